@@ -7,49 +7,317 @@ This module will be called to wait until SHC is completely setup and
 initial bundle replication has occurred such that user defined
 bundles are safe to push
 '''
+import os
+import errno
+import fcntl
+import tempfile
 import time
 import json
+import math
 import requests
+from multiprocessing.pool import ThreadPool
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from ansible.module_utils.basic import AnsibleModule
 
+# Circuit breaker state shared with the splunk_api module, see circuit_call() in library/splunk_api.py
+CIRCUIT_STATE_PATH = os.path.join(tempfile.gettempdir(), "splunk_api-{}".format(os.getuid()), "circuits.json")
+CIRCUIT_DEFAULTS = {"threshold": 3, "cooldown": 10.0, "max_cooldown": 300.0, "probe_timeout": 60.0}
+MEMBER_PROBE_TIMEOUT = 10
+# Of a request for the status of the SHC, cut short by the deadline of a wait
+STATUS_TIMEOUT = 10
+
+class Circuit(object):
+    '''
+    Circuit breaker of a splunkd target, in the same state file and format as the splunk_api module so
+    that both see the failures of the other
+    '''
+    def __init__(self, target, settings, state_path=CIRCUIT_STATE_PATH):
+        self.target = target
+        self.settings = dict(CIRCUIT_DEFAULTS)
+        self.settings.update((k, type(CIRCUIT_DEFAULTS[k])(v)) for k, v in settings.items() if k in CIRCUIT_DEFAULTS and v is not None)
+        self.state_path = state_path
+
+    def private_dir(self):
+        path = os.path.dirname(self.state_path)
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return False
+        st = os.lstat(path)
+        return st.st_uid == os.getuid() and not st.st_mode & 0o077 and os.path.isdir(path) and not os.path.islink(path)
+
+    def update(self, update):
+        if not self.private_dir():
+            return update({})
+        with open(self.state_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_path, "r") as f:
+                    states = json.load(f)
+            except (IOError, OSError, ValueError):
+                states = {}
+            state = dict(states.get(self.target) or {})
+            result = update(state)
+            if state != states.get(self.target, {}):
+                if state:
+                    states[self.target] = state
+                else:
+                    states.pop(self.target, None)
+                try:
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.state_path), prefix=".circuits")
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(states, f)
+                    os.rename(tmp, self.state_path)
+                except (IOError, OSError):
+                    pass
+        return result
+
+    def acquire(self):
+        '''
+        Return None when the target may be called, else why it is refused
+        '''
+        def update(state):
+            now = time.time()
+            if state.get("failures", 0) < self.settings["threshold"]:
+                return None
+            # Opened by callers with a longer max_cooldown, it holds this one no longer than its own
+            open_until = min(state["open_until"], state["open_until"] - state["cooldown"] + self.settings["max_cooldown"])
+            if now < open_until:
+                return "{} consecutive failures, next probe in {:.0f}s".format(state["failures"], open_until - now)
+            if now < state.get("probe_until", 0):
+                return "{} consecutive failures, waiting on the probe in flight".format(state["failures"])
+            state["probe_until"] = now + self.settings["probe_timeout"]
+            return None
+        return self.update(update)
+
+    def report(self, healthy):
+        def update(state):
+            if healthy:
+                state.clear()
+                return
+            state["failures"] = state.get("failures", 0) + 1
+            if state["failures"] >= self.settings["threshold"]:
+                cooldown = state.get("cooldown")
+                state["cooldown"] = min(cooldown * 2, self.settings["max_cooldown"]) if cooldown else self.settings["cooldown"]
+                state["open_until"] = time.time() + state["cooldown"]
+                state["probe_until"] = 0
+        self.update(update)
+
+def get_quorum(quorum, peers):
+    '''
+    Number of peers that must be ready, out of peers, for a quorum given as a count or as a percentage such
+    as "80%", all of them by default
+    '''
+    if quorum is None or quorum == "":
+        return peers
+    quorum = "{0}".format(quorum).strip()
+    try:
+        if quorum.endswith("%"):
+            required = int(math.ceil(round(float(quorum[:-1]) * peers / 100.0, 6)))
+        else:
+            required = int(quorum)
+    except ValueError:
+        raise ValueError("Invalid quorum {0}, expected a number of peers or a percentage".format(quorum))
+    if required < 1 or required > peers:
+        raise ValueError("Invalid quorum {0}, expected between 1 and {1} peers".format(quorum, peers))
+    return required
+
 class ShcReady(object):
     def __init__(self, module):
         self.captain_url = module.params["captain_url"]
         self.shc_peers = module.params["shc_peers"]
         self.user = module.params["spl_user"]
         self.password = module.params["spl_pass"]
+        self.timeout = module.params.get("timeout")
+        self.interval = module.params.get("interval") or 1.0
+        self.backoff = module.params.get("backoff") or 1.5
+        self.max_interval = max(module.params.get("max_interval") or 10.0, self.interval)
+        self.required = get_quorum(module.params.get("quorum"), len(self.shc_peers))
+        self.probe_threads = module.params.get("probe_threads") or 0
+        self.unconfirmed = {}
+        self.circuit = None
+        if module.params.get("circuit") is not None:
+            self.circuit = Circuit("https://{0}:8089".format(self.captain_url), module.params["circuit"],
+                                   os.environ.get("SPLUNK_API_CIRCUIT_STATE") or CIRCUIT_STATE_PATH)
+        # Every poll goes over the same keep-alive connection
+        self.session = requests.Session()
+        self.session.auth = (self.user, self.password)
+        self.session.verify = False
 
-    def run(self):
+    def get_status(self, url, timeout=STATUS_TIMEOUT):
+        if self.circuit is None:
+            return self.session.get(url, timeout=timeout).json()
+        refused = self.circuit.acquire()
+        if refused:
+            raise Exception("Circuit open for {0}: {1}".format(self.circuit.target, refused))
+        try:
+            resp = self.session.get(url, timeout=timeout)
+        except requests.exceptions.RequestException:
+            self.circuit.report(False)
+            raise
+        # The captain answering, even that the SHC is not ready, is healthy
+        self.circuit.report(resp.status_code < 500)
+        return resp.json()
+
+    def get_peers(self, timeout=STATUS_TIMEOUT):
         URL = "https://{0}:8089/services/shcluster/status?output_mode=json".format(self.captain_url)
-        online_peers = None
-        resp = requests.get(URL, auth=(self.user, self.password), verify=False).json()
-        shc_peers = resp['entry'][0]['content']['peers']
+        resp = self.get_status(URL, timeout)
+        return resp['entry'][0]['content']['peers']
+
+    def check(self, shc_peers):
         # Check #1, see if peers are up
         # the comparison will be >= in case play is run after cluster is setup
-        if not shc_peers or len(shc_peers.keys()) < len(self.shc_peers): # SH Captain included in list
+        if not shc_peers or len(shc_peers.keys()) < self.required: # SH Captain included in list
             raise Exception("SHC failure, setup not complete. Insufficient number of peers online")
         #correct number of peers online
         # Check #2, see if peers are ready to accept bundle
         online_peers = [peer for peer in shc_peers if shc_peers[peer].get('last_conf_replication', None) != "Pending"]
-        if len(online_peers) < len(self.shc_peers): # SH Captain included in list
+        # Check #3, see if the peers the captain sees ready agree
+        self.unconfirmed = {}
+        if self.probe_threads > 0:
+            probes = self.probe(dict((peer, shc_peers[peer]) for peer in online_peers))
+            self.unconfirmed = dict((shc_peers[peer].get("label") or peer, probes[peer]) for peer in online_peers if probes[peer])
+            online_peers = [peer for peer in online_peers if not probes[peer]]
+        if len(online_peers) < self.required: # SH Captain included in list
             raise Exception("SHC failure, setup not complete. online_peers:{0}".format(online_peers))
-        #correct number of peers ready to accept bundle
+        #enough peers ready to accept bundle
+        return online_peers
+
+    def probe_member(self, peer):
+        '''
+        Return None when the member confirms it is ready, else why not
+        '''
+        if not peer.get("mgmt_uri"):
+            return "No mgmt_uri"
+        url = "{0}/services/shcluster/member/info?output_mode=json".format(peer["mgmt_uri"].rstrip("/"))
+        try:
+            resp = self.session.get(url, timeout=MEMBER_PROBE_TIMEOUT)
+            if resp.status_code != 200:
+                return "HTTP {0}".format(resp.status_code)
+            content = resp.json()["entry"][0]["content"]
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            return "{0}".format(e)
+        if content.get("status", "Up") != "Up":
+            return "Status {0}".format(content["status"])
+        if content.get("last_conf_replication") == "Pending":
+            return "Pending"
+        return None
+
+    def probe(self, shc_peers):
+        '''
+        Probe the members concurrently, returning what probe_member() found for each of them
+        '''
+        if not shc_peers:
+            return {}
+        peers = list(shc_peers)
+        pool = ThreadPool(min(self.probe_threads, len(peers)))
+        try:
+            results = pool.map(lambda peer: self.probe_member(shc_peers[peer]), peers)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(peers, results))
+
+    def facts(self, online_peers):
         return {1:self.captain_url, 2:self.shc_peers, 3: self.user, 4: self.password, 5:online_peers}
 
+    def run(self):
+        return self.facts(self.check(self.get_peers()))
+
+    def wait(self):
+        '''
+        Poll the captain until the SHC is ready or the timeout expires. The interval goes back to its minimum
+        whenever a peer changes, as the SHC is then making progress, and grows by backoff up to max_interval
+        otherwise. Returns the facts, None on timeout, along with a report of the wait.
+        '''
+        if self.circuit is not None:
+            # The polls open the circuit, which must not keep them apart for longer than max_interval
+            self.circuit.settings.update(cooldown=min(self.circuit.settings["cooldown"], self.interval),
+                                         max_cooldown=min(self.circuit.settings["max_cooldown"], self.max_interval))
+        start = time.time()
+        deadline = start + self.timeout
+        interval = self.interval
+        states = {}
+        report = {"attempts": 0, "transitions": [], "ready_at": {}, "stragglers": [], "missing": len(self.shc_peers),
+                  "required": self.required, "unconfirmed": {}}
+        last_not_ready = None
+        while True:
+            report["attempts"] += 1
+            changed = False
+            try:
+                shc_peers = self.get_peers(max(min(STATUS_TIMEOUT, deadline - time.time()), 1)) or {}
+            except Exception as e:
+                report["error"] = "{0}".format(e)
+                shc_peers = None
+            if shc_peers is not None:
+                now = round(time.time() - start, 3)
+                for key, peer in sorted(shc_peers.items()):
+                    name = peer.get("label") or key
+                    state = peer.get("last_conf_replication")
+                    if name not in states or states[name] != state:
+                        report["transitions"].append({"peer": name, "from": states.get(name), "to": state, "at": now})
+                        states[name] = state
+                        changed = True
+                    if state == "Pending":
+                        report["ready_at"].pop(name, None)
+                    else:
+                        report["ready_at"].setdefault(name, now)
+                report["missing"] = max(len(self.shc_peers) - len(shc_peers), 0)
+                try:
+                    online_peers = self.check(shc_peers)
+                except Exception as e:
+                    report["error"] = "{0}".format(e)
+                    online_peers = None
+                report["unconfirmed"] = self.unconfirmed
+                not_ready = set(name for name, state in states.items() if state == "Pending") | set(self.unconfirmed)
+                if online_peers is not None:
+                    report.pop("error", None)
+                    report["time_to_ready"] = now
+                    # The peers not ready when last polled are the ones readiness waited on, those still not
+                    # ready were left behind by the quorum
+                    report["stragglers"] = sorted(set(last_not_ready or []) - not_ready)
+                    report["left_behind"] = sorted(not_ready)
+                    return self.facts(online_peers), report
+                last_not_ready = not_ready
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                report["stragglers"] = sorted(last_not_ready or [])
+                return None, report
+            interval = self.interval if changed else min(interval * self.backoff, self.max_interval)
+            time.sleep(min(interval, remaining))
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             captain_url=dict(required=True, type='str'),
             shc_peers=dict(required=True, type='list'),
             spl_user=dict(required=True, type='str'),
-            spl_pass=dict(required=True, type='str')
+            spl_pass=dict(required=True, type='str', no_log=True),
+            circuit=dict(required=False, type='dict'),
+            timeout=dict(required=False, type='float'),
+            interval=dict(required=False, type='float'),
+            backoff=dict(required=False, type='float'),
+            max_interval=dict(required=False, type='float'),
+            quorum=dict(required=False, type='str'),
+            probe_threads=dict(required=False, type='int')
         )
     )
-    shc_ready = ShcReady(module).run()
-    res = dict(changed=False, ansible_facts=shc_ready, rc=0)
-    module.exit_json(**res)
+    try:
+        shc_ready = ShcReady(module)
+    except ValueError as e:
+        module.fail_json(msg="{0}".format(e), rc=1)
+    if module.params.get("timeout") is None:
+        res = dict(changed=False, ansible_facts=shc_ready.run(), rc=0)
+        module.exit_json(**res)
+    if shc_ready.interval <= 0 or shc_ready.backoff < 1:
+        module.fail_json(msg="shc_ready needs interval > 0 and backoff >= 1", rc=1)
+    facts, report = shc_ready.wait()
+    if facts is None:
+        module.fail_json(msg="SHC not ready within {0}s after {1} attempts, last: {2}".format(
+            shc_ready.timeout, report["attempts"], report.get("error")), rc=1, **report)
+    module.exit_json(changed=False, ansible_facts=facts, rc=0, **report)
 
 if __name__ == '__main__':
     main()
@@ -17,13 +17,22 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import os
+import sys
 import platform
 import json
 import argparse
 import re
 import random
 import string
-from time import sleep
+import hashlib
+import tempfile
+import math
+from time import sleep, time
+from collections import OrderedDict
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 try:
     from urllib.parse import urlparse
 except ImportError:
@@ -32,6 +41,16 @@ import socket
 import requests
 import urllib3
 import yaml
+try:
+    # libyaml-backed loader, roughly an order of magnitude faster than the pure-Python one
+    from yaml import CSafeLoader as BaseDefaultsLoader
+except ImportError:
+    from yaml import SafeLoader as BaseDefaultsLoader
+try:
+    # Optional, several times faster than json.dumps() on large inventories
+    import orjson
+except ImportError:
+    orjson = None
 
 urllib3.disable_warnings()
 
@@ -40,6 +59,10 @@ _PLATFORM = platform.platform().lower()
 PLATFORM = "windows" if ("windows" in _PLATFORM or "cygwin" in _PLATFORM) else "linux"
 HOSTNAME = os.uname()[1]
 JAVA_VERSION_WHITELIST = frozenset(("oracle:8", "openjdk:8", "openjdk:9", "openjdk:11"))
+SPLUNKBASE_HOST = "splunkbase.splunk.com"
+SPLUNKBASE_LOGIN_URL = "https://splunkbase.splunk.com/api/account:login/"
+# Lifetime (in seconds) of a cached Splunkbase session token
+SPLUNKBASE_TOKEN_TTL = 3600
 
 roleNames = [
     'splunk_cluster_master', # (if it exists, set up indexer clustering)
@@ -60,6 +83,54 @@ reVarPrefix = r"${varPrefix}(.*)"
 envPrefix = "SPLUNK_ROLE_"
 reNamePattern = r"${envPrefix}(.*)"
 
+# Environment variables indexed by getEnv(), by prefix and by exact name
+ENV_SNAPSHOT_PREFIXES = ("SPLUNK_", "SPLUNKD_", "JAVA_", "DMC_")
+ENV_SNAPSHOT_NAMES = frozenset(("ARTIFACTORY_TOKEN", "ARTIFACTORY_USER", "ENABLE_TCP_MODE", "HIDE_PASSWORD",
+                                "KUBERNETES_SERVICE_HOST", "SPARK_MASTER_HOST", "SPARK_MASTER_WEBUI_PORT",
+                                "SPLUNKBASE_PASSWORD", "SPLUNKBASE_TOKEN_CACHE", "SPLUNKBASE_TOKEN_TTL",
+                                "SPLUNKBASE_USERNAME"))
+envSnapshot = {"source": None, "vars": {}}
+
+# Bump whenever the layout of a defaults cache entry changes
+DEFAULTS_CACHE_VERSION = 1
+# Environment variables that influence which defaults sources get loaded, rather than how they are fetched or cached
+reDefaultsCacheEnv = re.compile(r"^SPLUNK_(ROLE|DEFAULTS_(?!CACHE_|HTTP_MAX_|HTTP_MIRROR_DIR$|HTTP_SERVE_STALE$).*)$")
+# Validators (ETag/Last-Modified) of every remote default.yml fetched during this run
+urlValidators = {}
+# Retry counters and timings of every remote default.yml fetched during this run
+urlFetchStats = {}
+# Initial backoff (in seconds) between attempts to fetch a remote default.yml
+RETRY_BASE_DELAY = 1
+# How lists are combined when merging default.yml layers, besides "keyed:<field>" for lists of dicts
+MERGE_STRATEGY_NAMES = ("replace", "append", "append-unique")
+# Built-in list merge strategies by dotted path, extended by config.merge_strategies; other lists are appended
+MERGE_STRATEGIES = {
+    "splunk.apps_location": "append-unique",
+    "splunk.apps_location_local": "append-unique",
+    "splunk.smartstore.index": "keyed:indexName",
+}
+
+class DefaultsLoader(BaseDefaultsLoader):
+    """
+    Safe YAML loader that additionally understands the python/object/apply:os.path.join
+    tags used to derive paths in the shipped defaults
+    """
+    pass
+
+def constructPathJoin(loader, node):
+    """
+    Build a filesystem path from a YAML sequence the same way os.path.join would
+    """
+    return os.path.join(*loader.construct_sequence(node, deep=True))
+
+DefaultsLoader.add_constructor(u"tag:yaml.org,2002:python/object/apply:os.path.join", constructPathJoin)
+
+def loadYAML(content):
+    """
+    Parse YAML content (string or file object) using the fastest safe loader available
+    """
+    return yaml.load(content, Loader=DefaultsLoader)
+
 inventory = {
     "_meta": {
         "hostvars": {}
@@ -73,18 +144,195 @@ inventory = {
     }
 }
 
-def getVars(rePattern):
-    """
-    Return a mapping of environment keys::values if they match a given regex
-    """
-    return {re.match(rePattern, k).group(1).lower():os.environ[k] for k in os.environ
-            if re.match(rePattern, k)}
+# Declarative environment variable overrides, grouped by the get*() helper applying them. Each
+# entry maps a variable onto a dotted path in the defaults as (variable, path, coercion, default);
+# when the variable is unset, the current value (or the default when missing) is coerced instead.
+ENV_OVERRIDES = {
+    "paths": [
+        ("SPLUNK_OPT", "splunk.opt", None, None),
+        ("SPLUNK_HOME", "splunk.home", None, None),
+        ("SPLUNK_EXEC", "splunk.exec", None, None),
+        ("SPLUNK_PID", "splunk.pid", None, None),
+    ],
+    "idxc": [
+        ("SPLUNK_IDXC_LABEL", "splunk.idxc.label", None, None),
+        ("SPLUNK_IDXC_SECRET", "splunk.idxc.secret", None, None),
+        ("SPLUNK_IDXC_PASS4SYMMKEY", "splunk.idxc.pass4SymmKey", None, None),
+        ("SPLUNK_IDXC_DISCOVERYPASS4SYMMKEY", "splunk.idxc.discoveryPass4SymmKey", None, None),
+    ],
+    "shc": [
+        ("SPLUNK_SHC_LABEL", "splunk.shc.label", None, None),
+        ("SPLUNK_SHC_SECRET", "splunk.shc.secret", None, None),
+        ("SPLUNK_SHC_PASS4SYMMKEY", "splunk.shc.pass4SymmKey", None, None),
+    ],
+    "multisite": [
+        ("SPLUNK_MULTISITE_MASTER_PORT", "splunk.multisite_master_port", int, 8089),
+        ("SPLUNK_MULTISITE_REPLICATION_FACTOR_ORIGIN", "splunk.multisite_replication_factor_origin", int, 1),
+        ("SPLUNK_MULTISITE_REPLICATION_FACTOR_TOTAL", "splunk.multisite_replication_factor_total", int, 1),
+        ("SPLUNK_MULTISITE_SEARCH_FACTOR_ORIGIN", "splunk.multisite_search_factor_origin", int, 1),
+        ("SPLUNK_MULTISITE_SEARCH_FACTOR_TOTAL", "splunk.multisite_search_factor_total", int, 1),
+    ],
+    "web_ssl": [
+        ("SPLUNK_HTTP_ENABLESSL", "splunk.http_enableSSL", None, None),
+        ("SPLUNK_HTTP_ENABLESSL_CERT", "splunk.http_enableSSL_cert", None, None),
+        ("SPLUNK_HTTP_ENABLESSL_PRIVKEY", "splunk.http_enableSSL_privKey", None, None),
+        ("SPLUNK_HTTP_ENABLESSL_PRIVKEY_PASSWORD", "splunk.http_enableSSL_privKey_password", None, None),
+        ("SPLUNK_HTTP_PORT", "splunk.http_port", int, None),
+    ],
+    "splunkd_ssl": [
+        ("SPLUNKD_SSL_CERT", "splunk.ssl.cert", None, None),
+        ("SPLUNKD_SSL_CA", "splunk.ssl.ca", None, None),
+        ("SPLUNKD_SSL_PASSWORD", "splunk.ssl.password", None, None),
+    ],
+    "topology": [
+        ("SPLUNK_DEPLOYER_URL", "splunk.deployer_url", None, ""),
+        ("SPLUNK_CLUSTER_MASTER_URL", "splunk.cluster_master_url", None, ""),
+        ("SPLUNK_SEARCH_HEAD_CAPTAIN_URL", "splunk.search_head_captain_url", None, ""),
+    ],
+    "build": [
+        ("SPLUNK_BUILD_URL_BEARER_TOKEN", "splunk.build_url_bearer_token", None, None),
+        ("SPLUNK_BUILD_URL", "splunk.build_location", None, None),
+    ],
+    "build_auth": [
+        ("ARTIFACTORY_USER", "splunk.artifact_auth_user", None, None),
+        ("ARTIFACTORY_TOKEN", "splunk.artifact_auth_pass", None, None),
+    ],
+    "secrets": [
+        ("SPLUNK_PASS4SYMMKEY", "splunk.pass4SymmKey", None, None),
+        ("SPLUNK_SECRET", "splunk.secret", None, None),
+    ],
+    "asan": [
+        ("SPLUNK_ENABLE_ASAN", "splunk.asan", bool, None),
+    ],
+    "hec": [
+        ("SPLUNK_HEC_TOKEN", "splunk.hec.token", None, None),
+        ("SPLUNK_HEC_PORT", "splunk.hec.port", int, None),
+    ],
+    "dsp": [
+        ("SPLUNK_DSP_SERVER", "splunk.dsp.server", None, None),
+        ("SPLUNK_DSP_CERT", "splunk.dsp.cert", None, None),
+        ("SPLUNK_DSP_PIPELINE_NAME", "splunk.dsp.pipeline_name", None, None),
+        ("SPLUNK_DSP_PIPELINE_DESC", "splunk.dsp.pipeline_desc", None, None),
+        ("SPLUNK_DSP_PIPELINE_SPEC", "splunk.dsp.pipeline_spec", None, None),
+    ],
+    "dfs": [
+        ("SPLUNK_ENABLE_DFS", "splunk.dfs.enable", bool, None),
+        ("SPLUNK_DFW_NUM_SLOTS", "splunk.dfs.dfw_num_slots", int, 10),
+        ("SPLUNK_DFC_NUM_SLOTS", "splunk.dfs.dfc_num_slots", int, 4),
+        ("SPLUNK_DFW_NUM_SLOTS_ENABLED", "splunk.dfs.dfw_num_slots_enabled", bool, None),
+        ("SPARK_MASTER_HOST", "splunk.dfs.spark_master_host", None, "127.0.0.1"),
+        ("SPARK_MASTER_WEBUI_PORT", "splunk.dfs.spark_master_webui_port", int, 8080),
+    ],
+    "general": [
+        ("SPLUNK_USER", "splunk.user", None, None),
+        ("SPLUNK_GROUP", "splunk.group", None, None),
+        ("SPLUNK_CERT_PREFIX", "cert_prefix", None, "https"),
+        ("SPLUNK_ROOT_ENDPOINT", "splunk.root_endpoint", None, None),
+        ("SPLUNK_SVC_PORT", "splunk.svc_port", None, None),
+        ("SPLUNK_S2S_PORT", "splunk.s2s.port", int, None),
+        ("SPLUNK_ENABLE_SERVICE", "splunk.enable_service", None, None),
+        ("SPLUNK_SERVICE_NAME", "splunk.service_name", None, None),
+        ("SPLUNK_ALLOW_UPGRADE", "splunk.allow_upgrade", None, None),
+        ("SPLUNK_APPSERVER_PORT", "splunk.appserver.port", None, None),
+        ("SPLUNK_KVSTORE_PORT", "splunk.kvstore.port", None, None),
+        ("SPLUNK_CONNECTION_TIMEOUT", "splunk.connection_timeout", int, None),
+    ],
+}
+
+def compileEnvOverrides(entries):
+    """
+    Group override entries by their parent path, so that each parent is only looked up once
+    """
+    groups = OrderedDict()
+    for var, path, coerce, default in entries:
+        keys = path.split(".")
+        groups.setdefault(tuple(keys[:-1]), []).append((var, keys[-1], coerce, default))
+    return list(groups.items())
+
+envOverrideTable = {section: compileEnvOverrides(entries) for section, entries in ENV_OVERRIDES.items()}
+# Validation errors deferred while collectEnvOverrideErrors() is running
+envOverrideErrors = {"collect": False, "errors": []}
+
+def getEnv():
+    """
+    Return an indexed snapshot of the environment variables consulted while building the inventory.
+    The snapshot is built in a single pass and reused until os.environ is replaced.
+    """
+    if envSnapshot["source"] is not os.environ:
+        envSnapshot["vars"] = {k: os.environ[k] for k in os.environ
+                               if k.startswith(ENV_SNAPSHOT_PREFIXES) or k in ENV_SNAPSHOT_NAMES}
+        envSnapshot["source"] = os.environ
+    return envSnapshot["vars"]
+
+def getVars(rePattern, env=None):
+    """
+    Return a mapping of environment keys::values if they match a given regex.
+    Only the given env mapping is searched, if any, rather than the whole environment.
+    """
+    if env is None:
+        env = os.environ
+    match = re.compile(rePattern).match
+    result = {}
+    # Only decode the values of matching keys, which matters with thousands of injected variables
+    for k in env:
+        m = match(k)
+        if m:
+            result[m.group(1).lower()] = env[k]
+    return result
+
+def applyEnvOverrides(vars_scope, section):
+    """
+    Apply one section of ENV_OVERRIDES to vars_scope in-place, creating intermediate dicts as needed.
+    Every coercion failure in the section is reported at once, or handed to collectEnvOverrideErrors()
+    """
+    env = getEnv()
+    errors = []
+    for parent_path, entries in envOverrideTable[section]:
+        parent = vars_scope
+        for key in parent_path:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        for var, leaf, coerce, default in entries:
+            value = env[var] if var in env else parent.get(leaf, default)
+            if coerce:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    source = var if var in env else ".".join(parent_path + (leaf,))
+                    errors.append("{}={!r} is not a valid {}".format(source, value, coerce.__name__))
+            parent[leaf] = value
+    if envOverrideErrors["collect"]:
+        envOverrideErrors["errors"].extend(errors)
+    elif errors:
+        raise Exception("Invalid configuration: {}".format("; ".join(errors)))
+
+def collectEnvOverrideErrors(callback, *args):
+    """
+    Run callback while deferring the validation errors of applyEnvOverrides(), then raise all of them together
+    """
+    envOverrideErrors["collect"] = True
+    envOverrideErrors["errors"] = []
+    try:
+        result = callback(*args)
+    except Exception:
+        # Invalid values tend to trip up later steps as well, so surface the root causes first
+        if not envOverrideErrors["errors"]:
+            raise
+        result = None
+    finally:
+        envOverrideErrors["collect"] = False
+    if envOverrideErrors["errors"]:
+        raise Exception("Invalid configuration: {}".format("; ".join(envOverrideErrors["errors"])))
+    return result
 
 def getSplunkInventory(inventory, reName=r"(.*)_URL"):
     """
     Build an inventory of hosts based on a regex that defines host-groupings
     """
-    group_information = getVars(reName)
+    env = getEnv()
+    # Role groups are named after SPLUNK_<ROLE>_URL variables, all of which are in the snapshot
+    group_information = getVars(reName, env)
     for group_name in group_information:
         if group_name.lower() in roleNames:
             inventory[group_name] = {}
@@ -94,8 +342,9 @@ def getSplunkInventory(inventory, reName=r"(.*)_URL"):
             }
     inventory["all"]["vars"] = getDefaultVars()
     inventory["all"]["vars"]["docker"] = False
+    inventory["all"]["vars"]["defaults_http_stats"] = [urlFetchStats[url] for url in sorted(urlFetchStats)]
 
-    if os.path.isfile("/.dockerenv") or os.path.isfile("/run/.containerenv") or os.path.isdir("/var/run/secrets/kubernetes.io") or os.environ.get("KUBERNETES_SERVICE_HOST"):
+    if os.path.isfile("/.dockerenv") or os.path.isfile("/run/.containerenv") or os.path.isdir("/var/run/secrets/kubernetes.io") or env.get("KUBERNETES_SERVICE_HOST"):
         inventory["all"]["vars"]["docker"] = True
         if "localhost" not in inventory["all"]["children"]:
             inventory["all"]["hosts"].append("localhost")
@@ -107,8 +356,14 @@ def getDefaultVars():
     Load all splunk-ansible defaults and perform overwrites based on
     environment variables to return a consolidated inventory object
     """
-    defaultVars = loadDefaults()
-    defaultVars["splunk"]["role"] = os.environ.get('SPLUNK_ROLE', defaultVars["splunk"].get("role") or "splunk_standalone")
+    return collectEnvOverrideErrors(overrideDefaultVars, loadDefaults())
+
+def overrideDefaultVars(defaultVars):
+    """
+    Perform overwrites of the given defaults based on environment variables
+    """
+    env = getEnv()
+    defaultVars["splunk"]["role"] = env.get('SPLUNK_ROLE', defaultVars["splunk"].get("role") or "splunk_standalone")
     overrideEnvironmentVars(defaultVars)
     getAnsibleContext(defaultVars)
     getASan(defaultVars)
@@ -126,27 +381,29 @@ def getDefaultVars():
     getDistributedTopology(defaultVars)
     getLicenses(defaultVars)
     # Determine DMC settings
-    defaultVars["dmc_forwarder_monitoring"] = os.environ.get('DMC_FORWARDER_MONITORING', False)
-    defaultVars["dmc_asset_interval"] = os.environ.get('DMC_ASSET_INTERVAL', '3,18,33,48 * * * *')
+    defaultVars["dmc_forwarder_monitoring"] = env.get('DMC_FORWARDER_MONITORING', False)
+    defaultVars["dmc_asset_interval"] = env.get('DMC_ASSET_INTERVAL', '3,18,33,48 * * * *')
     # Determine SPLUNK_HOME owner
     defaultVars["splunk_home_ownership_enforcement"] = True
-    if os.environ.get("SPLUNK_HOME_OWNERSHIP_ENFORCEMENT", "").lower() == "false":
+    if env.get("SPLUNK_HOME_OWNERSHIP_ENFORCEMENT", "").lower() == "false":
         defaultVars["splunk_home_ownership_enforcement"] = False
     # Determine password visibility
-    if os.environ.get("HIDE_PASSWORD", "").lower() == "true":
+    if env.get("HIDE_PASSWORD", "").lower() == "true":
         defaultVars["hide_password"] = True
     # Determine SHC preferred captaincy
     defaultVars["splunk"]["preferred_captaincy"] = True
-    if os.environ.get("SPLUNK_PREFERRED_CAPTAINCY", "").lower() == "false":
+    if env.get("SPLUNK_PREFERRED_CAPTAINCY", "").lower() == "false":
         defaultVars["splunk"]["preferred_captaincy"] = False
-    defaultVars["splunk"]["hostname"] = os.environ.get('SPLUNK_HOSTNAME', socket.getfqdn())
+    defaultVars["splunk"]["hostname"] = env.get('SPLUNK_HOSTNAME', socket.getfqdn())
 
     getJava(defaultVars)
     getSplunkBuild(defaultVars)
-    getSplunkbaseToken(defaultVars)
     getSplunkBuildAuth(defaultVars)
     getSplunkApps(defaultVars)
     getSplunkAppsLocal(defaultVars)
+    # getSplunkbaseToken() must be called after getSplunkApps() + getSplunkAppsLocal()
+    # in order to only authenticate when an app is actually fetched from Splunkbase
+    getSplunkbaseToken(defaultVars)
     getLaunchConf(defaultVars)
     getDFS(defaultVars)
     getUFSplunkVariables(defaultVars)
@@ -160,31 +417,22 @@ def getSplunkPaths(vars_scope):
     Normalize the paths used by Splunk for downstream plays
     """
     # TODO: Handle changes to SPLUNK_HOME that impact other paths (ex splunk.app_paths.*)
-    splunk_vars = vars_scope["splunk"]
-    splunk_vars["opt"] = os.environ.get("SPLUNK_OPT", splunk_vars.get("opt"))
-    splunk_vars["home"] = os.environ.get("SPLUNK_HOME", splunk_vars.get("home"))
-    # Not sure if we should expose this - exec is fixed relative to SPLUNK_HOME
-    splunk_vars["exec"] = os.environ.get("SPLUNK_EXEC", splunk_vars.get("exec"))
-    # Not sure if we should expose this - pid is fixed relative to SPLUNK_HOME
-    splunk_vars["pid"] = os.environ.get("SPLUNK_PID", splunk_vars.get("pid"))
+    # Not sure if we should expose exec/pid - they are fixed relative to SPLUNK_HOME
+    applyEnvOverrides(vars_scope, "paths")
 
 def getIndexerClustering(vars_scope):
     """
     Parse and set parameters to configure indexer clustering
     """
-    if "idxc" not in vars_scope["splunk"]:
-        vars_scope["splunk"]["idxc"] = {}
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "idxc")
     idxc_vars = vars_scope["splunk"]["idxc"]
-    idxc_vars["label"] = os.environ.get("SPLUNK_IDXC_LABEL", idxc_vars.get("label"))
-    idxc_vars["secret"] = os.environ.get("SPLUNK_IDXC_SECRET", idxc_vars.get("secret"))
-    idxc_vars["pass4SymmKey"] = os.environ.get("SPLUNK_IDXC_PASS4SYMMKEY", idxc_vars.get("pass4SymmKey")) # Control flow for issue #316 backwards-compatibility
+    # Control flow for issue #316 backwards-compatibility
     if idxc_vars["pass4SymmKey"]:
         idxc_vars["secret"] = idxc_vars["pass4SymmKey"]
     else:
-        idxc_vars["secret"] = os.environ.get("SPLUNK_IDXC_SECRET", idxc_vars.get("secret"))
         idxc_vars["pass4SymmKey"] = idxc_vars["secret"]
     # Support separate pass4SymmKey for indexer discovery
-    idxc_vars["discoveryPass4SymmKey"] = os.environ.get("SPLUNK_IDXC_DISCOVERYPASS4SYMMKEY", idxc_vars.get("discoveryPass4SymmKey"))
     if not idxc_vars["discoveryPass4SymmKey"]:
         idxc_vars["discoveryPass4SymmKey"] = idxc_vars["pass4SymmKey"]
     # Rectify replication factor (https://docs.splunk.com/Documentation/Splunk/latest/Indexer/Thereplicationfactor)
@@ -195,25 +443,23 @@ def getIndexerClustering(vars_scope):
     else:
         # Only occurs during create-defaults generation or topologies without indexers
         indexer_count = idxc_vars.get("replication_factor", 1)
-    replf = os.environ.get("SPLUNK_IDXC_REPLICATION_FACTOR", idxc_vars.get("replication_factor", 1))
+    replf = env.get("SPLUNK_IDXC_REPLICATION_FACTOR", idxc_vars.get("replication_factor", 1))
     idxc_vars["replication_factor"] = min(indexer_count, int(replf))
     # Rectify search factor (https://docs.splunk.com/Documentation/Splunk/latest/Indexer/Thesearchfactor)
-    searchf = os.environ.get("SPLUNK_IDXC_SEARCH_FACTOR", idxc_vars.get("search_factor", 1))
+    searchf = env.get("SPLUNK_IDXC_SEARCH_FACTOR", idxc_vars.get("search_factor", 1))
     idxc_vars["search_factor"] = min(idxc_vars["replication_factor"], int(searchf))
 
 def getSearchHeadClustering(vars_scope):
     """
     Parse and set parameters to configure search head clustering
     """
-    if "shc" not in vars_scope["splunk"]:
-        vars_scope["splunk"]["shc"] = {}
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "shc")
     shc_vars = vars_scope["splunk"]["shc"]
-    shc_vars["label"] = os.environ.get("SPLUNK_SHC_LABEL", shc_vars.get("label"))
-    shc_vars["pass4SymmKey"] = os.environ.get("SPLUNK_SHC_PASS4SYMMKEY", shc_vars.get("pass4SymmKey")) # Control flow for issue #316 backwards-compatibility
+    # Control flow for issue #316 backwards-compatibility
     if shc_vars["pass4SymmKey"]:
         shc_vars["secret"] = shc_vars["pass4SymmKey"]
     else:
-        shc_vars["secret"] = os.environ.get("SPLUNK_SHC_SECRET", shc_vars.get("secret"))
         shc_vars["pass4SymmKey"] = shc_vars["secret"]
     # Rectify search factor (https://docs.splunk.com/Documentation/Splunk/latest/Indexer/Thesearchfactor)
     # Make sure default repl factor>0 else Splunk doesn't start unless user-defined
@@ -223,31 +469,28 @@ def getSearchHeadClustering(vars_scope):
     else:
         # Only occurs during create-defaults generation or topologies without search heads
         shcount = shc_vars.get("replication_factor", 1)
-    replf = os.environ.get("SPLUNK_SHC_REPLICATION_FACTOR", shc_vars.get("replication_factor", 1))
+    replf = env.get("SPLUNK_SHC_REPLICATION_FACTOR", shc_vars.get("replication_factor", 1))
     shc_vars["replication_factor"] = min(shcount, int(replf))
 
 def getMultisite(vars_scope):
     """
     Parse and set parameters to configure multisite
     """
+    env = getEnv()
     splunk_vars = vars_scope["splunk"]
-    if "SPLUNK_SITE" in os.environ or splunk_vars.get("site"):
-        splunk_vars["site"] = os.environ.get("SPLUNK_SITE", splunk_vars.get("site"))
+    if "SPLUNK_SITE" in env or splunk_vars.get("site"):
+        splunk_vars["site"] = env.get("SPLUNK_SITE", splunk_vars.get("site"))
 
-        all_sites = os.environ.get("SPLUNK_ALL_SITES", splunk_vars.get("all_sites"))
+        all_sites = env.get("SPLUNK_ALL_SITES", splunk_vars.get("all_sites"))
         if all_sites:
             splunk_vars["all_sites"] = all_sites
 
-        multisite_master = os.environ.get("SPLUNK_MULTISITE_MASTER", splunk_vars.get("multisite_master"))
+        multisite_master = env.get("SPLUNK_MULTISITE_MASTER", splunk_vars.get("multisite_master"))
         if multisite_master:
             splunk_vars["multisite_master"] = multisite_master
     # TODO: Split this into its own splunk.multisite.* section
-    splunk_vars["multisite_master_port"] = int(os.environ.get("SPLUNK_MULTISITE_MASTER_PORT", splunk_vars.get("multisite_master_port", 8089)))
-    splunk_vars["multisite_replication_factor_origin"] = int(os.environ.get("SPLUNK_MULTISITE_REPLICATION_FACTOR_ORIGIN", splunk_vars.get("multisite_replication_factor_origin", 1)))
-    splunk_vars["multisite_replication_factor_total"] = int(os.environ.get("SPLUNK_MULTISITE_REPLICATION_FACTOR_TOTAL", splunk_vars.get("multisite_replication_factor_total", 1)))
+    applyEnvOverrides(vars_scope, "multisite")
     splunk_vars["multisite_replication_factor_total"] = max(splunk_vars["multisite_replication_factor_total"], splunk_vars["idxc"]["replication_factor"])
-    splunk_vars["multisite_search_factor_origin"] = int(os.environ.get("SPLUNK_MULTISITE_SEARCH_FACTOR_ORIGIN", splunk_vars.get("multisite_search_factor_origin", 1)))
-    splunk_vars["multisite_search_factor_total"] = int(os.environ.get("SPLUNK_MULTISITE_SEARCH_FACTOR_TOTAL", splunk_vars.get("multisite_search_factor_total", 1)))
     splunk_vars["multisite_search_factor_total"] = max(splunk_vars["multisite_search_factor_total"], splunk_vars["idxc"]["search_factor"])
 
 def getSplunkWebSSL(vars_scope):
@@ -255,25 +498,17 @@ def getSplunkWebSSL(vars_scope):
     Parse and set parameters to define Splunk Web accessibility
     """
     # TODO: Split this into its own splunk.http.* section
-    splunk_vars = vars_scope["splunk"]
-    splunk_vars["http_enableSSL"] = os.environ.get('SPLUNK_HTTP_ENABLESSL', splunk_vars.get("http_enableSSL"))
-    splunk_vars["http_enableSSL_cert"] = os.environ.get('SPLUNK_HTTP_ENABLESSL_CERT', splunk_vars.get("http_enableSSL_cert"))
-    splunk_vars["http_enableSSL_privKey"] = os.environ.get('SPLUNK_HTTP_ENABLESSL_PRIVKEY', splunk_vars.get("http_enableSSL_privKey"))
-    splunk_vars["http_enableSSL_privKey_password"] = os.environ.get('SPLUNK_HTTP_ENABLESSL_PRIVKEY_PASSWORD', splunk_vars.get("http_enableSSL_privKey_password"))
-    splunk_vars["http_port"] = int(os.environ.get('SPLUNK_HTTP_PORT', splunk_vars.get("http_port")))
+    applyEnvOverrides(vars_scope, "web_ssl")
 
 def getSplunkdSSL(vars_scope):
     """
     Parse and set parameters to define Splunkd
     """
-    if "ssl" not in vars_scope["splunk"]:
-        vars_scope["splunk"]["ssl"] = {}
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "splunkd_ssl")
     ssl_vars = vars_scope["splunk"]["ssl"]
-    ssl_vars["cert"] = os.environ.get("SPLUNKD_SSL_CERT", ssl_vars.get("cert"))
-    ssl_vars["ca"] = os.environ.get("SPLUNKD_SSL_CA", ssl_vars.get("ca"))
-    ssl_vars["password"] = os.environ.get("SPLUNKD_SSL_PASSWORD", ssl_vars.get("password"))
     ssl_vars["enable"] = ssl_vars.get("enable", True)
-    enable = os.environ.get("SPLUNKD_SSL_ENABLE", "")
+    enable = env.get("SPLUNKD_SSL_ENABLE", "")
     if enable.lower() == "false":
         ssl_vars["enable"] = False
         vars_scope["cert_prefix"] = "http"
@@ -283,11 +518,10 @@ def getDistributedTopology(vars_scope):
     """
     Parse and set parameters to define topology if this is a distributed environment
     """
-    license_master_url = os.environ.get("SPLUNK_LICENSE_MASTER_URL", vars_scope["splunk"].get("license_master_url", ""))
+    env = getEnv()
+    license_master_url = env.get("SPLUNK_LICENSE_MASTER_URL", vars_scope["splunk"].get("license_master_url", ""))
     vars_scope["splunk"]["license_master_url"] = parseUrl(license_master_url, vars_scope)
-    vars_scope["splunk"]["deployer_url"] = os.environ.get("SPLUNK_DEPLOYER_URL", vars_scope["splunk"].get("deployer_url", ""))
-    vars_scope["splunk"]["cluster_master_url"] = os.environ.get("SPLUNK_CLUSTER_MASTER_URL", vars_scope["splunk"].get("cluster_master_url", ""))
-    vars_scope["splunk"]["search_head_captain_url"] = os.environ.get("SPLUNK_SEARCH_HEAD_CAPTAIN_URL", vars_scope["splunk"].get("search_head_captain_url", ""))
+    applyEnvOverrides(vars_scope, "topology")
     if not vars_scope["splunk"]["search_head_captain_url"] and "search_head_cluster_url" in vars_scope["splunk"]:
         vars_scope["splunk"]["search_head_captain_url"] = vars_scope["splunk"]["search_head_cluster_url"]
 
@@ -295,24 +529,26 @@ def getLicenses(vars_scope):
     """
     Determine the location of Splunk licenses to install at start-up time
     """
+    env = getEnv()
     # Need to provide some file value (does not have to exist). The task will automatically skip over if the file is not found. Otherwise, will throw an error if no file is specified.
-    vars_scope["splunk"]["license_uri"] = os.environ.get("SPLUNK_LICENSE_URI", vars_scope["splunk"].get("license_uri") or "splunk.lic")
+    vars_scope["splunk"]["license_uri"] = env.get("SPLUNK_LICENSE_URI", vars_scope["splunk"].get("license_uri") or "splunk.lic")
     vars_scope["splunk"]["wildcard_license"] = False
     if vars_scope["splunk"]["license_uri"] and '*' in vars_scope["splunk"]["license_uri"]:
         vars_scope["splunk"]["wildcard_license"] = True
     vars_scope["splunk"]["ignore_license"] = False
-    if os.environ.get("SPLUNK_IGNORE_LICENSE", "").lower() == "true":
+    if env.get("SPLUNK_IGNORE_LICENSE", "").lower() == "true":
         vars_scope["splunk"]["ignore_license"] = True
-    vars_scope["splunk"]["license_download_dest"] = os.environ.get("SPLUNK_LICENSE_INSTALL_PATH", vars_scope["splunk"].get("license_download_dest") or "/tmp/splunk.lic")
+    vars_scope["splunk"]["license_download_dest"] = env.get("SPLUNK_LICENSE_INSTALL_PATH", vars_scope["splunk"].get("license_download_dest") or "/tmp/splunk.lic")
 
 def getJava(vars_scope):
     """
     Parse and set Java installation parameters
     """
+    env = getEnv()
     vars_scope["java_version"] = vars_scope.get("java_version")
     vars_scope["java_download_url"] = vars_scope.get("java_download_url")
     vars_scope["java_update_version"] = vars_scope.get("java_update_version")
-    java_version = os.environ.get("JAVA_VERSION")
+    java_version = env.get("JAVA_VERSION")
     if not java_version:
         return
     java_version = java_version.lower()
@@ -321,13 +557,13 @@ def getJava(vars_scope):
     vars_scope["java_version"] = java_version
     # TODO: We can probably DRY this up
     if java_version == "oracle:8":
-        vars_scope["java_download_url"] = os.environ.get("JAVA_DOWNLOAD_URL", "https://download.oracle.com/otn-pub/java/jdk/8u141-b15/336fa29ff2bb4ef291e347e091f7f4a7/jdk-8u141-linux-x64.tar.gz")
+        vars_scope["java_download_url"] = env.get("JAVA_DOWNLOAD_URL", "https://download.oracle.com/otn-pub/java/jdk/8u141-b15/336fa29ff2bb4ef291e347e091f7f4a7/jdk-8u141-linux-x64.tar.gz")
         try:
             vars_scope["java_update_version"] = re.search(r"jdk-8u(\d+)-linux-x64.tar.gz", vars_scope["java_download_url"]).group(1)
         except:
             raise Exception("Invalid Java download URL format")
     elif java_version == "openjdk:11":
-        vars_scope["java_download_url"] = os.environ.get("JAVA_DOWNLOAD_URL", "https://download.java.net/java/GA/jdk11/9/GPL/openjdk-11.0.2_linux-x64_bin.tar.gz")
+        vars_scope["java_download_url"] = env.get("JAVA_DOWNLOAD_URL", "https://download.java.net/java/GA/jdk11/9/GPL/openjdk-11.0.2_linux-x64_bin.tar.gz")
         try:
             vars_scope["java_update_version"] = re.search(r"openjdk-(\d+\.\d+\.\d+)_linux-x64_bin.tar.gz", vars_scope["java_download_url"]).group(1)
         except:
@@ -337,38 +573,97 @@ def getSplunkBuild(vars_scope):
     """
     Determine the location of the Splunk build
     """
-    vars_scope["splunk"]["build_url_bearer_token"] = os.environ.get("SPLUNK_BUILD_URL_BEARER_TOKEN", vars_scope["splunk"].get("build_url_bearer_token"))
-    vars_scope["splunk"]["build_location"] = os.environ.get("SPLUNK_BUILD_URL", vars_scope["splunk"].get("build_location"))
+    applyEnvOverrides(vars_scope, "build")
+
+def usesSplunkbase(vars_scope):
+    """
+    Determine whether any of the apps to install is downloaded from Splunkbase
+    """
+    splunk_vars = vars_scope.get("splunk") or {}
+    apps = []
+    for key in ("apps_location", "apps_location_local"):
+        apps.extend(ensureListValue(splunk_vars.get(key), ","))
+    app_paths_install = splunk_vars.get("app_paths_install")
+    if isinstance(app_paths_install, dict):
+        for app_list in app_paths_install.values():
+            apps.extend(ensureListValue(app_list, ","))
+    return any(SPLUNKBASE_HOST in str(app) for app in apps)
 
 def getSplunkbaseToken(vars_scope):
     """
-    Authenticate to SplunkBase and modify the variable scope in-place to utilize temporary session token
+    Authenticate to SplunkBase and modify the variable scope in-place to utilize temporary session token.
+    Authentication is skipped unless an app is fetched from Splunkbase, and the session token is
+    reused from SPLUNKBASE_TOKEN_CACHE until it expires.
     """
+    env = getEnv()
     vars_scope["splunkbase_token"] = None
-    vars_scope["splunkbase_username"] = os.environ.get("SPLUNKBASE_USERNAME", vars_scope.get("splunkbase_username"))
-    vars_scope["splunkbase_password"] = os.environ.get("SPLUNKBASE_PASSWORD", vars_scope.get("splunkbase_password"))
-    if vars_scope["splunkbase_username"] and vars_scope["splunkbase_password"]:
-        resp = requests.post("https://splunkbase.splunk.com/api/account:login/",
-                             data={"username": vars_scope["splunkbase_username"], "password": vars_scope["splunkbase_password"]})
-        if resp.status_code != 200:
-            raise Exception("Invalid Splunkbase credentials - will not download apps from Splunkbase")
-        output = resp.content
-        if isinstance(output, bytes):
-            output = output.decode("utf-8", "ignore")
-        splunkbase_token = re.search("<id>(.*)</id>", output, re.IGNORECASE)
-        vars_scope["splunkbase_token"] = splunkbase_token.group(1) if splunkbase_token else None
+    vars_scope["splunkbase_username"] = env.get("SPLUNKBASE_USERNAME", vars_scope.get("splunkbase_username"))
+    vars_scope["splunkbase_password"] = env.get("SPLUNKBASE_PASSWORD", vars_scope.get("splunkbase_password"))
+    if not vars_scope["splunkbase_username"] or not vars_scope["splunkbase_password"]:
+        return
+    if not usesSplunkbase(vars_scope):
+        return
+    cache_file = env.get("SPLUNKBASE_TOKEN_CACHE", vars_scope.get("splunkbase_token_cache"))
+    vars_scope["splunkbase_token"] = loadSplunkbaseToken(cache_file, vars_scope["splunkbase_username"])
+    if vars_scope["splunkbase_token"]:
+        return
+    resp = requests.post(SPLUNKBASE_LOGIN_URL,
+                         data={"username": vars_scope["splunkbase_username"], "password": vars_scope["splunkbase_password"]})
+    if resp.status_code != 200:
+        raise Exception("Invalid Splunkbase credentials - will not download apps from Splunkbase")
+    output = resp.content
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "ignore")
+    splunkbase_token = re.search("<id>(.*)</id>", output, re.IGNORECASE)
+    vars_scope["splunkbase_token"] = splunkbase_token.group(1) if splunkbase_token else None
+    if vars_scope["splunkbase_token"]:
+        ttl = int(env.get("SPLUNKBASE_TOKEN_TTL", vars_scope.get("splunkbase_token_ttl") or SPLUNKBASE_TOKEN_TTL))
+        saveSplunkbaseToken(cache_file, vars_scope["splunkbase_username"], vars_scope["splunkbase_token"], ttl)
+
+def loadSplunkbaseToken(cache_file, username):
+    """
+    Return the cached Splunkbase session token of the given account, unless it has expired
+    """
+    if not cache_file:
+        return None
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if cached.get("username") != username:
+        return None
+    if not cached.get("expires") or cached["expires"] <= time():
+        return None
+    return cached.get("token")
+
+def saveSplunkbaseToken(cache_file, username, token, ttl):
+    """
+    Cache a Splunkbase session token along with the account it belongs to and its expiry. Nothing derived
+    from the password is kept, it could be recovered from the file.
+    """
+    if not cache_file or ttl <= 0:
+        return
+    cached = {"username": username, "token": token, "expires": time() + ttl}
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        writeJSONAtomic(cache_file, cached)
+    except (IOError, OSError):
+        pass
 
 def getSplunkBuildAuth(vars_scope):
     """
     Load username and password to be used in basic auth when fetching splunk build or apps
     """
-    vars_scope["splunk"]["artifact_auth_user"] = os.environ.get("ARTIFACTORY_USER", vars_scope["splunk"].get("artifact_auth_user"))
-    vars_scope["splunk"]["artifact_auth_pass"] = os.environ.get("ARTIFACTORY_TOKEN", vars_scope["splunk"].get("artifact_auth_pass"))
+    applyEnvOverrides(vars_scope, "build_auth")
 
 def getSplunkApps(vars_scope):
     """
     Determine the set of Splunk apps to install as union of defaults.yml and environment variables
     """
+    env = getEnv()
     appList = []
     if not "apps_location" in vars_scope["splunk"]:
         vars_scope["splunk"]["apps_location"] = []
@@ -378,7 +673,7 @@ def getSplunkApps(vars_scope):
     elif type(vars_scope["splunk"]["apps_location"]) == list:
         appList = vars_scope["splunk"]["apps_location"]
     # From environment variables
-    apps = os.environ.get("SPLUNK_APPS_URL")
+    apps = env.get("SPLUNK_APPS_URL")
     if apps:
         apps = apps.split(",")
         for app in apps:
@@ -390,6 +685,7 @@ def getSplunkAppsLocal(vars_scope):
     """
     Determine the set of Splunk apps to install locally only as union of defaults.yml and environment variables
     """
+    env = getEnv()
     # Check if theres a local apps list for CM/Deployer roles
     appListLocal = []
     if not "apps_location_local" in vars_scope["splunk"]:
@@ -400,7 +696,7 @@ def getSplunkAppsLocal(vars_scope):
     elif type(vars_scope["splunk"]["apps_location_local"]) == list:
         appListLocal = vars_scope["splunk"]["apps_location_local"]
     # From environment variables
-    apps = os.environ.get("SPLUNK_APPS_URL_LOCAL")
+    apps = env.get("SPLUNK_APPS_URL_LOCAL")
     if apps:
         apps = apps.split(",")
         for app in apps:
@@ -435,7 +731,8 @@ def getSecrets(vars_scope):
     """
     Parse sensitive passphrases
     """
-    vars_scope["splunk"]["password"] = os.environ.get("SPLUNK_PASSWORD", vars_scope["splunk"].get("password"))
+    env = getEnv()
+    vars_scope["splunk"]["password"] = env.get("SPLUNK_PASSWORD", vars_scope["splunk"].get("password"))
     if not vars_scope["splunk"]["password"]:
         raise Exception("Splunk password must be supplied!")
     if os.path.isfile(vars_scope["splunk"]["password"]):
@@ -443,18 +740,18 @@ def getSecrets(vars_scope):
             vars_scope["splunk"]["password"] = f.read().strip()
             if not vars_scope["splunk"]["password"]:
                 raise Exception("Splunk password supplied is empty/null")
-    dpw = os.environ.get("SPLUNK_DECLARATIVE_ADMIN_PASSWORD", "")
+    dpw = env.get("SPLUNK_DECLARATIVE_ADMIN_PASSWORD", "")
     if dpw.lower() == "true":
         vars_scope["splunk"]["declarative_admin_password"] = True
     else:
         vars_scope["splunk"]["declarative_admin_password"] = bool(vars_scope["splunk"].get("declarative_admin_password"))
-    vars_scope["splunk"]["pass4SymmKey"] = os.environ.get('SPLUNK_PASS4SYMMKEY', vars_scope["splunk"].get("pass4SymmKey"))
-    vars_scope["splunk"]["secret"] = os.environ.get('SPLUNK_SECRET', vars_scope["splunk"].get("secret"))
+    applyEnvOverrides(vars_scope, "secrets")
 
 def getLaunchConf(vars_scope):
     """
     Parse key/value pairs to set in splunk-launch.conf
     """
+    env = getEnv()
     launch = {}
     if not "launch" in vars_scope["splunk"]:
         vars_scope["splunk"]["launch"] = {}
@@ -462,7 +759,7 @@ def getLaunchConf(vars_scope):
     if type(vars_scope["splunk"]["launch"]) == dict:
         launch.update(vars_scope["splunk"]["launch"])
     # From environment variables
-    settings = os.environ.get("SPLUNK_LAUNCH_CONF")
+    settings = env.get("SPLUNK_LAUNCH_CONF")
     if settings:
         launch.update({k:v for k,v in [x.split("=", 1) for x in settings.split(",")]})
     vars_scope["splunk"]["launch"] = launch
@@ -481,8 +778,9 @@ def splitAndStrip(value, separator):
     return [x.strip() for x in value.split(separator)]
 
 def transformEnvironmentVariable(environmentVariableName, transform, default):
-    if environmentVariableName in os.environ:
-        return transform(os.environ.get(environmentVariableName))
+    env = getEnv()
+    if environmentVariableName in env:
+        return transform(env.get(environmentVariableName))
     else:
         return default
 
@@ -490,19 +788,20 @@ def getAnsibleContext(vars_scope):
     """
     Parse parameters that influence Ansible execution
     """
+    env = getEnv()
     stringSeparator = ","
     vars_scope["ansible_pre_tasks"] = transformEnvironmentVariable("SPLUNK_ANSIBLE_PRE_TASKS", lambda v: splitAndStrip(v, stringSeparator), ensureListValue(vars_scope.get("ansible_pre_tasks"), stringSeparator))
     vars_scope["ansible_post_tasks"] = transformEnvironmentVariable("SPLUNK_ANSIBLE_POST_TASKS", lambda v: splitAndStrip(v, stringSeparator), ensureListValue(vars_scope.get("ansible_post_tasks"), stringSeparator))
     vars_scope["ansible_environment"] = vars_scope.get("ansible_environment") or {}
-    env = os.environ.get("SPLUNK_ANSIBLE_ENV")
-    if env:
-        vars_scope["ansible_environment"].update({k:v for k,v in [x.split("=", 1) for x in env.split(",")]})
+    ansible_env = env.get("SPLUNK_ANSIBLE_ENV")
+    if ansible_env:
+        vars_scope["ansible_environment"].update({k:v for k,v in [x.split("=", 1) for x in ansible_env.split(",")]})
 
 def getASan(vars_scope):
     """
     Enable ASan debug builds
     """
-    vars_scope["splunk"]["asan"] = bool(os.environ.get("SPLUNK_ENABLE_ASAN", vars_scope["splunk"].get("asan")))
+    applyEnvOverrides(vars_scope, "asan")
     if vars_scope["splunk"]["asan"]:
         vars_scope["ansible_environment"].update({"ASAN_OPTIONS": "detect_leaks=0"})
 
@@ -510,8 +809,9 @@ def getDisablePopups(vars_scope):
     """
     Configure pop-up settings
     """
+    env = getEnv()
     vars_scope["splunk"]["disable_popups"] = bool(vars_scope["splunk"].get("disable_popups"))
-    popups_disabled = os.environ.get("SPLUNK_DISABLE_POPUPS", "")
+    popups_disabled = env.get("SPLUNK_DISABLE_POPUPS", "")
     if popups_disabled.lower() == "true":
         vars_scope["splunk"]["disable_popups"] = True
     elif popups_disabled.lower() == "false":
@@ -521,11 +821,9 @@ def getHEC(vars_scope):
     """
     Configure HEC settings
     """
-    if not "hec" in vars_scope["splunk"]:
-        vars_scope["splunk"]["hec"] = {}
-    vars_scope["splunk"]["hec"]["token"] = os.environ.get("SPLUNK_HEC_TOKEN", vars_scope["splunk"]["hec"].get("token"))
-    vars_scope["splunk"]["hec"]["port"] = int(os.environ.get("SPLUNK_HEC_PORT", vars_scope["splunk"]["hec"].get("port")))
-    ssl = os.environ.get("SPLUNK_HEC_SSL", "")
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "hec")
+    ssl = env.get("SPLUNK_HEC_SSL", "")
     if ssl.lower() == "false":
         vars_scope["splunk"]["hec"]["ssl"] = False
     else:
@@ -535,27 +833,23 @@ def getDSP(vars_scope):
     """
     Configure DSP settings
     """
-    if not "dsp" in vars_scope["splunk"]:
-        vars_scope["splunk"]["dsp"] = {}
-    vars_scope["splunk"]["dsp"]["server"] = os.environ.get("SPLUNK_DSP_SERVER", vars_scope["splunk"]["dsp"].get("server"))
-    vars_scope["splunk"]["dsp"]["cert"] = os.environ.get("SPLUNK_DSP_CERT", vars_scope["splunk"]["dsp"].get("cert"))
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "dsp")
     vars_scope["splunk"]["dsp"]["verify"] = bool(vars_scope["splunk"]["dsp"].get("verify"))
-    verify = os.environ.get("SPLUNK_DSP_VERIFY", "")
+    verify = env.get("SPLUNK_DSP_VERIFY", "")
     if verify.lower() == "true":
         vars_scope["splunk"]["dsp"]["verify"] = True
     vars_scope["splunk"]["dsp"]["enable"] = bool(vars_scope["splunk"]["dsp"].get("enable"))
-    enable = os.environ.get("SPLUNK_DSP_ENABLE", "")
+    enable = env.get("SPLUNK_DSP_ENABLE", "")
     if enable.lower() == "true":
         vars_scope["splunk"]["dsp"]["enable"] = True
-    vars_scope["splunk"]["dsp"]["pipeline_name"] = os.environ.get("SPLUNK_DSP_PIPELINE_NAME", vars_scope["splunk"]["dsp"].get("pipeline_name"))
-    vars_scope["splunk"]["dsp"]["pipeline_desc"] = os.environ.get("SPLUNK_DSP_PIPELINE_DESC", vars_scope["splunk"]["dsp"].get("pipeline_desc"))
-    vars_scope["splunk"]["dsp"]["pipeline_spec"] = os.environ.get("SPLUNK_DSP_PIPELINE_SPEC", vars_scope["splunk"]["dsp"].get("pipeline_spec"))
 
 def getESSplunkVariables(vars_scope):
     """
     Get any special Enterprise Security configuration variables
     """
-    ssl_enablement_env = os.environ.get("SPLUNK_ES_SSL_ENABLEMENT")
+    env = getEnv()
+    ssl_enablement_env = env.get("SPLUNK_ES_SSL_ENABLEMENT")
     if not ssl_enablement_env and (not "es" in vars_scope["splunk"] or not "ssl_enablement" in vars_scope["splunk"]["es"]):
         # This feature is only for specific versions of ES.
         # if it is missing, don't pass any value in.
@@ -569,62 +863,46 @@ def getESSplunkVariables(vars_scope):
         vars_scope["es_ssl_enablement"] = "--ssl_enablement {0}".format(ssl_enablement)
 
 def overrideEnvironmentVars(vars_scope):
-    vars_scope["splunk"]["user"] = os.environ.get("SPLUNK_USER", vars_scope["splunk"]["user"])
-    vars_scope["splunk"]["group"] = os.environ.get("SPLUNK_GROUP", vars_scope["splunk"]["group"])
-    vars_scope["cert_prefix"] = os.environ.get("SPLUNK_CERT_PREFIX", vars_scope.get("cert_prefix", "https"))
-    vars_scope["splunk"]["root_endpoint"] = os.environ.get('SPLUNK_ROOT_ENDPOINT', vars_scope["splunk"]["root_endpoint"])
-    vars_scope["splunk"]["svc_port"] = os.environ.get('SPLUNK_SVC_PORT', vars_scope["splunk"]["svc_port"])
-    vars_scope["splunk"]["splunk_http_enabled"] = os.environ.get('ENABLE_TCP_MODE', vars_scope["splunk"]["enable_tcp_mode"])
-    vars_scope["splunk"]["s2s"]["port"] = int(os.environ.get('SPLUNK_S2S_PORT', vars_scope["splunk"]["s2s"]["port"]))
-    vars_scope["splunk"]["enable_service"] = os.environ.get('SPLUNK_ENABLE_SERVICE', vars_scope["splunk"]["enable_service"])
-    vars_scope["splunk"]["service_name"] = os.environ.get('SPLUNK_SERVICE_NAME', vars_scope["splunk"]["service_name"])
-    vars_scope["splunk"]["allow_upgrade"] = os.environ.get('SPLUNK_ALLOW_UPGRADE', vars_scope["splunk"]["allow_upgrade"])
-    vars_scope["splunk"]["appserver"]["port"] = os.environ.get('SPLUNK_APPSERVER_PORT', vars_scope["splunk"]["appserver"]["port"])
-    vars_scope["splunk"]["kvstore"]["port"] = os.environ.get('SPLUNK_KVSTORE_PORT', vars_scope["splunk"]["kvstore"]["port"])
-    vars_scope["splunk"]["connection_timeout"] = int(os.environ.get('SPLUNK_CONNECTION_TIMEOUT', vars_scope["splunk"]["connection_timeout"]))
+    env = getEnv()
+    applyEnvOverrides(vars_scope, "general")
+    vars_scope["splunk"]["splunk_http_enabled"] = env.get('ENABLE_TCP_MODE', vars_scope["splunk"]["enable_tcp_mode"])
 
     if vars_scope["splunk"]["splunk_http_enabled"] == "false" and "forwarder" not in vars_scope["splunk"]["role"].lower():
         vars_scope["splunk"]["splunk_http_enabled"] = "true"
     # Set set_search_peers to False to disable peering to indexers when creating multisite topology
-    if os.environ.get("SPLUNK_SET_SEARCH_PEERS", "").lower() == "false":
+    if env.get("SPLUNK_SET_SEARCH_PEERS", "").lower() == "false":
         vars_scope["splunk"]["set_search_peers"] = False
 
 def getDFS(vars_scope):
     """
     Parse and set parameters to configure Data Fabric Search
     """
-    if "dfs" not in vars_scope["splunk"]:
-        vars_scope["splunk"]["dfs"] = {}
-    dfs_vars = vars_scope["splunk"]["dfs"]
-    dfs_vars["enable"] = bool(os.environ.get("SPLUNK_ENABLE_DFS", dfs_vars.get("enable")))
-    dfs_vars["dfw_num_slots"] = int(os.environ.get("SPLUNK_DFW_NUM_SLOTS", dfs_vars.get("dfw_num_slots", 10)))
-    dfs_vars["dfc_num_slots"] = int(os.environ.get("SPLUNK_DFC_NUM_SLOTS", dfs_vars.get("dfc_num_slots", 4)))
-    dfs_vars["dfw_num_slots_enabled"] = bool(os.environ.get('SPLUNK_DFW_NUM_SLOTS_ENABLED', dfs_vars.get("dfw_num_slots_enabled")))
-    dfs_vars["spark_master_host"] = os.environ.get("SPARK_MASTER_HOST", dfs_vars.get("spark_master_host", "127.0.0.1"))
-    dfs_vars["spark_master_webui_port"] = int(os.environ.get("SPARK_MASTER_WEBUI_PORT", dfs_vars.get("spark_master_webui_port", 8080)))
+    applyEnvOverrides(vars_scope, "dfs")
 
 def getUFSplunkVariables(vars_scope):
     """
     Set or override specific environment variables for universal forwarders
     """
-    if os.environ.get("SPLUNK_DEPLOYMENT_SERVER"):
-        vars_scope["splunk"]["deployment_server"] = os.environ.get("SPLUNK_DEPLOYMENT_SERVER")
-    if os.environ.get("SPLUNK_ADD"):
-        vars_scope["splunk"]["add"] = os.environ.get("SPLUNK_ADD").split(",")
-    if os.environ.get("SPLUNK_BEFORE_START_CMD"):
-        vars_scope["splunk"]["before_start_cmd"] = os.environ.get("SPLUNK_BEFORE_START_CMD").split(",")
-    if os.environ.get("SPLUNK_CMD"):
-        vars_scope["splunk"]["cmd"] = os.environ.get("SPLUNK_CMD").split(",")
-    if os.environ.get("SPLUNK_DEPLOYMENT_CLIENT_NAME"):
+    env = getEnv()
+    if env.get("SPLUNK_DEPLOYMENT_SERVER"):
+        vars_scope["splunk"]["deployment_server"] = env.get("SPLUNK_DEPLOYMENT_SERVER")
+    if env.get("SPLUNK_ADD"):
+        vars_scope["splunk"]["add"] = env.get("SPLUNK_ADD").split(",")
+    if env.get("SPLUNK_BEFORE_START_CMD"):
+        vars_scope["splunk"]["before_start_cmd"] = env.get("SPLUNK_BEFORE_START_CMD").split(",")
+    if env.get("SPLUNK_CMD"):
+        vars_scope["splunk"]["cmd"] = env.get("SPLUNK_CMD").split(",")
+    if env.get("SPLUNK_DEPLOYMENT_CLIENT_NAME"):
         vars_scope["splunk"]["deployment_client"] = {
-            "name": os.environ.get("SPLUNK_DEPLOYMENT_CLIENT_NAME")
+            "name": env.get("SPLUNK_DEPLOYMENT_CLIENT_NAME")
         }
 
 def getIPv6(vars_scope):
     """
     Set specific environment variables to apply IPv6 configurations
     """
-    vars_scope["splunk"]["listen_on_ipv6"] = os.environ.get("SPLUNK_LISTEN_ON_IPV6", False)
+    env = getEnv()
+    vars_scope["splunk"]["listen_on_ipv6"] = env.get("SPLUNK_LISTEN_ON_IPV6", False)
 
 
 def getRandomString():
@@ -661,22 +939,100 @@ def parseUrl(url, vars_scope):
         port = parsed[1]
     return "{}://{}:{}".format(scheme, hostname, port)
 
-def merge_dict(dict1, dict2, path=None):
+def merge_dict(dict1, dict2, strategies=None):
+    """
+    Merge two dictionaries such that all the keys in dict2 overwrite those in dict1.
+    Lists present in both are merged using the strategy found at their path in the
+    tree returned by getMergeStrategies(), and appended to by default
+    """
+    # Walk both trees with an explicit stack, carrying the matching strategy subtree instead of a path
+    stack = [(dict1, dict2, strategies)]
+    while stack:
+        target, source, node = stack.pop()
+        for key, value in source.items():
+            if key in target:
+                current = target[key]
+                if isinstance(current, dict) and isinstance(value, dict):
+                    child = node.get(key) if node else None
+                    stack.append((current, value, child if isinstance(child, dict) else None))
+                    continue
+                if isinstance(current, list) and isinstance(value, list):
+                    strategy = node.get(key) if node else None
+                    if strategy is None or isinstance(strategy, dict):
+                        current += value
+                    else:
+                        target[key] = mergeList(current, value, strategy)
+                    continue
+            target[key] = value
+    return dict1
+
+def mergeList(list1, list2, strategy=None):
+    """
+    Merge list2 into list1 using one of MERGE_STRATEGY_NAMES or "keyed:<field>"
+    """
+    if strategy == "replace":
+        return list2
+    if strategy == "append-unique":
+        for item in list2:
+            if item not in list1:
+                list1.append(item)
+    elif strategy and strategy.startswith("keyed:"):
+        # Merge dicts sharing the same value for field, e.g. smartstore indexes by indexName
+        field = strategy[len("keyed:"):]
+        keyed = {}
+        for item in list1:
+            if isinstance(item, dict) and field in item:
+                keyed.setdefault(item[field], item)
+        for item in list2:
+            existing = keyed.get(item.get(field)) if isinstance(item, dict) and field in item else None
+            if existing is None:
+                list1.append(item)
+                if isinstance(item, dict) and field in item:
+                    keyed[item[field]] = item
+            else:
+                merge_dict(existing, item)
+    else:
+        list1 += list2
+    return list1
+
+def getMergeStrategies(vars_scope):
     """
-    Merge two dictionaries such that all the keys in dict2 overwrite those in dict1
+    Compile MERGE_STRATEGIES along with any config.merge_strategies into a tree of dotted path segments
     """
-    if path is None: path = []
-    for key in dict2:
-        if key in dict1:
-            if isinstance(dict1[key], dict) and isinstance(dict2[key], dict):
-                merge_dict(dict1[key], dict2[key], path + [str(key)])
-            elif isinstance(dict1[key], list) and isinstance(dict2[key], list):
-                dict1[key] += dict2[key]
-            else:
-                dict1[key] = dict2[key]
-        else:
-            dict1[key] = dict2[key]
-    return dict1
+    strategies = dict(MERGE_STRATEGIES)
+    strategies.update((vars_scope.get("config") or {}).get("merge_strategies") or {})
+    tree = {}
+    for path, strategy in strategies.items():
+        if strategy not in MERGE_STRATEGY_NAMES and not (strategy or "").startswith("keyed:"):
+            raise Exception("Invalid merge strategy {} for {}, supported strategies are: {} or keyed:<field>".format(strategy, path, MERGE_STRATEGY_NAMES))
+        node = tree
+        keys = path.split(".")
+        for key in keys[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        node[keys[-1]] = strategy
+    return tree
+
+def normalizeSource(src):
+    """
+    Strip and lowercase a defaults source, removing any file:// scheme
+    """
+    src = src.strip().lower()
+    if src.startswith("file://"):
+        src = src[7:]
+    return src
+
+def getDefaultsRequestParams(vars_scope, key):
+    """
+    Return the headers and SSL verification used when fetching a remote defaults source
+    """
+    headers = None
+    verify = False
+    if vars_scope.get("config") and vars_scope["config"].get(key):
+        headers = vars_scope["config"][key].get("headers")
+        verify = bool(vars_scope["config"][key].get("verify"))
+    return headers, verify
 
 def mergeDefaults(vars_scope, key, src):
     """
@@ -684,15 +1040,9 @@ def mergeDefaults(vars_scope, key, src):
     """
     if not src or not src.strip():
         return vars_scope
-    src = src.strip().lower()
-    if src.startswith("file://"):
-        src = src[7:]
+    src = normalizeSource(src)
     if src.startswith(("http://", "https://")):
-        headers = None
-        verify = False
-        if vars_scope.get("config") and vars_scope["config"].get(key):
-            headers = vars_scope["config"][key].get("headers")
-            verify = bool(vars_scope["config"][key].get("verify"))
+        headers, verify = getDefaultsRequestParams(vars_scope, key)
         vars_scope = mergeDefaultsFromURL(vars_scope, src, headers, verify)
     else:
         vars_scope = mergeDefaultsFromFile(vars_scope, src)
@@ -704,34 +1054,176 @@ def mergeDefaultsFromURL(vars_scope, url, headers=None, verify=False):
     """
     if not url:
         return vars_scope
-    if not headers:
-        headers = {}
-    max_retries = int(os.environ.get("SPLUNK_DEFAULTS_HTTP_MAX_RETRIES", vars_scope["config"].get("max_retries")))
-    max_delay = int(os.environ.get("SPLUNK_DEFAULTS_HTTP_MAX_DELAY", vars_scope["config"].get("max_delay")))
-    max_timeout = int(os.environ.get("SPLUNK_DEFAULTS_HTTP_MAX_TIMEOUT", vars_scope["config"].get("max_timeout")))
-    auth = os.environ.get("SPLUNK_DEFAULTS_HTTP_AUTH_HEADER")
+    return merge_dict(vars_scope, fetchDefaultsFromURL(vars_scope, url, headers, verify), getMergeStrategies(vars_scope))
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter, bounded by a number of retries and an overall deadline
+    """
+    def __init__(self, max_retries, max_delay, max_elapsed, base_delay=RETRY_BASE_DELAY):
+        # max_retries of -1 retries until the deadline is reached
+        self.max_retries = max_retries
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.base_delay = base_delay
+        self.retries = 0
+        self.start = time()
+
+    @classmethod
+    def fromConfig(cls, config):
+        """
+        Build a policy from the "config" section of the defaults and SPLUNK_DEFAULTS_HTTP_* overrides
+        """
+        env = getEnv()
+        return cls(int(env.get("SPLUNK_DEFAULTS_HTTP_MAX_RETRIES", config.get("max_retries"))),
+                   int(env.get("SPLUNK_DEFAULTS_HTTP_MAX_DELAY", config.get("max_delay"))),
+                   int(env.get("SPLUNK_DEFAULTS_HTTP_MAX_TIMEOUT", config.get("max_timeout"))),
+                   float(config.get("base_delay") or RETRY_BASE_DELAY))
+
+    def elapsed(self):
+        return time() - self.start
+
+    def timeout(self):
+        """
+        Return the timeout of the next attempt, so that it cannot overrun the deadline
+        """
+        return min(self.max_elapsed, int(math.ceil(max(self.max_elapsed - self.elapsed(), 0))))
+
+    def nextDelay(self):
+        """
+        Return how long to sleep before the next attempt, or None once retries or time are exhausted
+        """
+        if self.max_retries != -1 and self.retries >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** self.retries)))
+        if self.elapsed() + delay >= self.max_elapsed:
+            return None
+        self.retries += 1
+        return delay
+
+def recordFetchStats(url, policy, result):
+    """
+    Keep retry counters and elapsed time of a remote defaults fetch for the inventory output
+    """
+    parsed = urlparse(url)
+    # Drop credentials and query strings which may carry secrets
+    location = "{}://{}{}".format(parsed.scheme, parsed.netloc.split("@", 1)[-1], parsed.path)
+    urlFetchStats[url] = {"url": location, "attempts": policy.retries + 1, "retries": policy.retries,
+                          "elapsed": round(policy.elapsed(), 3), "result": result}
+
+def fetchDefaultsFromURL(vars_scope, url, headers=None, verify=False):
+    """
+    Fetch and parse defaults from a URL, retrying according to the "config" section of vars_scope.
+    When a mirror directory is configured, the request is made conditional on the mirrored copy.
+    """
+    env = getEnv()
+    headers = dict(headers) if headers else {}
+    policy = RetryPolicy.fromConfig(vars_scope["config"])
+    auth = env.get("SPLUNK_DEFAULTS_HTTP_AUTH_HEADER")
     if auth:
         headers["Authorization"] = auth
-    unlimited_retries = (max_retries == -1)
-    current_retry = 0
+    mirror_dir = env.get("SPLUNK_DEFAULTS_HTTP_MIRROR_DIR", vars_scope["config"].get("mirror_dir"))
+    serve_stale = str(env.get("SPLUNK_DEFAULTS_HTTP_SERVE_STALE", vars_scope["config"].get("serve_stale"))).lower() == "true"
+    mirror = loadDefaultsMirror(mirror_dir, url)
+    if mirror:
+        if mirror.get("etag"):
+            headers["If-None-Match"] = mirror["etag"]
+        if mirror.get("last_modified"):
+            headers["If-Modified-Since"] = mirror["last_modified"]
     while True:
         try:
             resp = requests.get(url.format(hostname=HOSTNAME, platform=PLATFORM),
-                                headers=headers, timeout=max_timeout, verify=verify)
+                                headers=headers, timeout=policy.timeout(), verify=verify)
+            if resp.status_code == 304 and mirror:
+                urlValidators[url] = {"etag": resp.headers.get("ETag", mirror.get("etag")),
+                                      "last_modified": resp.headers.get("Last-Modified", mirror.get("last_modified"))}
+                recordFetchStats(url, policy, "not_modified")
+                return mirror["defaults"]
             resp.raise_for_status()
+            urlValidators[url] = {"etag": resp.headers.get("ETag"),
+                                  "last_modified": resp.headers.get("Last-Modified")}
             output = resp.content
             if isinstance(output, bytes):
                 output = output.decode("utf-8", "ignore")
-            vars_scope = merge_dict(vars_scope, yaml.load(output, Loader=yaml.Loader))
-            break
+            defaults = loadYAML(output)
+            saveDefaultsMirror(mirror_dir, url, urlValidators[url], defaults)
+            recordFetchStats(url, policy, "fetched")
+            return defaults
         except Exception as err:
-            if unlimited_retries or current_retry < max_retries:
-                current_retry += 1
-                print('URL request #{0} failed, sleeping {1} seconds and retrying'.format(current_retry, max_delay))
-                sleep(max_delay)
+            delay = policy.nextDelay()
+            if delay is not None:
+                print('URL request #{0} failed after {1:.1f} seconds, sleeping {2:.1f} seconds and retrying'.format(policy.retries, policy.elapsed(), delay), file=sys.stderr)
+                sleep(delay)
                 continue
+            if serve_stale and mirror:
+                print("URL request for {0} failed, using mirrored copy: {1}".format(url, err), file=sys.stderr)
+                recordFetchStats(url, policy, "stale")
+                return mirror["defaults"]
+            recordFetchStats(url, policy, "failed")
             raise err
-    return vars_scope
+
+def getDefaultsMirrorFile(mirror_dir, url):
+    """
+    Return the path of the mirrored copy of a remote defaults source
+    """
+    return os.path.join(mirror_dir, "{}.json".format(hashlib.sha256(url.encode("utf-8")).hexdigest()))
+
+def loadDefaultsMirror(mirror_dir, url):
+    """
+    Return the mirrored copy (validators and parsed content) of a remote defaults source, if any
+    """
+    if not mirror_dir:
+        return None
+    try:
+        with open(getDefaultsMirrorFile(mirror_dir, url), "r") as f:
+            mirror = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if mirror.get("url") != url or "defaults" not in mirror:
+        return None
+    return mirror
+
+def saveDefaultsMirror(mirror_dir, url, validators, defaults):
+    """
+    Keep a copy of a remote defaults source along with its ETag/Last-Modified validators
+    """
+    if not mirror_dir:
+        return
+    mirror = {"url": url, "etag": validators.get("etag"), "last_modified": validators.get("last_modified"), "defaults": defaults}
+    try:
+        if not os.path.isdir(mirror_dir):
+            os.makedirs(mirror_dir, 0o700)
+        writeJSONAtomic(getDefaultsMirrorFile(mirror_dir, url), mirror)
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+
+def fetchDefaultsConcurrently(vars_scope, ymls):
+    """
+    Fetch every remote source among ymls in parallel using a bounded thread pool.
+    Returns a mapping of normalized URL to parsed defaults; merging is left to the caller
+    so that sources are still applied in their declared order.
+    """
+    env = getEnv()
+    urls = []
+    for yml in ymls:
+        if not yml["src"] or not yml["src"].strip():
+            continue
+        src = normalizeSource(yml["src"])
+        if src.startswith(("http://", "https://")) and src not in [url for url, _ in urls]:
+            urls.append((src, yml["key"]))
+    if len(urls) < 2 or ThreadPoolExecutor is None:
+        return {}
+    max_workers = int(env.get("SPLUNK_DEFAULTS_HTTP_MAX_WORKERS", vars_scope["config"].get("max_workers", 4)))
+    if max_workers < 2:
+        return {}
+    # Request parameters are resolved up front from the scope as it stands before this group
+    futures = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        for url, key in urls:
+            headers, verify = getDefaultsRequestParams(vars_scope, key)
+            futures.append((url, pool.submit(fetchDefaultsFromURL, vars_scope, url, headers, verify)))
+    # Surface the first failure in declared order, as a sequential fetch would
+    return {url: future.result() for url, future in futures}
 
 def mergeDefaultsFromFile(vars_scope, file):
     """
@@ -741,7 +1233,7 @@ def mergeDefaultsFromFile(vars_scope, file):
         return vars_scope
     if os.path.exists(file):
         with open(file, "r") as f:
-            vars_scope = merge_dict(vars_scope, yaml.load(f.read(), Loader=yaml.Loader))
+            vars_scope = merge_dict(vars_scope, loadYAML(f.read()), getMergeStrategies(vars_scope))
     return vars_scope
 
 def loadDefaults():
@@ -749,33 +1241,229 @@ def loadDefaults():
     Generate a consolidated map containing variables used to drive Ansible functionality.
     Defaults are loaded in a particular order such that latter overrides former.
     """
+    env = getEnv()
+    cache_dir = env.get("SPLUNK_DEFAULTS_CACHE_DIR")
+    if cache_dir:
+        return loadCachedDefaults(cache_dir)
+    return buildDefaults()[0]
+
+def buildDefaults():
+    """
+    Load and merge every defaults source, returning the consolidated map along with
+    the list of sources that contributed to it
+    """
     # Load base defaults from splunk-ansible repository
     base = loadBaseDefaults()
+    sources = [{"key": "base", "src": getBaseDefaultsFile()}]
     if not base.get("config"):
-        return base
-    # Add "baked" files to array
-    for yml in loadBakedDefaults(base.get("config")):
-        base = mergeDefaults(base, yml["key"], yml["src"])
-    # Add "env" files to array
-    for yml in loadEnvDefaults(base.get("config")):
-        base = mergeDefaults(base, yml["key"], yml["src"])
-    # Add "host" files to array
-    for yml in loadHostDefaults(base.get("config")):
-        base = mergeDefaults(base, yml["key"], yml["src"])
-    return base
+        return base, sources
+    config = base.get("config")
+    if config.get("env") and config["env"].get("var"):
+        sources.append({"key": "env_var", "src": config["env"]["var"]})
+    # Add "baked", then "env", then "host" files to array
+    for loadGroup in (loadBakedDefaults, loadEnvDefaults, loadHostDefaults):
+        ymls = loadGroup(base.get("config"))
+        fetched = fetchDefaultsConcurrently(base, ymls)
+        for yml in ymls:
+            sources.append(yml)
+            src = normalizeSource(yml["src"]) if yml["src"] else yml["src"]
+            if src in fetched:
+                base = merge_dict(base, fetched[src], getMergeStrategies(base))
+            else:
+                base = mergeDefaults(base, yml["key"], yml["src"])
+    return base, sources
+
+def getBaseDefaultsFile():
+    """
+    Return the path to the base defaults shipped in splunk-ansible
+    """
+    env = getEnv()
+    filename = "splunk_defaults_{}.yml".format(PLATFORM)
+    if env.get("SPLUNK_ROLE") == "splunk_universal_forwarder":
+        filename = "splunkforwarder_defaults_{}.yml".format(PLATFORM)
+    return os.path.join(HERE, filename)
 
 def loadBaseDefaults():
     """
     Load the base defaults shipped in splunk-ansible
     """
     yml = {}
-    filename = "splunk_defaults_{}.yml".format(PLATFORM)
-    if os.environ.get("SPLUNK_ROLE") == "splunk_universal_forwarder":
-        filename = "splunkforwarder_defaults_{}.yml".format(PLATFORM)
-    with open(os.path.join(HERE, filename), "r") as yaml_file:
-        yml = yaml.load(yaml_file, Loader=yaml.Loader)
+    with open(getBaseDefaultsFile(), "r") as yaml_file:
+        yml = loadYAML(yaml_file)
     return yml
 
+def getDefaultsCacheKey():
+    """
+    Compute the content address of a defaults cache entry from everything that selects
+    which sources get loaded: the base defaults file, host/platform and SPLUNK_* environment
+    """
+    env = getEnv()
+    material = json.dumps({"version": DEFAULTS_CACHE_VERSION,
+                           "base": getBaseDefaultsFile(),
+                           "hostname": HOSTNAME,
+                           "platform": PLATFORM,
+                           "env": {k: env[k] for k in env if reDefaultsCacheEnv.match(k)}}, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def hashFile(path):
+    """
+    Return the sha256 hex digest of a file's content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def describeDefaultsSource(source):
+    """
+    Record the state of a defaults source so a cache entry can later be validated against it.
+    Returns None if the source cannot be validated and must not be cached.
+    """
+    if source["key"] == "env_var":
+        return {"type": "env", "name": source["src"], "value": os.environ.get(source["src"])}
+    if not source["src"] or not source["src"].strip():
+        return {"type": "empty"}
+    src = normalizeSource(source["src"])
+    if src.startswith(("http://", "https://")):
+        validators = urlValidators.get(src)
+        if not validators or not (validators.get("etag") or validators.get("last_modified")):
+            return None
+        return {"type": "url", "key": source["key"], "url": src,
+                "etag": validators.get("etag"), "last_modified": validators.get("last_modified")}
+    if not os.path.exists(src):
+        return {"type": "file", "path": src, "exists": False}
+    stat = os.stat(src)
+    return {"type": "file", "path": src, "exists": True, "mtime": stat.st_mtime,
+            "size": stat.st_size, "sha256": hashFile(src)}
+
+def isDefaultsSourceValid(source, defaults):
+    """
+    Check whether a recorded defaults source is unchanged since the cache entry was written
+    """
+    env = getEnv()
+    if source["type"] == "empty":
+        return True
+    if source["type"] == "env":
+        return os.environ.get(source["name"]) == source["value"]
+    if source["type"] == "file":
+        if not os.path.exists(source["path"]):
+            return not source["exists"]
+        if not source["exists"]:
+            return False
+        stat = os.stat(source["path"])
+        if stat.st_mtime == source["mtime"] and stat.st_size == source["size"]:
+            return True
+        # Files re-copied on container start keep their content but not their mtime
+        return stat.st_size == source["size"] and hashFile(source["path"]) == source["sha256"]
+    if source["type"] == "url":
+        headers, verify = getDefaultsRequestParams(defaults, source["key"])
+        headers = dict(headers or {})
+        auth = env.get("SPLUNK_DEFAULTS_HTTP_AUTH_HEADER")
+        if auth:
+            headers["Authorization"] = auth
+        timeout = int(env.get("SPLUNK_DEFAULTS_HTTP_MAX_TIMEOUT", defaults["config"].get("max_timeout")))
+        try:
+            resp = requests.head(source["url"].format(hostname=HOSTNAME, platform=PLATFORM),
+                                 headers=headers, timeout=timeout, verify=verify)
+            resp.raise_for_status()
+        except Exception:
+            return False
+        return resp.headers.get("ETag") == source["etag"] and \
+               resp.headers.get("Last-Modified") == source["last_modified"]
+    return False
+
+def writeJSONAtomic(path, content):
+    """
+    Atomically replace a file with JSON content readable only by the current user
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(content, f)
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def readDefaultsCacheStats(cache_dir):
+    """
+    Return the hit/miss counters recorded in the defaults cache directory
+    """
+    stats = {"hits": 0, "misses": 0, "last_result": None, "last_reason": None}
+    try:
+        with open(os.path.join(cache_dir, "stats.json"), "r") as f:
+            stats.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+    return stats
+
+def recordDefaultsCacheResult(cache_dir, hit, reason):
+    """
+    Update the hit/miss counters recorded in the defaults cache directory
+    """
+    stats = readDefaultsCacheStats(cache_dir)
+    stats["hits" if hit else "misses"] += 1
+    stats["last_result"] = "hit" if hit else "miss"
+    stats["last_reason"] = reason
+    try:
+        writeJSONAtomic(os.path.join(cache_dir, "stats.json"), stats)
+    except (IOError, OSError):
+        pass
+
+def invalidateDefaultsCache(cache_dir):
+    """
+    Remove every defaults cache entry, preserving the hit/miss counters
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.listdir(cache_dir):
+        if entry.startswith("defaults-") and entry.endswith(".json"):
+            os.remove(os.path.join(cache_dir, entry))
+
+def loadCachedDefaults(cache_dir):
+    """
+    Return the consolidated defaults from the on-disk cache when none of their sources changed,
+    otherwise rebuild them and refresh the cache entry
+    """
+    env = getEnv()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    entry_file = os.path.join(cache_dir, "defaults-{}.json".format(getDefaultsCacheKey()))
+    reason = "missing"
+    if env.get("SPLUNK_DEFAULTS_CACHE_INVALIDATE", "").lower() == "true":
+        reason = "invalidated"
+        invalidateDefaultsCache(cache_dir)
+    elif os.path.isfile(entry_file):
+        try:
+            with open(entry_file, "r") as f:
+                entry = json.load(f)
+            if entry.get("version") != DEFAULTS_CACHE_VERSION:
+                reason = "version"
+            elif all(isDefaultsSourceValid(source, entry["defaults"]) for source in entry["sources"]):
+                recordDefaultsCacheResult(cache_dir, True, "valid")
+                return entry["defaults"]
+            else:
+                reason = "stale"
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            reason = "corrupt"
+    recordDefaultsCacheResult(cache_dir, False, reason)
+    defaults, sources = buildDefaults()
+    described = [describeDefaultsSource(source) for source in sources]
+    if None in described:
+        # At least one remote source offers no validators - never serve it from cache
+        if os.path.isfile(entry_file):
+            os.remove(entry_file)
+        return defaults
+    try:
+        # Serialize before the caller mutates the consolidated map
+        writeJSONAtomic(entry_file, {"version": DEFAULTS_CACHE_VERSION, "sources": described, "defaults": defaults})
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+    return defaults
+
 def loadBakedDefaults(config):
     """
     Load the defaults in "baked" key of the configuration.
@@ -843,6 +1531,8 @@ def create_parser():
     parser.add_argument('--host', action='store', help='Only get information for a specific host.')
     parser.add_argument('--write-to-file', action='store_true', default=False, help='Write to file for debugging')
     parser.add_argument('--write-to-stdout', action='store_true', default=False, help='create a default.yml file shown on stdout from current vars')
+    parser.add_argument('--invalidate-defaults-cache', action='store_true', default=False, help='Drop cached defaults in SPLUNK_DEFAULTS_CACHE_DIR before loading')
+    parser.add_argument('--defaults-cache-stats', action='store_true', default=False, help='Show hits/misses of the defaults cache in SPLUNK_DEFAULTS_CACHE_DIR')
     return parser
 
 def prep_for_yaml_out(inventory):
@@ -853,6 +1543,7 @@ def prep_for_yaml_out(inventory):
 
     keys_to_del = ["ansible_ssh_user",
                    "apps_location",
+                   "defaults_http_stats",
                    "build_location",
                    "hostname",
                    "role",
@@ -875,13 +1566,46 @@ def prep_for_yaml_out(inventory):
         del inventory_to_dump["splunk"]["shc"]
     return inventory_to_dump
 
+def dumpJSON(content):
+    """
+    Serialize content to a JSON string, using orjson when it is available
+    """
+    if orjson:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            # Types orjson does not handle the same way, let json have the final word
+            pass
+    return json.dumps(content)
+
+def dumpInventory(inventory, compact=False):
+    """
+    Serialize the inventory for Ansible. In compact mode, hostvars that are the very same object as
+    all.vars are emitted empty since the host already inherits them from the "all" group
+    """
+    if not compact or not inventory.get("_meta", {}).get("hostvars"):
+        return dumpJSON(inventory)
+    all_vars = inventory.get("all", {}).get("vars")
+    compacted = dict(inventory)
+    compacted["_meta"] = dict(inventory["_meta"])
+    compacted["_meta"]["hostvars"] = {host: {} if host_vars is all_vars else host_vars
+                                      for host, host_vars in inventory["_meta"]["hostvars"].items()}
+    return dumpJSON(compacted)
+
 def main():
     """
     Primary entrypoint to dynamic inventory script
     """
+    env = getEnv()
     parser = create_parser()
     args = parser.parse_args()
 
+    cache_dir = env.get("SPLUNK_DEFAULTS_CACHE_DIR")
+    if args.defaults_cache_stats:
+        print(json.dumps(readDefaultsCacheStats(cache_dir) if cache_dir else {}))
+        return
+    if args.invalidate_defaults_cache and cache_dir:
+        invalidateDefaultsCache(cache_dir)
     getSplunkInventory(inventory)
     if args.write_to_file:
         with open(os.path.join("/opt/container_artifact", "ansible_inventory.json"), "w") as outfile:
@@ -892,7 +1616,7 @@ def main():
         print("---")
         print(yaml.dump(inventory_to_dump, default_flow_style=False))
     else:
-        print(json.dumps(inventory))
+        print(dumpInventory(inventory, env.get("SPLUNK_INVENTORY_COMPACT", "").lower() == "true"))
 
 
 if __name__ == "__main__":
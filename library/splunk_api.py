@@ -2,26 +2,540 @@
 
 from ansible.module_utils.basic import AnsibleModule
 import os
+import base64
+import errno
+import fcntl
+import hashlib
+import socket
+import ssl
+import stat
+import struct
+import tempfile
+import threading
+import time
 import requests
 import requests_unixsocket
+import requests_unixsocket.adapters
+import urllib3.connection
 import json
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    from urllib.parse import urlparse, quote, unquote, urlencode, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from urllib import quote, unquote, urlencode
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
 
 UDS_SOCKET_PATH = "/opt/splunkforwarder/var/run/splunk/cli.socket"
-UDS_SOCKET_PATH_URL = "%2Fopt%2Fsplunkforwarder%2Fvar%2Frun%2Fsplunk%2Fcli.socket"
+# Location of the UDS socket relative to SPLUNK_HOME, when splunkd is configured to listen on it
+UDS_SOCKET_RELATIVE_PATH = os.path.join("var", "run", "splunk", "cli.socket")
 
-def supports_uds():
-    return os.path.exists(UDS_SOCKET_PATH)
+# Private directory holding the broker socket and the session key cache of the current user
+STATE_DIR = os.path.join(tempfile.gettempdir(), "splunk_api-{}".format(os.getuid()))
+# Keep-alive broker shared by the splunk_api tasks of a run, see broker_request()
+BROKER_SOCKET_PATH = os.path.join(STATE_DIR, "broker.sock")
+# Seconds without any request after which the broker exits
+BROKER_IDLE_TIMEOUT = 300
+# Seconds to wait for a freshly spawned broker to accept connections
+BROKER_START_TIMEOUT = 5
+# splunkd session keys obtained from /services/auth/login, see session_request()
+SESSION_CACHE_PATH = os.path.join(STATE_DIR, "sessions.json")
+# Seconds a cached session key is reused for, below the default splunkd sessionTimeout of 1h
+SESSION_KEY_TTL = 3000
+# Keys of an item of the requests list, the module parameters of the same name are their defaults
+BATCH_REQUEST_KEYS = ("name", "method", "url", "body", "body_format", "headers", "status_code", "timeout", "ensure", "host")
+# Checks the value found at the path of a wait condition can be submitted to, see check_condition()
+WAIT_CONDITIONS = ("equals", "not_equals", "length", "contains", "not_contains")
+# Polling schedule of a wait condition, in seconds, unless overridden
+WAIT_DEFAULTS = {"interval": 1.0, "backoff": 1.0, "max_interval": 30.0, "timeout": 300.0}
+# JSON lines file the metrics of every call are appended to when enabled, along with the Ansible log
+METRICS_FILE_PATH = "/opt/container_artifact/splunk_api_metrics.json"
+# Consecutive failures and open circuits of the splunkd targets called, shared by the tasks of a run, see circuit_call()
+CIRCUIT_STATE_PATH = os.path.join(STATE_DIR, "circuits.json")
+# Circuit breaker of a target unless overridden: failures opening it, then seconds before a single probe is let
+# through, doubled on every failed probe, and seconds a probe may take before another one is allowed
+CIRCUIT_DEFAULTS = {"threshold": 3, "cooldown": 10.0, "max_cooldown": 300.0, "probe_timeout": 60.0}
+# Requests written ahead of their responses on a pipelined connection, see pipeline_calls()
+PIPELINE_DEPTH = 16
+# Spellings splunkd and the roles use for booleans, which compare equal in the settings of an entity
+BOOLEAN_STRINGS = {"true": True, "t": True, "yes": True, "y": True, "1": True,
+                   "false": False, "f": False, "no": False, "n": False, "0": False}
 
-def api_call_tcp(cert_prefix, method, endpoint, username, password, svc_port, payload=None, headers=None, verify=False, status_code=None, timeout=None, body_format=None):
-    if not cert_prefix or cert_prefix not in ['http', 'https']:
-      cert_prefix = 'https'
-    if not svc_port:
-      svc_port = 8089
-    url = "{}://127.0.0.1:{}{}".format(cert_prefix, svc_port, endpoint)
+# Time spent opening connections by the request the current thread is sending, see timed_request()
+connection_timings = threading.local()
+# Metrics of the call the current thread is making, see api_call()
+call_metrics = threading.local()
+
+def timed(method, key):
+    """
+    Add the time spent in a connection method to the timings of the current request, if any
+    """
+    def wrapper(self, *args, **kwargs):
+        timings = getattr(connection_timings, "current", None)
+        if timings is None:
+            return method(self, *args, **kwargs)
+        start, connect_ms = time.time(), timings["connect_ms"]
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            if key == "tls_ms":
+                # The TLS handshake follows the TCP connection, which is timed on its own
+                elapsed_ms -= timings["connect_ms"] - connect_ms
+            else:
+                timings["connections"] += 1
+            timings[key] += elapsed_ms
+    wrapper.timed = True
+    return wrapper
+
+def instrument_connections():
+    """
+    Time the TCP and UDS connections and the TLS handshakes of urllib3, which requests does not report
+    """
+    for cls, name, key in ((urllib3.connection.HTTPConnection, "_new_conn", "connect_ms"),
+                           (urllib3.connection.HTTPSConnection, "connect", "tls_ms"),
+                           (requests_unixsocket.adapters.UnixHTTPConnection, "connect", "connect_ms")):
+        method = cls.__dict__.get(name)
+        if method is not None and not getattr(method, "timed", False):
+            setattr(cls, name, timed(method, key))
+
+instrument_connections()
+
+def timed_request(session, method, url, stream=False, **kwargs):
+    """
+    Send the request on the session and return the response along with its timings: time spent connecting,
+    in TLS handshakes and then waiting for the response headers, and body bytes sent and received
+    """
+    timings = {"connections": 0, "connect_ms": 0.0, "tls_ms": 0.0}
+    connection_timings.current = timings
+    try:
+        response = session.request(method, url, stream=stream, **kwargs)
+    finally:
+        connection_timings.current = None
+    timings["ttfb_ms"] = max(0.0, response.elapsed.total_seconds() * 1000 - timings["connect_ms"] - timings["tls_ms"])
+    body = response.request.body or b""
+    timings["bytes_out"] = len(body if isinstance(body, bytes) else body.encode("utf-8"))
+    # The body of a streamed response is only read later on
+    timings["bytes_in"] = 0 if stream else len(response.content)
+    return response, timings
+
+def new_metrics(transport=None):
+    return {"transport": transport, "brokered": False, "requests": 0, "retries": 0, "logins": 0, "refused": 0, "connections": 0,
+            "connect_ms": 0.0, "tls_ms": 0.0, "ttfb_ms": 0.0, "total_ms": 0.0, "bytes_out": 0, "bytes_in": 0}
+
+def record_metrics(timings=None, **counts):
+    """
+    Add the timings of a request, or other counts, to the metrics of the call the current thread is making
+    """
+    metrics = getattr(call_metrics, "current", None)
+    if metrics is None:
+        return
+    if timings is not None:
+        metrics["requests"] += 1
+        for key in ("connections", "connect_ms", "tls_ms", "ttfb_ms", "bytes_out", "bytes_in"):
+            metrics[key] += timings.get(key, 0)
+    for key, count in counts.items():
+        metrics[key] += count
+
+def write_metrics(path, records):
+    """
+    Append a JSON line per record to the metrics file, without ever failing the call
+    """
+    try:
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("".join(json.dumps(record, sort_keys=True) + "\n" for record in records))
+    except (IOError, OSError):
+        pass
+
+def supports_uds(socket_path=UDS_SOCKET_PATH):
+    try:
+        return stat.S_ISSOCK(os.stat(socket_path).st_mode)
+    except OSError:
+        return False
+
+def get_uds_socket(uds=None, socket_path=None, splunk_home=None):
+    """
+    Return the path of the UDS socket calls are sent to, or None when they go over TCP. The socket is the
+    given one, else the one under splunk_home or $SPLUNK_HOME, else UDS_SOCKET_PATH. It is used whenever
+    it exists unless uds forces the choice either way.
+    """
+    if uds is False:
+        return None
+    if not socket_path:
+        splunk_home = splunk_home or os.environ.get("SPLUNK_HOME")
+        socket_path = os.path.join(splunk_home, UDS_SOCKET_RELATIVE_PATH) if splunk_home else UDS_SOCKET_PATH
+    if uds or supports_uds(socket_path):
+        return socket_path
+    return None
+
+def send_message(sock, message):
+    payload = json.dumps(message).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(payload)) + payload)
+
+def recv_exact(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            if chunks:
+                raise IOError("Broker connection closed mid-message")
+            return None
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+def recv_message(sock):
+    header = recv_exact(sock, 4)
+    if header is None:
+        return None
+    length = struct.unpack("!I", header)[0]
+    return json.loads(recv_exact(sock, length).decode("utf-8"))
+
+class BrokerResponse(object):
+    """
+    Stand-in for the requests.Response relayed by the broker or an in-process SessionPool
+    """
+    def __init__(self, reply, brokered=True):
+        self.status_code = reply["status_code"]
+        self.headers = reply["headers"]
+        self.text = reply["text"]
+        self.elapsed_ms = reply["elapsed_ms"]
+        self.timings = reply.get("timings", {})
+        self.brokered = brokered
+
+    def json(self):
+        return json.loads(self.text)
+
+class SessionPool(object):
+    """
+    Keep-alive sessions per target (scheme and host:port or socket) along with their latency stats
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = {}
+
+    def acquire(self, target):
+        with self.lock:
+            if self.idle.get(target):
+                return self.idle[target].pop()
+        session = requests_unixsocket.Session()
+        # Disable SSL verification for the session
+        session.verify = False
+        return session
+
+    def release(self, target, session):
+        with self.lock:
+            self.idle.setdefault(target, []).append(session)
+
+    def record(self, target, elapsed_ms, failed):
+        with self.lock:
+            stats = self.stats.setdefault(target, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += int(failed)
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    def relay(self, message):
+        target = "{0.scheme}://{0.netloc}".format(urlparse(message["url"]))
+        session = self.acquire(target)
+        start = time.time()
+        try:
+            response, timings = timed_request(session, message["method"], message["url"], headers=message.get("headers"),
+                                              auth=tuple(message["auth"]) if message.get("auth") else None,
+                                              data=message.get("data"), verify=message.get("verify", False),
+                                              timeout=message.get("timeout"))
+            reply = {"status_code": response.status_code, "headers": dict(response.headers), "text": response.text, "timings": timings}
+            # A session that failed may hold a broken connection, only pool the healthy ones
+            self.release(target, session)
+        except Exception as e:
+            reply = {"error": "{}".format(e)}
+        reply["elapsed_ms"] = (time.time() - start) * 1000
+        self.record(target, reply["elapsed_ms"], "error" in reply)
+        return reply
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    return
+                server.last_request = time.time()
+                if message.get("op") == "stats":
+                    with server.pool.lock:
+                        reply = {"stats": dict((k, dict(v)) for k, v in server.pool.stats.items())}
+                else:
+                    reply = server.pool.relay(message)
+                send_message(self.request, reply)
+        finally:
+            with server.lock:
+                server.active -= 1
+                server.last_request = time.time()
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Wake up regularly to check for idleness
+    timeout = 1
+
+    def __init__(self, socket_path, idle_timeout):
+        socketserver.UnixStreamServer.__init__(self, socket_path, BrokerHandler)
+        self.pool = SessionPool()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.idle_timeout = idle_timeout
+        self.timeout = min(self.timeout, idle_timeout)
+        self.last_request = time.time()
+
+    def idle(self):
+        with self.lock:
+            return not self.active and time.time() - self.last_request > self.idle_timeout
+
+def ensure_private_dir(path):
+    """
+    Create path if needed and make sure nobody but the current user can access it
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+    st = os.lstat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077 and os.path.isdir(path) and not os.path.islink(path)
+
+def run_broker(socket_path, idle_timeout):
+    """
+    Serve requests relayed by splunk_api tasks until the broker has been idle for idle_timeout seconds
+    """
+    # Only one broker per socket, the lock also protects the removal of a stale socket
+    lock = open(socket_path + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    umask = os.umask(0o077)
+    try:
+        server = BrokerServer(socket_path, idle_timeout)
+    finally:
+        os.umask(umask)
+    try:
+        while not server.idle():
+            server.handle_request()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server.server_close()
+        lock.close()
+
+def spawn_broker(socket_path, idle_timeout):
+    """
+    Start a detached broker process, which must not hold on to the stdout/stderr of this module
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if not os.fork():
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            run_broker(socket_path, idle_timeout)
+    finally:
+        os._exit(0)
+
+def connect_broker(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def broker_request(socket_path, message, idle_timeout=BROKER_IDLE_TIMEOUT):
+    """
+    Relay a request through the keep-alive broker listening on socket_path, spawning it when needed.
+    Returns None when no broker can be reached, in which case the request was not sent.
+    """
+    if not ensure_private_dir(os.path.dirname(socket_path)):
+        return None
+    sock = connect_broker(socket_path)
+    if sock is None:
+        try:
+            spawn_broker(socket_path, idle_timeout)
+        except OSError:
+            return None
+        deadline = time.time() + BROKER_START_TIMEOUT
+        while sock is None and time.time() < deadline:
+            time.sleep(0.01)
+            sock = connect_broker(socket_path)
+        if sock is None:
+            return None
+    try:
+        send_message(sock, message)
+        reply = recv_message(sock)
+    finally:
+        sock.close()
+    if reply is None:
+        raise IOError("Broker closed the connection without replying")
+    if "error" in reply:
+        raise IOError(reply["error"])
+    return BrokerResponse(reply)
+
+def broker_stats(socket_path):
+    """
+    Return the latency stats per target of a running broker, if any
+    """
+    sock = connect_broker(socket_path)
+    if sock is None:
+        return {}
+    try:
+        send_message(sock, {"op": "stats"})
+        return recv_message(sock)["stats"]
+    finally:
+        sock.close()
+
+def send_request(session_class, method, url, headers, auth, data, verify, timeout, broker=None, pool=None, stream=False):
+    """
+    Send the request through the broker listening on the given socket if any, else on a session of
+    the given pool if any, or on a new session. A streamed response, whose body is only read on demand,
+    always comes from a new session.
+    """
+    message = {"method": method, "url": url, "headers": headers, "auth": auth, "data": data, "verify": verify, "timeout": timeout}
+    if stream:
+        broker = pool = None
+    if broker:
+        response = broker_request(broker["socket"], message, broker["idle_timeout"])
+        if response is not None:
+            record_metrics(response.timings)
+            return response
+    if pool is not None:
+        reply = pool.relay(message)
+        if "error" in reply:
+            raise IOError(reply["error"])
+        response = BrokerResponse(reply, brokered=False)
+        record_metrics(response.timings)
+        return response
+    session = session_class()
+    # Disable SSL verification for the session
+    session.verify = False
+    if data is None:
+        response, timings = timed_request(session, method, url, headers=headers, auth=auth, verify=verify, timeout=timeout, stream=stream)
+    else:
+        response, timings = timed_request(session, method, url, headers=headers, auth=auth, data=data, verify=verify, timeout=timeout, stream=stream)
+    record_metrics(timings)
+    return response
+
+def get_session_digest(base_url, auth):
+    """
+    Identify a session key by target and credentials, without keeping the password around
+    """
+    return hashlib.sha256("\0".join((base_url,) + tuple(auth)).encode("utf-8")).hexdigest()
+
+def load_session_keys(cache_path):
+    try:
+        with open(cache_path, "r") as f:
+            keys = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    now = time.time()
+    return dict((k, v) for k, v in keys.items() if isinstance(v, dict) and v.get("expires", 0) > now)
+
+def save_session_keys(cache_path, keys):
+    """
+    Atomically replace the session key cache, readable by the current user only
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=".sessions")
+        with os.fdopen(fd, "w") as f:
+            json.dump(keys, f)
+        os.rename(tmp, cache_path)
+    except (IOError, OSError):
+        pass
+
+def login(session_class, base_url, auth, verify, timeout, broker=None, pool=None):
+    """
+    Obtain a new session key from splunkd, or None if it cannot be obtained
+    """
+    data = {"username": auth[0], "password": auth[1], "output_mode": "json"}
+    record_metrics(logins=1)
+    try:
+        response = send_request(session_class, "POST", base_url + "/services/auth/login", {}, None, data, verify, timeout, broker, pool)
+        if response.status_code != 200:
+            return None
+        return response.json()["sessionKey"]
+    except Exception:
+        return None
+
+def get_session_key(session_class, base_url, auth, verify, timeout, session_auth, broker=None, pool=None, refresh=False):
+    """
+    Return the cached session key for the target and credentials, logging in when there is none
+    """
+    cache_path = session_auth["cache"]
+    if not ensure_private_dir(os.path.dirname(cache_path)):
+        return login(session_class, base_url, auth, verify, timeout, broker, pool)
+    digest = get_session_digest(base_url, auth)
+    keys = load_session_keys(cache_path)
+    if not refresh and digest in keys:
+        return keys[digest]["key"]
+    key = login(session_class, base_url, auth, verify, timeout, broker, pool)
+    if key is None:
+        keys.pop(digest, None)
+    else:
+        keys[digest] = {"key": key, "expires": time.time() + session_auth["ttl"]}
+    save_session_keys(cache_path, keys)
+    return key
+
+def session_request(session_class, method, url, headers, auth, data, verify, timeout, session_auth, broker=None, pool=None, stream=False):
+    """
+    Send the request with a cached splunkd session key rather than basic auth, so that splunkd does not
+    verify the password on every call. An expired key is replaced once, and basic auth is used if no key
+    can be obtained at all.
+    """
+    if not session_auth:
+        return send_request(session_class, method, url, headers, auth, data, verify, timeout, broker, pool, stream)
+    base_url = "{0.scheme}://{0.netloc}".format(urlparse(url))
+    key = get_session_key(session_class, base_url, auth, verify, timeout, session_auth, broker, pool)
+    if key is None:
+        return send_request(session_class, method, url, headers, auth, data, verify, timeout, broker, pool, stream)
+    response = send_request(session_class, method, url, dict(headers, Authorization="Splunk " + key), None, data, verify, timeout, broker, pool, stream)
+    if response.status_code == 401:
+        record_metrics(retries=1)
+        key = get_session_key(session_class, base_url, auth, verify, timeout, session_auth, broker, pool, refresh=True)
+        if key is not None:
+            response = send_request(session_class, method, url, dict(headers, Authorization="Splunk " + key), None, data, verify, timeout, broker, pool, stream)
+    return response
+
+def get_auth(username, password):
+    """
+    Basic auth credentials, or None to send the request without any
+    """
+    if username is None:
+        return None
+    return (username, password)
+
+def api_call_tcp(cert_prefix, method, endpoint, username, password, svc_port, payload=None, headers=None, verify=False, status_code=None, timeout=None, body_format=None, broker=None, session_auth=None, pool=None, stream=False, host=None):
+    url = "{}{}".format(get_tcp_target(cert_prefix, svc_port, host), endpoint)
     if headers is None:
         headers = {}
     headers['Content-Type'] = 'application/json'
-    auth = (username, password)
+    auth = get_auth(username, password)
 
     data = None
     if payload and body_format and body_format == "form-urlencoded":
@@ -29,17 +543,10 @@ def api_call_tcp(cert_prefix, method, endpoint, username, password, svc_port, pa
     elif payload:
       data = json.dumps(payload)
 
-    session = requests.Session()
-    # Disable SSL verification for the session
-    session.verify = False
-
     response = None
     excep_str = "No Exception"
     try:
-      if data is None:
-              response = session.request(method, url, headers=headers, auth=auth, verify=verify, timeout=timeout)
-      else:
-              response = session.request(method, url, headers=headers, auth=auth, data=data, verify=verify, timeout=timeout)
+      response = session_request(requests.Session, method, url, headers, auth, data, verify, timeout, session_auth, broker, pool, stream)
       if status_code is not None and response.status_code not in status_code:
           raise ValueError("API call for {} and data as {} failed with status code {}: {}".format(url, payload, response.status_code, response.text))
     except Exception as e:
@@ -47,16 +554,19 @@ def api_call_tcp(cert_prefix, method, endpoint, username, password, svc_port, pa
       cwd = os.getcwd()
     return response, excep_str
 
-def api_call_uds(method, endpoint, username, password, svc_port, payload=None, headers=None, verify=False, status_code=None, timeout=None, body_format=None):
-    url = "http+unix://{}{}".format(UDS_SOCKET_PATH_URL,endpoint)
+def get_tcp_target(cert_prefix, svc_port, host=None):
+    if not cert_prefix or cert_prefix not in ['http', 'https']:
+      cert_prefix = 'https'
+    if not svc_port:
+      svc_port = 8089
+    return "{}://{}:{}".format(cert_prefix, host or "127.0.0.1", svc_port)
+
+def api_call_uds(method, endpoint, username, password, svc_port, payload=None, headers=None, verify=False, status_code=None, timeout=None, body_format=None, broker=None, session_auth=None, pool=None, socket_path=UDS_SOCKET_PATH, stream=False):
+    url = "http+unix://{}{}".format(quote(socket_path, safe=""),endpoint)
     if headers is None:
         headers = {}
     headers['Content-Type'] = 'application/json'
-    auth = (username, password)
-
-    session = requests_unixsocket.Session()
-    # Disable SSL verification for the session
-    session.verify = False
+    auth = get_auth(username, password)
 
     data = None
     if payload and body_format and body_format == "form-urlencoded":
@@ -67,22 +577,790 @@ def api_call_uds(method, endpoint, username, password, svc_port, payload=None, h
     excep_str = "No Exception"
     response = None
     try:
-      if data is None:
-              response = session.request(method, url, headers=headers, auth=auth, verify=verify, timeout=timeout)
-      else:
-              response = session.request(method, url, headers=headers, auth=auth, data=data, verify=verify, timeout=timeout)
+      response = session_request(requests_unixsocket.Session, method, url, headers, auth, data, verify, timeout, session_auth, broker, pool, stream)
       if status_code is not None and response.status_code not in status_code:
         raise ValueError("API call for {} and data as {} failed with status code {}: {}".format(url, payload, response.status_code, response.text))
     except Exception as e:
       excep_str = "{}".format(e)
     return response, excep_str
 
+def parse_status_code(status_code):
+    """
+    Expected status codes as a list of integers, from a list or a comma-separated string
+    """
+    if status_code is None:
+        return None
+    if not isinstance(status_code, list):
+        status_code = "{}".format(status_code).split(",")
+    return [int(x) for x in status_code]
+
+def is_expected_status(response, status_code):
+    if status_code is None:
+        return 200 <= response.status_code < 300
+    return response.status_code in status_code
+
+def api_call(call, username, password, cert_prefix, svc_port, verify, broker=None, session_auth=None, pool=None, uds_socket=None, stream=False, metrics=None, circuit=None):
+    """
+    Send the call described by a dict of BATCH_REQUEST_KEYS over the given UDS socket if any and the call is
+    not for another host, else over TCP, adding its timings and counts to metrics if given (see new_metrics())
+    and going through the circuit breaker of its target if given (see get_circuit())
+    """
+    if call.get("host"):
+        uds_socket = None
+    if metrics is None:
+        return circuit_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream, circuit)
+    metrics["transport"] = "uds" if uds_socket else "tcp"
+    call_metrics.current = metrics
+    start = time.time()
+    try:
+        response, excep_str = circuit_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream, circuit)
+    finally:
+        call_metrics.current = None
+        metrics["total_ms"] += (time.time() - start) * 1000
+    metrics["brokered"] = isinstance(response, BrokerResponse) and response.brokered
+    return response, excep_str
+
+def circuit_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream, circuit):
+    """
+    Refuse the call without sending it while the circuit of its target is open, and report how the target
+    answered otherwise: no response or a 5xx status is a failure, any other status means splunkd is up
+    """
+    if not circuit:
+        return send_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream)
+    target = "unix://{}".format(uds_socket) if uds_socket else get_tcp_target(cert_prefix, svc_port, call.get("host"))
+    refused = acquire_circuit(circuit, target)
+    if refused:
+        record_metrics(refused=1)
+        return None, "Circuit open for {}: {}".format(target, refused)
+    response, excep_str = send_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream)
+    report_circuit(circuit, target, response is not None and response.status_code < 500)
+    return response, excep_str
+
+def send_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket, stream):
+    # The headers are updated in place, do not share them between calls
+    headers = dict(call["headers"]) if call.get("headers") else None
+    if uds_socket:
+        return api_call_uds(call["method"], call["url"], username, password, svc_port, call.get("body"), headers, verify,
+                            call.get("status_code"), call.get("timeout"), call.get("body_format"), broker, session_auth, pool, uds_socket, stream)
+    return api_call_tcp(cert_prefix, call["method"], call["url"], username, password, svc_port, call.get("body"), headers, verify,
+                        call.get("status_code"), call.get("timeout"), call.get("body_format"), broker, session_auth, pool, stream, call.get("host"))
+
+def get_circuit(circuit, state_path=CIRCUIT_STATE_PATH):
+    """
+    Validate the circuit parameter and complete it with CIRCUIT_DEFAULTS and the path of the state it shares
+    with the other tasks, raising ValueError when it is invalid
+    """
+    circuit = dict((k, v) for k, v in circuit.items() if v is not None)
+    unknown = sorted(set(circuit) - set(CIRCUIT_DEFAULTS))
+    if unknown:
+        raise ValueError("circuit has unsupported keys {}, supported keys are {}".format(", ".join(unknown), ", ".join(sorted(CIRCUIT_DEFAULTS))))
+    try:
+        for k, v in CIRCUIT_DEFAULTS.items():
+            circuit[k] = type(v)(circuit.get(k, v))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid circuit: {}".format(e))
+    if circuit["threshold"] < 1 or circuit["cooldown"] <= 0 or circuit["max_cooldown"] < circuit["cooldown"] or circuit["probe_timeout"] <= 0:
+        raise ValueError("circuit needs threshold >= 1, cooldown > 0, max_cooldown >= cooldown and probe_timeout > 0")
+    circuit["state"] = state_path
+    return circuit
+
+def get_wait_circuit(circuit, wait):
+    """
+    The circuit for the attempts of a wait, whose cooldown stays within the interval of the wait: its own
+    retries open the circuit, which must not keep it from seeing the target answer again
+    """
+    return dict(circuit, cooldown=min(circuit["cooldown"], wait["interval"]), max_cooldown=min(circuit["max_cooldown"], wait["max_interval"]))
+
+def update_circuit(state_path, target, update):
+    """
+    Apply update(state) to the state of the target under an exclusive lock, so that the tasks sharing the
+    state file see each other's updates, and return its result. Without a private state directory there
+    is no breaker and update is applied to a throwaway state.
+    """
+    if not ensure_private_dir(os.path.dirname(state_path)):
+        return update({})
+    with open(state_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(state_path, "r") as f:
+                states = json.load(f)
+        except (IOError, OSError, ValueError):
+            states = {}
+        state = dict(states.get(target) or {})
+        result = update(state)
+        if state != states.get(target, {}):
+            if state:
+                states[target] = state
+            else:
+                states.pop(target, None)
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(state_path), prefix=".circuits")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(states, f)
+                os.rename(tmp, state_path)
+            except (IOError, OSError):
+                pass
+    return result
+
+def acquire_circuit(circuit, target):
+    """
+    Return None when a call to the target may be sent, else why it is refused. Once the cooldown of an open
+    circuit is over, a single call is let through as the probe of the target, the others are refused until
+    it has reported or probe_timeout has passed.
+    """
+    def update(state):
+        now = time.time()
+        if state.get("failures", 0) < circuit["threshold"]:
+            return None
+        # Opened by callers with a longer max_cooldown, it holds this one no longer than its own
+        open_until = min(state["open_until"], state["open_until"] - state["cooldown"] + circuit["max_cooldown"])
+        if now < open_until:
+            return "{} consecutive failures, next probe in {:.0f}s".format(state["failures"], open_until - now)
+        if now < state.get("probe_until", 0):
+            return "{} consecutive failures, waiting on the probe in flight".format(state["failures"])
+        state["probe_until"] = now + circuit["probe_timeout"]
+        return None
+    return update_circuit(circuit["state"], target, update)
+
+def report_circuit(circuit, target, healthy):
+    """
+    Close the circuit of the target after a healthy answer, or count a failure, opening the circuit at the
+    threshold and for twice as long after each failed probe
+    """
+    def update(state):
+        if healthy:
+            state.clear()
+            return
+        state["failures"] = state.get("failures", 0) + 1
+        if state["failures"] >= circuit["threshold"]:
+            cooldown = state.get("cooldown")
+            state["cooldown"] = min(cooldown * 2, circuit["max_cooldown"]) if cooldown else circuit["cooldown"]
+            state["open_until"] = time.time() + state["cooldown"]
+            state["probe_until"] = 0
+    update_circuit(circuit["state"], target, update)
+
+def get_content(response):
+    try:
+        return response.json()
+    except:
+        return response.text
+
+def add_rest_filter(url, rest_filter):
+    """
+    Have splunkd only return the given content fields of each entry, which takes JSON output
+    """
+    if not rest_filter:
+        return url
+    args = [("f", f) for f in rest_filter]
+    if "output_mode=" not in url:
+        args.insert(0, ("output_mode", "json"))
+    return "{}{}{}".format(url, "&" if "?" in url else "?", urlencode(args))
+
+# Marks the parts of a JSON document no path of a projection reaches
+MISSING = object()
+
+def project(content, paths):
+    """
+    Keep the parts of the JSON content reached by any of the dotted paths, as understood by resolve_path(),
+    in the shape of content. Items of lists and dicts no path reaches are left out; None if nothing is left.
+    """
+    projected = project_keys(content, [path.split(".") if path else [] for path in paths])
+    return None if projected is MISSING else projected
+
+def matches_key(component, key, value):
+    """
+    Whether a component of a path designates the key of value, a dict or a list
+    """
+    if component == "*" or component == key:
+        return True
+    if not isinstance(value, list):
+        return False
+    try:
+        index = int(component)
+    except ValueError:
+        return False
+    return index == key or index + len(value) == key
+
+def project_keys(value, paths):
+    if any(not path for path in paths):
+        return value
+    if isinstance(value, dict):
+        projected, items = {}, value.items()
+    elif isinstance(value, list):
+        projected, items = [], enumerate(value)
+    else:
+        return MISSING
+    for key, item in items:
+        rest = [path[1:] for path in paths if matches_key(path[0], key, value)]
+        item = project_keys(item, rest) if rest else MISSING
+        if item is MISSING:
+            continue
+        if isinstance(projected, dict):
+            projected[key] = item
+        else:
+            projected.append(item)
+    return projected if projected else MISSING
+
+def read_body(response, max_bytes=None, dest=None):
+    """
+    Return the body of the response as text along with its size, or write it to dest and return None
+    instead of the text. Raises ValueError as soon as the body gets over max_bytes, which for a streamed
+    response happens before the rest of the body is read.
+    """
+    if isinstance(response, BrokerResponse):
+        chunks = [response.text.encode("utf-8")]
+        encoding = "utf-8"
+    else:
+        chunks = response.iter_content(65536)
+        encoding = response.encoding or "utf-8"
+    size = 0
+    kept = []
+    # Only replace dest once the whole body is written
+    out = open(dest + ".part", "wb") if dest else None
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise ValueError("Response body exceeds max_bytes of {}".format(max_bytes))
+            if out:
+                out.write(chunk)
+            else:
+                kept.append(chunk)
+    except Exception:
+        if out:
+            out.close()
+            os.unlink(dest + ".part")
+        raise
+    finally:
+        if not isinstance(response, BrokerResponse):
+            response.close()
+    if out:
+        out.close()
+        os.rename(dest + ".part", dest)
+        return None, size
+    return b"".join(kept).decode(encoding, "replace"), size
+
+def get_projected_content(response, projection):
+    """
+    Return the JSON content of the response, or its text if it is not JSON, along with the size of its body.
+    projection may hold fields to keep only parts of the content, max_bytes to bound the size of the body
+    and dest to write the body to. The content of a body written to dest is None unless fields are given.
+    """
+    text, size = read_body(response, projection.get("max_bytes"), projection.get("dest"))
+    try:
+        if text is None:
+            if not projection.get("fields"):
+                return None, size
+            with open(projection["dest"], "r") as f:
+                content = json.load(f)
+        else:
+            content = json.loads(text)
+    except ValueError:
+        return text, size
+    if projection.get("fields"):
+        content = project(content, projection["fields"])
+    return content, size
+
+def get_desired(body):
+    """
+    Return the settings a write body asks for, from a dict or a form-urlencoded string where a repeated key
+    makes a list, raising ValueError on any other body
+    """
+    if isinstance(body, dict):
+        return dict((k, v) for k, v in body.items() if v is not None)
+    if isinstance(body, (str, bytes)) or body is None:
+        values = parse_qs(body or "", keep_blank_values=True)
+        return dict((k, v[0] if len(v) == 1 else v) for k, v in values.items())
+    raise ValueError("ensure needs a dict or form-urlencoded body, got {!r}".format(body))
+
+def get_entity_url(url, desired):
+    """
+    URL of the entity a write targets: a body with a name creates it below the collection it is posted to,
+    otherwise the URL is the entity itself, as for a conf stanza
+    """
+    path, sep, query = url.partition("?")
+    if "name" in desired:
+        path = "{}/{}".format(path.rstrip("/"), quote("{}".format(desired["name"]), safe=""))
+    return "{}?{}".format(path, "&".join([arg for arg in query.split("&") if arg and not arg.startswith("output_mode=")] + ["output_mode=json"]))
+
+def as_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return BOOLEAN_STRINGS.get("{}".format(value).lower())
+
+def same_setting(current, desired):
+    """
+    Whether the current value of a setting already is the desired one, where splunkd returns typed booleans
+    and lists for multi-valued settings but bodies templated by Ansible usually have strings
+    """
+    if isinstance(current, list) or isinstance(desired, list):
+        current = current if isinstance(current, list) else [current]
+        desired = desired if isinstance(desired, list) else [desired]
+        return sorted("{}".format(v) for v in current) == sorted("{}".format(v) for v in desired)
+    if as_boolean(current) is not None and as_boolean(desired) is not None:
+        return as_boolean(current) == as_boolean(desired)
+    return same_value(current, desired)
+
+def diff_settings(current, desired):
+    """
+    Return the settings of desired the current content of the entity does not have, as before and after dicts
+    """
+    before, after = {}, {}
+    for key, value in desired.items():
+        if key != "name" and (key not in current or not same_setting(current[key], value)):
+            before[key] = current.get(key)
+            after[key] = value
+    return {"before": before, "after": after}
+
+def ensure_call(call, *args, **kwargs):
+    """
+    Make the write of call only when the entity it targets does not exist or differs from its body, looking
+    it up first. Returns the response, excep_str, whether a write was or would be needed and the diff; when
+    no write is sent, because nothing differs or check_mode is set, the response is the one of the lookup.
+    A failed lookup returns no response. Raises ValueError on a body that cannot be compared.
+    """
+    check_mode = kwargs.pop("check_mode", False)
+    stream = kwargs.pop("stream", False)
+    desired = get_desired(call.get("body"))
+    lookup = {"method": "GET", "url": get_entity_url(call["url"], desired), "headers": call.get("headers"), "timeout": call.get("timeout"),
+              "status_code": [200, 404]}
+    response, excep_str = api_call(lookup, *args, **kwargs)
+    if response is None or response.status_code not in (200, 404):
+        return None, "looking up {} failed: {}".format(lookup["url"], excep_str), False, None
+    if response.status_code == 404:
+        diff = {"before": {}, "after": dict((k, v) for k, v in desired.items() if k != "name")}
+        write = call
+    else:
+        try:
+            entry = get_content(response)["entry"][0]
+        except (KeyError, IndexError, TypeError):
+            return None, "looking up {} returned no entry: {}".format(lookup["url"], response.text), False, None
+        diff = diff_settings(entry.get("content", {}), desired)
+        if not diff["after"]:
+            return response, excep_str, False, diff
+        write = call
+        if "name" in desired:
+            # The entity exists, so it is edited in place rather than created again
+            body = dict((k, v) for k, v in desired.items() if k != "name")
+            write = dict(call, url=entry.get("links", {}).get("edit") or lookup["url"].partition("?")[0],
+                         body=body if isinstance(call.get("body"), dict) else urlencode(body, doseq=True))
+    if check_mode:
+        return response, excep_str, True, diff
+    response, excep_str = api_call(write, *args, stream=stream, **kwargs)
+    return response, excep_str, True, diff
+
+def batch_call(call, projection, *args, **kwargs):
+    """
+    Run one item of the requests list and describe its outcome, without raising. In check mode, only the
+    items with ensure are looked up, the others are skipped without being sent.
+    """
+    check_mode = kwargs.get("check_mode", False)
+    if check_mode and call.get("ensure") != "present":
+        result = {"method": call["method"], "url": call["url"], "skipped": True, "failed": False, "changed": False}
+        if "name" in call:
+            result["name"] = call["name"]
+        return result
+    metrics = new_metrics()
+    start = time.time()
+    changed, written, diff = True, True, None
+    try:
+        if call.get("ensure") == "present":
+            response, excep_str, changed, diff = ensure_call(call, *args, metrics=metrics, check_mode=check_mode, circuit=kwargs.get("circuit"))
+            written = changed and not check_mode
+        else:
+            response, excep_str = api_call(call, *args, metrics=metrics, circuit=kwargs.get("circuit"))
+    except Exception as e:
+        response, excep_str = None, "{}".format(e)
+    return describe_call(call, projection, response, excep_str, metrics, (time.time() - start) * 1000, changed, written, diff)
+
+def describe_call(call, projection, response, excep_str, metrics, latency_ms, changed=True, written=True, diff=None):
+    """
+    Result of an item of the requests list given its response, or None and why it got none
+    """
+    result = {"method": call["method"], "url": call["url"], "latency_ms": latency_ms, "skipped": False, "metrics": metrics, "changed": changed}
+    if "name" in call:
+        result["name"] = call["name"]
+    if diff is not None:
+        result["diff"] = diff
+    result["failed"] = response is None or (written and not is_expected_status(response, call.get("status_code")))
+    if result["failed"]:
+        result["msg"] = excep_str if response is None else "{} {} failed with status code {}: {}; {}".format(
+            call["method"], call["url"], response.status_code, response.text, excep_str)
+    if response is not None:
+        result["status"] = response.status_code
+        result["brokered"] = isinstance(response, BrokerResponse) and response.brokered
+        try:
+            result["json"], result["size"] = get_projected_content(response, projection)
+        except ValueError as e:
+            if not result["failed"]:
+                result["failed"] = True
+                result["msg"] = "{} {}: {}".format(call["method"], call["url"], e)
+    return result
+
+def run_batch(run, calls, concurrency=1, on_error="stop"):
+    """
+    Return the results of run(call) for each call, in order, with at most concurrency calls in flight.
+    With on_error set to "stop", the calls not started yet once one has failed are skipped; with "collect"
+    every call is run.
+    """
+    results = [None] * len(calls)
+    state = {"next": 0, "stop": False}
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            if state["stop"] or state["next"] >= len(calls):
+                return False
+            index = state["next"]
+            state["next"] += 1
+        results[index] = run(calls[index])
+        if results[index]["failed"] and on_error == "stop":
+            with lock:
+                state["stop"] = True
+        return True
+
+    def worker():
+        while step():
+            pass
+
+    # The first call runs on its own, so that the others find a session key and an open connection
+    if step() and concurrency > 1:
+        threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(calls)) - 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        worker()
+        for thread in threads:
+            thread.join()
+    else:
+        worker()
+    for index, call in enumerate(calls):
+        if results[index] is None:
+            results[index] = {"method": call["method"], "url": call["url"], "skipped": True, "failed": False, "changed": False}
+            if "name" in call:
+                results[index]["name"] = call["name"]
+    return results
+
+def get_batch_calls(calls, defaults):
+    """
+    Validate the items of the requests list and complete them with the defaults, raising ValueError on invalid items
+    """
+    batch = []
+    for index, call in enumerate(calls):
+        if not isinstance(call, dict):
+            raise ValueError("requests[{}] must be a dict, got {!r}".format(index, call))
+        unknown = sorted(set(call) - set(BATCH_REQUEST_KEYS))
+        if unknown:
+            raise ValueError("requests[{}] has unsupported keys {}, supported keys are {}".format(index, ", ".join(unknown), ", ".join(BATCH_REQUEST_KEYS)))
+        call = dict((k, v) for k, v in defaults.items() if v is not None)
+        call.update((k, v) for k, v in calls[index].items() if v is not None)
+        if not call.get("method") or not call.get("url"):
+            raise ValueError("requests[{}] needs a method and a url".format(index))
+        if call.get("ensure") not in (None, "present"):
+            raise ValueError("requests[{}] has unsupported ensure {!r}, supported is present".format(index, call["ensure"]))
+        call["status_code"] = parse_status_code(call.get("status_code"))
+        batch.append(call)
+    return batch
+
+class PipelineReader(object):
+    """
+    Buffered reader of a pipelined connection, shared by the responses read off it in turn
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def close(self):
+        # A response is done with the connection, the next one is not
+        pass
+
+class PipelinedConnection(object):
+    """
+    HTTP/1.1 keep-alive connection to splunkd on which requests are written ahead of their responses, which
+    splunkd sends back in order. splunkd does not speak HTTP/2, so this is how several calls share a round trip.
+    """
+    def __init__(self, target, verify=False, timeout=None):
+        start = time.time()
+        url = urlparse(target)
+        if url.scheme == "http+unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(unquote(url.netloc))
+            self.host = "localhost"
+        else:
+            self.sock = socket.create_connection((url.hostname, url.port), timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.host = url.netloc
+        self.timings = {"connections": 1, "connect_ms": (time.time() - start) * 1000, "tls_ms": 0.0}
+        if url.scheme == "https":
+            start = time.time()
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self.sock = context.wrap_socket(self.sock, server_hostname=url.hostname)
+            self.timings["tls_ms"] = (time.time() - start) * 1000
+        self.reader = PipelineReader(self.sock.makefile("rb"))
+
+    def makefile(self, *args, **kwargs):
+        return self.reader
+
+    def send(self, method, path, headers, body):
+        head = ["{} {} HTTP/1.1".format(method, path), "Host: {}".format(self.host), "Accept-Encoding: identity",
+                "Content-Length: {}".format(len(body))]
+        head.extend("{}: {}".format(k, v) for k, v in headers.items())
+        self.sock.sendall("\r\n".join(head + ["", ""]).encode("utf-8") + body)
+
+    def receive(self, method):
+        """
+        Read the response to the oldest request in flight, returning it and its body
+        """
+        response = httplib.HTTPResponse(self, method=method)
+        response.begin()
+        return response, response.read()
+
+    def close(self):
+        self.reader.fp.close()
+        self.sock.close()
+
+def get_pipeline_request(call, key, auth):
+    """
+    Path, headers and body of the call as api_call_tcp() would send it
+    """
+    headers = dict(call.get("headers") or {})
+    payload = call.get("body")
+    body = b""
+    if payload and call.get("body_format") == "form-urlencoded":
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        body = payload if isinstance(payload, (str, bytes)) else urlencode(payload, doseq=True)
+    elif payload:
+        headers["Content-Type"] = "application/json"
+        body = json.dumps(payload)
+    if key:
+        headers["Authorization"] = "Splunk " + key
+    elif auth:
+        headers["Authorization"] = "Basic " + base64.b64encode(":".join(auth).encode("utf-8")).decode("ascii")
+    return call["url"], headers, body if isinstance(body, bytes) else body.encode("utf-8")
+
+def pipeline_calls(calls, projection, username, password, cert_prefix, svc_port, verify, session_auth=None, uds_socket=None, depth=PIPELINE_DEPTH,
+                   on_error="stop", circuit=None):
+    """
+    Send the calls over a keep-alive connection per target with up to depth requests in flight, rather than
+    waiting for each response before the next request, and return the result of each as batch_call() does.
+    Calls splunkd closed the connection before answering are resent on a new one, and calls answered 401
+    once with a new session key. With on_error set to "stop", the calls not written yet once one has failed
+    are skipped; those in flight are still answered. When the connection breaks, the GET calls in flight
+    are resent but the others fail, as splunkd may have processed them.
+    """
+    results = [None] * len(calls)
+    targets = []
+    for index, call in enumerate(calls):
+        target = get_tcp_target(cert_prefix, svc_port, call.get("host")) if call.get("host") or not uds_socket else \
+            "http+unix://{}".format(quote(uds_socket, safe=""))
+        if target not in [t for t, _ in targets]:
+            targets.append((target, []))
+        [indexes for t, indexes in targets if t == target][0].append(index)
+    state = {"stop": False}
+    for target, indexes in targets:
+        pipeline_target(target, [(index, calls[index]) for index in indexes], results, state, projection, get_auth(username, password), verify,
+                        session_auth, depth, on_error, circuit)
+    for index, call in enumerate(calls):
+        if results[index] is None:
+            results[index] = {"method": call["method"], "url": call["url"], "skipped": True, "failed": False, "changed": False}
+            if "name" in call:
+                results[index]["name"] = call["name"]
+    return results
+
+def pipeline_target(target, pending, results, state, projection, auth, verify, session_auth, depth, on_error, circuit):
+    transport = "uds" if target.startswith("http+unix://") else "tcp"
+    timeout = max([call.get("timeout") or 0 for _, call in pending]) or None
+    session_class = requests_unixsocket.Session if transport == "uds" else requests.Session
+    metrics = dict((index, new_metrics(transport)) for index, _ in pending)
+    # A login is accounted to the first call
+    call_metrics.current = metrics[pending[0][0]]
+    try:
+        key = get_session_key(session_class, target, auth, verify, timeout, session_auth) if session_auth else None
+    finally:
+        call_metrics.current = None
+    refreshed = set()
+
+    def fail(index, call, excep_str):
+        results[index] = describe_call(call, projection, None, excep_str, metrics[index], 0.0)
+        if on_error == "stop":
+            state["stop"] = True
+
+    while pending and not state["stop"]:
+        refused = acquire_circuit(circuit, target) if circuit else None
+        if refused:
+            for index, call in pending:
+                metrics[index]["refused"] += 1
+                fail(index, call, "Circuit open for {}: {}".format(target, refused))
+            return
+        try:
+            conn = PipelinedConnection(target, verify, timeout)
+        except (socket.error, IOError, ssl.SSLError) as e:
+            if circuit:
+                report_circuit(circuit, target, False)
+            for index, call in pending:
+                fail(index, call, "URL: {}; exception: {}".format(target, e))
+            return
+        in_flight = []
+        closing = False
+        answered = 0
+        try:
+            while in_flight or (pending and not state["stop"] and not closing):
+                while pending and not state["stop"] and not closing and len(in_flight) < depth:
+                    index, call = pending[0]
+                    path, headers, body = get_pipeline_request(call, key, auth)
+                    conn.send(call["method"], path, headers, body)
+                    in_flight.append((index, call, time.time(), len(body), key))
+                    pending.pop(0)
+                index, call, sent, bytes_out, sent_key = in_flight[0]
+                response, content = conn.receive(call["method"])
+                in_flight.pop(0)
+                answered += 1
+                elapsed_ms = (time.time() - sent) * 1000
+                timings = dict(conn.timings if answered == 1 else {}, requests=1, ttfb_ms=elapsed_ms, total_ms=elapsed_ms, bytes_out=bytes_out,
+                               bytes_in=len(content))
+                for k, v in timings.items():
+                    metrics[index][k] += v
+                if response.will_close:
+                    # splunkd drops the requests written after this one
+                    closing = True
+                    pending[0:0] = [(i, c) for i, c, _, _, _ in in_flight]
+                    in_flight = []
+                if response.status == 401 and sent_key and index not in refreshed:
+                    refreshed.add(index)
+                    metrics[index]["retries"] += 1
+                    # The calls sent along with the same expired key only need to be resent
+                    if sent_key == key:
+                        call_metrics.current = metrics[index]
+                        try:
+                            key = get_session_key(session_class, target, auth, verify, timeout, session_auth, refresh=True)
+                        finally:
+                            call_metrics.current = None
+                    pending.insert(0, (index, call))
+                    continue
+                reply = {"status_code": response.status, "headers": dict(response.getheaders()), "text": content.decode("utf-8", "replace"),
+                         "elapsed_ms": elapsed_ms}
+                results[index] = describe_call(call, projection, BrokerResponse(reply, brokered=False), "No Exception", metrics[index], elapsed_ms)
+                if results[index]["failed"] and on_error == "stop":
+                    state["stop"] = True
+        except (socket.error, IOError, ssl.SSLError, httplib.HTTPException) as e:
+            # A connection closed with requests in flight may have lost answers already sent, only the calls
+            # which can safely be repeated are resent
+            for index, call, _, _, _ in reversed(in_flight):
+                if answered and call["method"].upper() in ("GET", "HEAD"):
+                    pending.insert(0, (index, call))
+                else:
+                    fail(index, call, "URL: {}{}; exception: {}".format(target, call["url"], e))
+            if not answered:
+                # Not a connection splunkd closed after answering, but one it never answered on
+                for index, call in pending:
+                    fail(index, call, "URL: {}; exception: {}".format(target, e))
+                pending = []
+        finally:
+            conn.close()
+        if circuit:
+            report_circuit(circuit, target, answered > 0)
+
+def resolve_path(content, path):
+    """
+    Return the value at the dotted path of the JSON content, where a "*" component expands every item of
+    a list or dict and makes the result a list. Items of an expansion missing the rest of the path are
+    left out; raises KeyError, IndexError, ValueError or TypeError when the path does not match otherwise.
+    """
+    values, expanded = [content], False
+    for key in path.split(".") if path else []:
+        if key == "*":
+            values = [item for value in values for item in (value.values() if isinstance(value, dict) else value)]
+            expanded = True
+            continue
+        found = []
+        for value in values:
+            try:
+                found.append(value[int(key)] if isinstance(value, list) else value[key])
+            except (KeyError, IndexError, ValueError, TypeError):
+                if not expanded:
+                    raise
+        values = found
+    return values if expanded else values[0]
+
+def same_value(actual, expected):
+    # Values templated by Ansible usually come in as strings
+    return actual == expected or "{}".format(actual) == "{}".format(expected)
+
+def check_condition(content, wait):
+    """
+    Whether the JSON content satisfies the condition of wait, which is false when its path does not match
+    """
+    try:
+        value = resolve_path(content, wait.get("path"))
+    except (KeyError, IndexError, ValueError, TypeError):
+        return False
+    if "equals" in wait:
+        return same_value(value, wait["equals"])
+    if "not_equals" in wait:
+        return not same_value(value, wait["not_equals"])
+    if "length" in wait:
+        return isinstance(value, (list, dict, str)) and len(value) == int(wait["length"])
+    if "contains" in wait:
+        return any(same_value(item, wait["contains"]) for item in value) if isinstance(value, list) else "{}".format(wait["contains"]) in "{}".format(value)
+    if "not_contains" in wait:
+        return not any(same_value(item, wait["not_contains"]) for item in value) if isinstance(value, list) else "{}".format(wait["not_contains"]) not in "{}".format(value)
+    return True
+
+def get_wait(wait):
+    """
+    Validate the wait parameter and complete it with WAIT_DEFAULTS, raising ValueError when it is invalid
+    """
+    wait = dict((k, v) for k, v in wait.items() if v is not None)
+    unknown = sorted(set(wait) - set(("path",) + WAIT_CONDITIONS) - set(WAIT_DEFAULTS))
+    if unknown:
+        raise ValueError("wait has unsupported keys {}, supported keys are {}".format(
+            ", ".join(unknown), ", ".join(("path",) + WAIT_CONDITIONS + tuple(sorted(WAIT_DEFAULTS)))))
+    conditions = [k for k in WAIT_CONDITIONS if k in wait]
+    if len(conditions) > 1:
+        raise ValueError("wait accepts a single condition, got {}".format(", ".join(conditions)))
+    try:
+        for k, v in WAIT_DEFAULTS.items():
+            wait[k] = float(wait.get(k, v))
+        if "length" in wait:
+            wait["length"] = int(wait["length"])
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid wait: {}".format(e))
+    if wait["interval"] <= 0 or wait["backoff"] < 1 or wait["max_interval"] < wait["interval"] or wait["timeout"] < 0:
+        raise ValueError("wait needs interval > 0, backoff >= 1, max_interval >= interval and timeout >= 0")
+    return wait
+
+def poll(call, done, wait):
+    """
+    Repeat call() until done(response) or the timeout of wait expires, sleeping between attempts for an
+    interval which starts at wait["interval"] and is multiplied by wait["backoff"] up to wait["max_interval"].
+    Returns the last response and exception string, the number of attempts and whether done.
+    """
+    deadline = time.time() + wait["timeout"]
+    interval = wait["interval"]
+    attempts = 0
+    while True:
+        response, excep_str = call()
+        attempts += 1
+        if response is not None and done(response):
+            return response, excep_str, attempts, True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return response, excep_str, attempts, False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * wait["backoff"], wait["max_interval"])
+
 def main():
     module_args = dict(
-        method=dict(type='str', required=True),
-        url=dict(type='str', required=True),
-        username=dict(type='str', required=True),
-        password=dict(type='str', required=True, no_log=True),
+        method=dict(type='str', required=False),
+        url=dict(type='str', required=False),
+        username=dict(type='str', required=False),
+        password=dict(type='str', required=False, no_log=True),
         cert_prefix=dict(type='str', required=False),
         body=dict(type='dict', required=False),
         body_format=dict(type='str', required=False),
@@ -92,7 +1370,28 @@ def main():
         use_proxy=dict(type='str', required=False),
         status_code=dict(type='list', required=False),
         timeout=dict(type='int', required=False),
-        svc_port=dict(type='int', required=False)
+        svc_port=dict(type='int', required=False),
+        broker=dict(type='bool', required=False),
+        broker_socket=dict(type='str', required=False),
+        broker_idle_timeout=dict(type='int', required=False),
+        auth_method=dict(type='str', required=False, choices=['basic', 'session']),
+        requests=dict(type='list', required=False),
+        concurrency=dict(type='int', required=False, default=1),
+        on_error=dict(type='str', required=False, default='stop', choices=['stop', 'collect']),
+        wait=dict(type='dict', required=False),
+        splunk_home=dict(type='str', required=False),
+        uds=dict(type='bool', required=False),
+        uds_socket=dict(type='str', required=False),
+        fields=dict(type='list', required=False),
+        rest_filter=dict(type='list', required=False),
+        max_bytes=dict(type='int', required=False),
+        dest=dict(type='path', required=False),
+        metrics=dict(type='bool', required=False),
+        metrics_file=dict(type='path', required=False),
+        ensure=dict(type='str', required=False, choices=['present']),
+        host=dict(type='str', required=False),
+        circuit=dict(type='dict', required=False),
+        pipeline=dict(type='int', required=False)
     )
 
     module = AnsibleModule(
@@ -100,7 +1399,10 @@ def main():
         supports_check_mode=True
     )
 
-    if module.check_mode:
+    ensure = module.params.get('ensure')
+    calls = module.params.get('requests')
+    # Only writes made with ensure can tell whether they would change anything without being sent
+    if module.check_mode and not ensure and not any(isinstance(call, dict) and call.get("ensure") for call in calls or []):
         module.exit_json(changed=False)
 
     method = module.params['method']
@@ -117,6 +1419,26 @@ def main():
     svc_port = module.params.get('svc_port', 8089)
     return_content = module.params.get('return_content', False)
     use_proxy = module.params.get('use_proxy', "no")
+    use_broker = module.params.get('broker')
+    auth_method = module.params.get('auth_method') or os.environ.get("SPLUNK_API_AUTH_METHOD", "session")
+    wait = module.params.get('wait')
+    # Decided once, every call of this run goes over the same transport
+    host = module.params.get('host')
+    uds_socket = None if host else get_uds_socket(module.params.get('uds'), module.params.get('uds_socket'), module.params.get('splunk_home'))
+    transport = "uds" if uds_socket else "tcp"
+    facts = {"splunk_api_transport": transport}
+    # What of the response bodies is read, kept and returned
+    projection = {"fields": module.params.get('fields'), "max_bytes": module.params.get('max_bytes'), "dest": module.params.get('dest')}
+    rest_filter = module.params.get('rest_filter')
+    metrics_file = None
+    if module.params.get('metrics') or (module.params.get('metrics') is None and os.environ.get("SPLUNK_API_METRICS", "").lower() == "true"):
+      metrics_file = module.params.get('metrics_file') or os.environ.get("SPLUNK_API_METRICS_FILE") or METRICS_FILE_PATH
+
+    def log_metrics(*results):
+      if metrics_file:
+        write_metrics(metrics_file, [dict(result["metrics"], time=time.time(), method=result["method"], url=result["url"],
+                                          status=result.get("status"), failed=result["failed"], **dict((k, result[k]) for k in ("name", "attempts") if k in result))
+                                     for result in results if "metrics" in result])
 
     if status_code:
       status_code = [int(x) for x in status_code]
@@ -124,24 +1446,152 @@ def main():
       use_proxy = 'no'
     if not return_content:
       return_content = False
+    if use_broker is None:
+      use_broker = os.environ.get("SPLUNK_API_BROKER", "").lower() == "true"
+    broker = None
+    if use_broker:
+      broker = {
+        "socket": module.params.get('broker_socket') or os.environ.get("SPLUNK_API_BROKER_SOCKET") or BROKER_SOCKET_PATH,
+        "idle_timeout": module.params.get('broker_idle_timeout') or int(os.environ.get("SPLUNK_API_BROKER_IDLE_TIMEOUT", BROKER_IDLE_TIMEOUT))
+      }
+    session_auth = None
+    if auth_method == "session" and username is not None:
+      session_auth = {
+        "cache": os.environ.get("SPLUNK_API_SESSION_CACHE") or SESSION_CACHE_PATH,
+        "ttl": int(os.environ.get("SPLUNK_API_SESSION_TTL", SESSION_KEY_TTL))
+      }
+
+    circuit = module.params.get('circuit')
+    if circuit is not None:
+      try:
+        circuit = get_circuit(circuit, os.environ.get("SPLUNK_API_CIRCUIT_STATE") or CIRCUIT_STATE_PATH)
+      except ValueError as e:
+        module.fail_json(msg="{}".format(e))
+
+    # Only a remote host may be called without credentials, such as to check that it is reachable
+    if (username is None or password is None) and not host:
+      module.fail_json(msg="username and password are required unless host is set")
+    if (username is None) != (password is None):
+      module.fail_json(msg="username and password must be set together")
+    if calls is not None and wait is not None:
+      module.fail_json(msg="wait is not supported along with requests")
+    if calls is not None and projection["dest"]:
+      module.fail_json(msg="dest is not supported along with requests")
+    if ensure and wait is not None:
+      module.fail_json(msg="wait is not supported along with ensure")
+    if projection["max_bytes"] is not None and projection["max_bytes"] < 0:
+      module.fail_json(msg="max_bytes must be positive, got {}".format(projection["max_bytes"]))
+    if calls is not None:
+      defaults = {"method": method, "url": endpoint, "body": payload, "body_format": body_format, "headers": headers,
+                  "status_code": status_code, "timeout": timeout, "ensure": ensure, "host": host}
+      try:
+        calls = get_batch_calls(calls, defaults)
+      except ValueError as e:
+        module.fail_json(msg="{}".format(e))
+      if module.params['concurrency'] < 1:
+        module.fail_json(msg="concurrency must be at least 1, got {}".format(module.params['concurrency']))
+      for call in calls:
+        call["url"] = add_rest_filter(call["url"], rest_filter)
+      pipeline = module.params.get('pipeline')
+      if pipeline is not None and pipeline < 1:
+        module.fail_json(msg="pipeline must be at least 1, got {}".format(pipeline))
+      if pipeline and any(call.get("ensure") for call in calls):
+        module.fail_json(msg="ensure is not supported along with pipeline")
+      start = time.time()
+      if pipeline:
+        results = pipeline_calls(calls, projection, username, password, cert_prefix, svc_port, verify, session_auth, uds_socket, pipeline,
+                                 module.params['on_error'], circuit)
+      else:
+        # Calls not relayed by the broker share keep-alive sessions
+        pool = SessionPool()
+        results = run_batch(lambda call: batch_call(call, projection, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket,
+                                                    check_mode=module.check_mode, circuit=circuit),
+                            calls, module.params['concurrency'], module.params['on_error'])
+      latency_ms = (time.time() - start) * 1000
+      failed = [result for result in results if result["failed"]]
+      log_metrics(*results)
+      if failed:
+        module.fail_json(msg="{} of {} requests failed, first failure: {}".format(len(failed), len(results), failed[0]["msg"]),
+                         results=results, latency_ms=latency_ms, transport=transport)
+      module.exit_json(changed=any(result.get("changed") for result in results), results=results, latency_ms=latency_ms, transport=transport, ansible_facts=facts)
+
+    if module.params.get('pipeline'):
+      module.fail_json(msg="pipeline is only supported along with requests")
+    if not method or not endpoint:
+      module.fail_json(msg="method and url are required unless requests is given")
+    endpoint = add_rest_filter(endpoint, rest_filter)
+
+    def exit_with_content(response, metrics, streamed=False, changed=True, **result):
+      try:
+        content, size = get_projected_content(response, projection)
+      except (ValueError, IOError, OSError) as e:
+        fail(response, metrics, "{} {}: {}".format(method, endpoint, e), **result)
+      if streamed:
+        metrics["bytes_in"] += size
+      if content is not None or not projection["dest"]:
+        result["json"] = content
+      if projection["dest"]:
+        result["dest"] = projection["dest"]
+      log_metrics(dict(result, method=method, url=endpoint, status=response.status_code, failed=False, metrics=metrics))
+      module.exit_json(changed=changed, status=response.status_code, size=size, transport=transport, ansible_facts=facts, metrics=metrics, **result)
+
+    def fail(response, metrics, msg, **result):
+      status = None if response is None else response.status_code
+      log_metrics(dict(result, method=method, url=endpoint, status=status, failed=True, metrics=metrics))
+      module.fail_json(msg=msg, status=status, transport=transport, metrics=metrics, **dict((k, v) for k, v in result.items() if k != "excep_str"))
 
     s = "{}{}{}{}{}{}{}{}{}".format(method, endpoint, username, password, svc_port, payload, headers, verify, status_code, timeout)
-    if supports_uds():
-        response, excep_str = api_call_uds(method, endpoint, username, password, svc_port, payload, headers, verify, status_code, timeout, body_format)
+    call = {"method": method, "url": endpoint, "body": payload, "body_format": body_format, "headers": headers, "status_code": status_code, "timeout": timeout,
+            "host": host}
+    if wait is not None:
+      try:
+        wait = get_wait(wait)
+      except ValueError as e:
+        module.fail_json(msg="{}".format(e))
+      if circuit:
+        circuit = get_wait_circuit(circuit, wait)
+      # Every attempt goes over the same keep-alive session, and adds up to the same metrics
+      pool = SessionPool()
+      metrics = new_metrics()
+      start = time.time()
+      response, excep_str, attempts, met = poll(lambda: api_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, pool, uds_socket,
+                                                                 metrics=metrics, circuit=circuit),
+                                                lambda response: is_expected_status(response, status_code) and check_condition(get_content(response), wait),
+                                                wait)
+      latency_ms = (time.time() - start) * 1000
+      if met:
+        exit_with_content(response, metrics, excep_str=excep_str, latency_ms=latency_ms, brokered=metrics["brokered"], attempts=attempts)
+      last = "no response: {}".format(excep_str) if response is None else "status code {}: {}".format(response.status_code, response.text)
+      fail(response, metrics, "{} {} did not meet the wait condition within {}s after {} attempts, last {}".format(method, endpoint, wait["timeout"], attempts, last),
+           attempts=attempts, latency_ms=latency_ms)
+
+    # Bounded or saved bodies are read as they come rather than all at once
+    stream = bool(projection["dest"]) or projection["max_bytes"] is not None
+    metrics = new_metrics()
+    start = time.time()
+    changed, result = True, {}
+    if ensure:
+      try:
+        response, excep_str, changed, result["diff"] = ensure_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth,
+                                                                   uds_socket=uds_socket, stream=stream, metrics=metrics, check_mode=module.check_mode,
+                                                                   circuit=circuit)
+      except ValueError as e:
+        module.fail_json(msg="{}".format(e))
     else:
-        response, excep_str = api_call_tcp(cert_prefix, method, endpoint, username, password, svc_port, payload, headers, verify, status_code, timeout, body_format)
+      response, excep_str = api_call(call, username, password, cert_prefix, svc_port, verify, broker, session_auth, uds_socket=uds_socket,
+                                     stream=stream, metrics=metrics, circuit=circuit)
+    latency_ms = (time.time() - start) * 1000
 
-    if response is not None and ((status_code and response.status_code in status_code) or (status_code is None and response.status_code >= 200 and response.status_code < 300)):
-        try:
-          content = response.json()
-        except:
-          content = response.text
-        module.exit_json(changed=True, status = response.status_code, json=content,excep_str=excep_str)
+    if response is not None and ensure and (not changed or module.check_mode):
+        # Nothing was written, the response is the one of the lookup
+        exit_with_content(response, metrics, changed=changed, excep_str=excep_str, latency_ms=latency_ms, brokered=metrics["brokered"], **result)
+    if response is not None and is_expected_status(response, status_code):
+        exit_with_content(response, metrics, stream, excep_str=excep_str, latency_ms=latency_ms, brokered=isinstance(response, BrokerResponse), **result)
     else:
         if response is None:
-          module.fail_json(msg="{};;; failed with NO RESPONSE and EXCEP_STR as {}".format(s, excep_str))
+          fail(response, metrics, "{};;; failed with NO RESPONSE and EXCEP_STR as {}".format(s, excep_str), latency_ms=latency_ms)
         else:
-          module.fail_json(msg="{};;; AND excep_str: {}, failed with status code {}: {}".format(s, excep_str, response.status_code, response.text))
+          fail(response, metrics, "{};;; AND excep_str: {}, failed with status code {}: {}".format(s, excep_str, response.status_code, response.text), latency_ms=latency_ms)
 
 if __name__ == '__main__':
     main()
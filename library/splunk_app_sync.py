@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+from ansible.module_utils.basic import AnsibleModule
+import os
+import errno
+import fnmatch
+import hashlib
+import json
+import shutil
+import stat
+import tempfile
+
+# Same exclusions as the tar pipeline this replaces: local/app.conf because some apps are disabled after installation
+DEFAULT_EXCLUDES = ["local/app.conf", "*.pyc", "*__pycache__*"]
+# Bump when the manifest format changes, an unknown version is ignored and rebuilt
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+# splunkd rewrites these in place in the installed app, a hardlink would let that leak into the bundle
+NO_LINK_DIRS = ("local",)
+NO_LINK_FILES = ("local.meta",)
+
+
+def is_excluded(rel_path, excludes):
+    """
+    Match rel_path, relative to the source directory, the way tar --exclude does: against the whole path and
+    every trailing run of its components
+    """
+    parts = rel_path.split("/")
+    for i in range(len(parts)):
+        tail = "/".join(parts[i:])
+        if any(fnmatch.fnmatchcase(tail, pattern) for pattern in excludes):
+            return True
+    return False
+
+def get_signature(st):
+    """
+    Cheap change detection of a file, content is only hashed when this differs from the manifest
+    """
+    return [st.st_size, getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9), st.st_ino, st.st_mode]
+
+def hash_file(path, st):
+    if stat.S_ISLNK(st.st_mode):
+        return "link:" + os.readlink(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("files") or {}
+
+def save_manifest(path, files):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".app_sync")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": files}, f, sort_keys=True)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        os.unlink(tmp)
+        raise
+
+def get_manifest_path(dest):
+    """
+    Manifest of dest, kept next to it rather than in it so that it never ends up in a bundle
+    """
+    dest = dest.rstrip("/")
+    return os.path.join(os.path.dirname(dest), ".{}.app_sync.json".format(os.path.basename(dest)))
+
+def can_link(rel_path):
+    parts = rel_path.split("/")
+    return not any(part in NO_LINK_DIRS for part in parts[1:-1]) and parts[-1] not in NO_LINK_FILES
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def install_file(src, dest, st, hardlink):
+    """
+    Replace dest with src atomically, as a hardlink when allowed and possible or else as a copy keeping its
+    mode and times. Return whether it was linked.
+    """
+    dest_dir = os.path.dirname(dest)
+    make_dirs(dest_dir)
+    tmp = os.path.join(dest_dir, ".{}.app_sync".format(os.path.basename(dest)))
+    if lstat(tmp):
+        os.unlink(tmp)
+    linked = False
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), tmp)
+    else:
+        if hardlink:
+            try:
+                os.link(src, tmp)
+                linked = True
+            except OSError:
+                # Across filesystems, or not allowed by fs.protected_hardlinks
+                pass
+        if not linked:
+            shutil.copy2(src, tmp)
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        os.unlink(tmp)
+        raise
+    return linked
+
+def remove_file(path, root):
+    """
+    Remove path and the directories it leaves empty up to root
+    """
+    if lstat(path):
+        os.unlink(path)
+    parent = os.path.dirname(path)
+    while parent != root and parent.startswith(root):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+def walk_app(src, app, excludes):
+    """
+    Yield the path relative to src of every directory, file and symlink of app not excluded, along with its lstat
+    """
+    top = os.path.join(src, app)
+    st = lstat(top)
+    if st is None:
+        raise ValueError("App {} not found in {}".format(app, src))
+    yield app, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel_dir = os.path.relpath(dirpath, src)
+        # Symlinked directories are kept as symlinks, as tar does
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        dirnames[:] = sorted(d for d in dirnames if d not in links and not is_excluded(rel_dir + "/" + d, excludes))
+        for name in dirnames + sorted(filenames + links):
+            rel_path = rel_dir + "/" + name
+            if not is_excluded(rel_path, excludes):
+                yield rel_path, os.lstat(os.path.join(dirpath, name))
+
+def sync_apps(src, dest, apps, excludes=None, manifest_path=None, hardlink=True, check_mode=False):
+    """
+    Make the apps of dest the same as the ones of src, only writing the files whose content differs and
+    removing the files a previous sync installed that are gone from src. The files are tracked in a
+    manifest, so that only the ones whose size, mtime or inode changed are hashed.
+    """
+    excludes = DEFAULT_EXCLUDES if excludes is None else excludes
+    manifest_path = manifest_path or get_manifest_path(dest)
+    old = load_manifest(manifest_path)
+    files = dict((rel, record) for rel, record in old.items() if rel.split("/")[0] not in apps)
+    result = {"copied": 0, "linked": 0, "deleted": 0, "unchanged": 0, "hashed": 0,
+              "bytes_copied": 0, "bytes_linked": 0, "bytes_hashed": 0, "changed_apps": []}
+    changed_apps = set()
+    for app in apps:
+        for rel_path, st in walk_app(src, app, excludes):
+            if stat.S_ISDIR(st.st_mode):
+                if not check_mode:
+                    make_dirs(os.path.join(dest, rel_path))
+                continue
+            src_path = os.path.join(src, rel_path)
+            dest_path = os.path.join(dest, rel_path)
+            dest_st = lstat(dest_path)
+            record = old.get(rel_path)
+            if record and dest_st and record["src"] == get_signature(st) and record["dest"] == get_signature(dest_st):
+                files[rel_path] = record
+                result["unchanged"] += 1
+                continue
+            digest = hash_file(src_path, st)
+            result["hashed"] += 1
+            result["bytes_hashed"] += st.st_size
+            same = False
+            if dest_st and stat.S_IFMT(dest_st.st_mode) == stat.S_IFMT(st.st_mode) and dest_st.st_size == st.st_size:
+                if record and record["sha256"] == digest and record["dest"] == get_signature(dest_st):
+                    same = True
+                elif (dest_st.st_dev, dest_st.st_ino) == (st.st_dev, st.st_ino):
+                    same = True
+                else:
+                    same = hash_file(dest_path, dest_st) == digest
+                    result["hashed"] += 1
+                    result["bytes_hashed"] += dest_st.st_size
+            if same and (stat.S_ISLNK(st.st_mode) or stat.S_IMODE(dest_st.st_mode) == stat.S_IMODE(st.st_mode)):
+                result["unchanged"] += 1
+            elif same:
+                changed_apps.add(app)
+                if not check_mode:
+                    os.chmod(dest_path, stat.S_IMODE(st.st_mode))
+                    dest_st = os.lstat(dest_path)
+            else:
+                changed_apps.add(app)
+                linked = hardlink and can_link(rel_path) and not stat.S_ISLNK(st.st_mode)
+                if not check_mode:
+                    linked = install_file(src_path, dest_path, st, hardlink and can_link(rel_path))
+                    dest_st = os.lstat(dest_path)
+                result["linked" if linked else "copied"] += 1
+                result["bytes_linked" if linked else "bytes_copied"] += st.st_size
+            if dest_st:
+                files[rel_path] = {"sha256": digest, "src": get_signature(st), "dest": get_signature(dest_st)}
+        for rel_path in sorted(old):
+            if rel_path.split("/")[0] == app and rel_path not in files:
+                changed_apps.add(app)
+                result["deleted"] += 1
+                if not check_mode:
+                    remove_file(os.path.join(dest, rel_path), os.path.normpath(dest))
+    result["changed_apps"] = sorted(changed_apps)
+    if not check_mode and files != old:
+        save_manifest(manifest_path, files)
+    return result
+
+def main():
+    module_args = dict(
+        src=dict(type='path', required=True),
+        dest=dict(type='path', required=True),
+        apps=dict(type='list', required=True),
+        exclude=dict(type='list', required=False),
+        manifest=dict(type='path', required=False),
+        hardlink=dict(type='bool', required=False, default=True)
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not os.path.isdir(module.params['dest']):
+        module.fail_json(msg="dest {} is not a directory".format(module.params['dest']))
+    try:
+        result = sync_apps(module.params['src'], module.params['dest'], module.params['apps'],
+                           excludes=module.params['exclude'], manifest_path=module.params['manifest'],
+                           hardlink=module.params['hardlink'], check_mode=module.check_mode)
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg="{}".format(e))
+    module.exit_json(changed=bool(result["changed_apps"]), **result)
+
+if __name__ == '__main__':
+    main()
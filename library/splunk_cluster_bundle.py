@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+from ansible.module_utils.basic import AnsibleModule
+import os
+import errno
+import hashlib
+import json
+import stat
+import tempfile
+import requests
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Bump when the state format changes, an unknown version is ignored and rebuilt
+STATE_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+INFO_ENDPOINT = "/services/cluster/master/info?output_mode=json"
+APPLY_ENDPOINT = "/services/cluster/master/control/default/apply?output_mode=json"
+
+
+def get_tcp_target(cert_prefix, svc_port, host=None):
+    if not cert_prefix or cert_prefix not in ['http', 'https']:
+      cert_prefix = 'https'
+    if not svc_port:
+      svc_port = 8089
+    return "{}://{}:{}".format(cert_prefix, host or "127.0.0.1", svc_port)
+
+def get_state_path(bundle_path):
+    """
+    State of bundle_path, kept next to it rather than in it so that it never ends up in the bundle
+    """
+    bundle_path = bundle_path.rstrip("/")
+    return os.path.join(os.path.dirname(bundle_path), ".{}.bundle.json".format(os.path.basename(bundle_path)))
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        return {}
+    return state
+
+def save_state(path, state):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".bundle")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(state, version=STATE_VERSION), f, sort_keys=True)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        os.unlink(tmp)
+        raise
+
+def get_signature(st):
+    return [st.st_size, getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9), st.st_ino, st.st_mode]
+
+def hash_file(path, st):
+    if stat.S_ISLNK(st.st_mode):
+        return "link:" + os.readlink(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_bundle_checksum(bundle_path, cache=None):
+    """
+    Checksum of the content of bundle_path: its file paths, modes and contents. splunkd checksums the tarball
+    it builds, with timestamps, which cannot be reproduced here. cache maps the path of a file to its
+    signature and hash, only the files whose signature changed are hashed. Return the checksum, the new
+    cache and how many files were hashed.
+    """
+    cache = cache or {}
+    files = {}
+    hashed = 0
+    if not os.path.isdir(bundle_path):
+        raise ValueError("Bundle path {} is not a directory".format(bundle_path))
+    for dirpath, dirnames, filenames in os.walk(bundle_path):
+        dirnames.sort()
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        dirnames[:] = [d for d in dirnames if d not in links]
+        for name in filenames + links:
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(path, bundle_path)
+            st = os.lstat(path)
+            signature = get_signature(st)
+            cached = cache.get(rel_path)
+            if cached and cached[0] == signature:
+                files[rel_path] = cached
+                continue
+            files[rel_path] = [signature, hash_file(path, st)]
+            hashed += 1
+    digest = hashlib.sha256()
+    for rel_path in sorted(files):
+        signature, content = files[rel_path]
+        digest.update("{}\0{:o}\0{}\n".format(rel_path, stat.S_IMODE(signature[3]), content).encode("utf-8"))
+    return digest.hexdigest(), files, hashed
+
+def get_bundle_info(session, target, timeout=None):
+    """
+    Return the content of cluster/master/info, with the bundle checksums and restart flags
+    """
+    response = session.get(target + INFO_ENDPOINT, timeout=timeout)
+    if response.status_code != 200:
+        raise Exception("GET cluster/master/info returned {}: {}".format(response.status_code, get_messages(response)))
+    return response.json()["entry"][0]["content"]
+
+def get_messages(response):
+    try:
+        return "; ".join(message.get("text", "") for message in response.json().get("messages", []))
+    except (ValueError, AttributeError):
+        return response.text
+
+def get_checksum(info, key):
+    return (info.get(key) or {}).get("checksum")
+
+def is_restart_required(info):
+    return bool(info.get("rolling_restart_flag") or info.get("last_check_restart_bundle_result"))
+
+def apply_bundle(session, target, skip_validation=True, timeout=None):
+    """
+    Ask the cluster master to apply the bundle on its peers, return whether it did rather than finding the
+    bundle identical to the active one
+    """
+    data = {"ignore_identical_bundle": "true"}
+    if skip_validation:
+        data["skip-validation"] = "true"
+    response = session.post(target + APPLY_ENDPOINT, data=data, timeout=timeout)
+    if response.status_code == 200:
+        return True
+    messages = get_messages(response)
+    if "already" in messages:
+        return False
+    raise Exception("POST cluster/master/control/default/apply returned {}: {}".format(response.status_code, messages))
+
+def sync_bundle(session, target, bundle_path, state_path=None, skip_validation=True, timeout=None, check_mode=False):
+    """
+    Apply the cluster bundle unless its content is the one last applied and the bundle this produced is still
+    the active or latest one on the cluster master
+    """
+    state_path = state_path or get_state_path(bundle_path)
+    state = load_state(state_path)
+    local_checksum, files, hashed = get_bundle_checksum(bundle_path, state.get("files"))
+    info = get_bundle_info(session, target, timeout)
+    result = {"local_checksum": local_checksum, "hashed": hashed, "applied": False,
+              "active_checksum": get_checksum(info, "active_bundle"), "latest_checksum": get_checksum(info, "latest_bundle"),
+              "restart_required": is_restart_required(info)}
+    applied = state.get("applied") or {}
+    if applied.get("local_checksum") == local_checksum and applied.get("checksum") in (result["active_checksum"], result["latest_checksum"]):
+        result["changed"] = False
+    elif check_mode:
+        result["changed"] = True
+    else:
+        previous = result["latest_checksum"]
+        if apply_bundle(session, target, skip_validation, timeout):
+            info = get_bundle_info(session, target, timeout)
+            result.update(active_checksum=get_checksum(info, "active_bundle"), latest_checksum=get_checksum(info, "latest_bundle"),
+                          restart_required=is_restart_required(info))
+        # An identical bundle is ignored by the cluster master
+        result["changed"] = result["applied"] = result["latest_checksum"] != previous
+        applied = {"local_checksum": local_checksum, "checksum": result["latest_checksum"]}
+    if not check_mode and (files != state.get("files") or applied != (state.get("applied") or {})):
+        try:
+            save_state(state_path, {"files": files, "applied": applied})
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+    return result
+
+def main():
+    module_args = dict(
+        bundle_path=dict(type='path', required=True),
+        state=dict(type='path', required=False),
+        username=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+        cert_prefix=dict(type='str', required=False),
+        svc_port=dict(type='int', required=False),
+        host=dict(type='str', required=False),
+        verify=dict(type='bool', required=False, default=False),
+        timeout=dict(type='int', required=False),
+        skip_validation=dict(type='bool', required=False, default=True)
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    session = requests.Session()
+    session.auth = (module.params['username'], module.params['password'])
+    session.verify = module.params['verify']
+    target = get_tcp_target(module.params['cert_prefix'], module.params['svc_port'], module.params['host'])
+    try:
+        result = sync_bundle(session, target, module.params['bundle_path'], state_path=module.params['state'],
+                             skip_validation=module.params['skip_validation'], timeout=module.params['timeout'],
+                             check_mode=module.check_mode)
+    except requests.exceptions.RequestException as e:
+        module.fail_json(msg="Could not reach the cluster master: {}".format(e))
+    except Exception as e:
+        module.fail_json(msg="{}".format(e))
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
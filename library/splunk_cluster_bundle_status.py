@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+from ansible.module_utils.basic import AnsibleModule
+import json
+import time
+import requests
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+INFO_ENDPOINT = "/services/cluster/master/info?output_mode=json"
+PEERS_ENDPOINT = "/services/cluster/master/peers?output_mode=json&count=0"
+# Polling schedule, in seconds, unless overridden
+WAIT_DEFAULTS = {"interval": 1.0, "backoff": 1.5, "max_interval": 30.0, "timeout": 300.0}
+# Of each request unless overridden, cut short by the deadline of the wait
+REQUEST_TIMEOUT = 30
+# Peer statuses of a rolling restart, any other than Up counts as pending
+RESTART_STATUSES = ("Restarting", "ShuttingDown", "Down", "Stopped", "ReassigningPrimaries")
+
+
+def get_tcp_target(cert_prefix, svc_port, host=None):
+    if not cert_prefix or cert_prefix not in ['http', 'https']:
+      cert_prefix = 'https'
+    if not svc_port:
+      svc_port = 8089
+    return "{}://{}:{}".format(cert_prefix, host or "127.0.0.1", svc_port)
+
+def get_messages(response):
+    try:
+        return "; ".join(message.get("text", "") for message in response.json().get("messages", []))
+    except (ValueError, AttributeError):
+        return response.text
+
+def get_entries(session, target, endpoint, timeout=None):
+    response = session.get(target + endpoint, timeout=timeout)
+    if response.status_code != 200:
+        raise Exception("GET {} returned {}: {}".format(endpoint.partition("?")[0], response.status_code, get_messages(response)))
+    return response.json()["entry"]
+
+def get_validation_errors(apply_bundle_status):
+    invalid = (apply_bundle_status or {}).get("invalid_bundle") or {}
+    return invalid.get("bundle_validation_errors_on_master") or invalid.get("bundle_validation_errors") or []
+
+def get_progress(info, peers):
+    """
+    Summarize where the push of the latest bundle is, from the content of cluster/master/info and the entries
+    of cluster/master/peers: which peers applied it, are still to, or are restarting
+    """
+    apply_bundle_status = info.get("apply_bundle_status") or {}
+    latest = ((info.get("latest_bundle") or {}).get("checksum") or "").upper()
+    progress = {"latest_checksum": latest, "active_checksum": ((info.get("active_bundle") or {}).get("checksum") or "").upper(),
+                "status": apply_bundle_status.get("status"), "rolling_restart": bool(info.get("rolling_restart_flag")),
+                "applied": [], "pending": [], "restarting": [], "errors": list(get_validation_errors(apply_bundle_status))}
+    for peer in peers:
+        content = peer.get("content") or {}
+        name = content.get("label") or peer.get("name")
+        errors = get_validation_errors(content.get("apply_bundle_status"))
+        progress["errors"].extend("{}: {}".format(name, error) for error in errors)
+        if content.get("status") in RESTART_STATUSES:
+            progress["restarting"].append(name)
+        elif content.get("status") == "Up" and (content.get("active_bundle_id") or "").upper() == latest:
+            progress["applied"].append(name)
+        else:
+            progress["pending"].append(name)
+    for key in ("applied", "pending", "restarting"):
+        progress[key].sort()
+    return progress
+
+def is_done(progress):
+    # cluster_status=None of splunk show cluster-bundle-status
+    return (not progress["pending"] and not progress["restarting"] and not progress["rolling_restart"]
+            and progress["status"] in (None, "", "None"))
+
+def summarize(progress, elapsed):
+    """
+    Snapshot of progress recorded each time it moves
+    """
+    snapshot = {"at": round(elapsed, 3)}
+    if "status" in progress:
+        snapshot.update(applied=len(progress["applied"]), pending=len(progress["pending"]), restarting=len(progress["restarting"]),
+                        status=progress["status"], rolling_restart=progress["rolling_restart"])
+    if "error" in progress:
+        snapshot["error"] = progress["error"]
+    return snapshot
+
+def wait_bundle(session, target, wait, timeout=REQUEST_TIMEOUT, progress_file=None):
+    """
+    Poll the cluster master until the latest bundle is active on every peer, no rolling restart is in
+    progress, a bundle validation error is reported or wait["timeout"] seconds have passed. The interval
+    goes back to its minimum whenever the push moves, and grows by backoff up to max_interval otherwise.
+    Each request times out after timeout seconds, or at the deadline with at least a second left.
+    Return whether the push completed, along with the last progress and its history.
+    """
+    start = time.time()
+    deadline = start + wait["timeout"]
+    interval = wait["interval"]
+    history = []
+    attempts = 0
+    progress = None
+    while True:
+        attempts += 1
+        try:
+            info = get_entries(session, target, INFO_ENDPOINT, max(min(timeout, deadline - time.time()), 1))[0]["content"]
+            progress = get_progress(info, get_entries(session, target, PEERS_ENDPOINT, max(min(timeout, deadline - time.time()), 1)))
+        except Exception as e:
+            # Such as splunkd restarting, tried again until the deadline
+            progress = dict(progress or {}, error="{}".format(e))
+        snapshot = summarize(progress, time.time() - start)
+        moved = not history or dict(history[-1], at=None) != dict(snapshot, at=None)
+        if moved:
+            history.append(snapshot)
+            if progress_file:
+                with open(progress_file, "a") as f:
+                    f.write(json.dumps(dict(snapshot, time=time.time())) + "\n")
+        if progress.get("errors"):
+            return False, progress, history, attempts
+        if "status" in progress and "error" not in progress and is_done(progress):
+            return True, progress, history, attempts
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False, progress, history, attempts
+        interval = wait["interval"] if moved and "error" not in progress else min(interval * wait["backoff"], wait["max_interval"])
+        time.sleep(min(interval, remaining))
+
+def main():
+    module_args = dict(
+        username=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+        cert_prefix=dict(type='str', required=False),
+        svc_port=dict(type='int', required=False),
+        host=dict(type='str', required=False),
+        verify=dict(type='bool', required=False, default=False),
+        timeout=dict(type='float', required=False),
+        interval=dict(type='float', required=False),
+        backoff=dict(type='float', required=False),
+        max_interval=dict(type='float', required=False),
+        request_timeout=dict(type='int', required=False, default=REQUEST_TIMEOUT),
+        progress_file=dict(type='path', required=False)
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    wait = dict((key, module.params[key] if module.params[key] is not None else value) for key, value in WAIT_DEFAULTS.items())
+    if wait["interval"] <= 0 or wait["backoff"] < 1:
+        module.fail_json(msg="interval must be positive and backoff at least 1")
+    if module.params['request_timeout'] <= 0:
+        module.fail_json(msg="request_timeout must be positive")
+    session = requests.Session()
+    session.auth = (module.params['username'], module.params['password'])
+    session.verify = module.params['verify']
+    target = get_tcp_target(module.params['cert_prefix'], module.params['svc_port'], module.params['host'])
+    try:
+        done, progress, history, attempts = wait_bundle(session, target, wait, module.params['request_timeout'], module.params['progress_file'])
+    except Exception as e:
+        module.fail_json(msg="{}".format(e))
+    result = dict(progress, changed=False, attempts=attempts, history=history)
+    if progress.get("errors"):
+        module.fail_json(msg="Bundle validation failed: {}".format("; ".join(progress["errors"])), **result)
+    if not done:
+        module.fail_json(msg="Bundle push not complete within {}s after {} attempts: {} applied, {} pending, {} restarting{}".format(
+            wait["timeout"], attempts, len(progress.get("applied", [])), len(progress.get("pending", [])),
+            len(progress.get("restarting", [])), ", last error: {}".format(progress["error"]) if "error" in progress else ""), **result)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks for inventory/environ.py
+
+Usage: python tests/benchmarks/bench_environ.py
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import copy
+import gc
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add environ.py into path for benchmarking
+sys.path.append(os.path.join(REPO_DIR, "inventory"))
+
+import environ
+
+def report(name, seconds, runs):
+    print("{:<64} {:>10.3f} ms".format(name, seconds * 1000.0 / runs))
+
+def build_large_defaults(copies):
+    '''
+    Concatenate the shipped defaults into a multi-thousand-line default.yml
+    '''
+    with open(os.path.join(REPO_DIR, "inventory", "splunk_defaults_linux.yml"), "r") as f:
+        base = f.read()
+    base = "\n".join(line for line in base.splitlines() if line != "---")
+    copies_yml = []
+    for i in range(copies):
+        # Nest every copy under its own key and keep anchors unique per copy
+        copy = re.sub(r"([&*])(\w+)", r"\g<1>\g<2>_{}".format(i), base)
+        copies_yml.append("copy{}:\n".format(i) + "\n".join("    " + line for line in copy.splitlines()))
+    return "\n".join(copies_yml)
+
+def bench_yaml_loader(runs=5):
+    content = build_large_defaults(20)
+    print("YAML loaders on a {} line default.yml (libyaml: {})".format(content.count("\n"), yaml.__with_libyaml__))
+    report("yaml.Loader", timeit.timeit(lambda: yaml.load(content, Loader=yaml.Loader), number=runs), runs)
+    report("environ.loadYAML ({})".format(environ.BaseDefaultsLoader.__name__),
+           timeit.timeit(lambda: environ.loadYAML(content), number=runs), runs)
+
+def legacy_getVars(rePattern):
+    return {re.match(rePattern, k).group(1).lower():os.environ[k] for k in os.environ
+            if re.match(rePattern, k)}
+
+def bench_environment_scan(sizes=(100, 1000, 10000), runs=20):
+    defaults = environ.loadYAML(open(os.path.join(REPO_DIR, "inventory", "splunk_defaults_linux.yml")))
+    environ.loadDefaults = lambda: copy.deepcopy(defaults)
+    original = dict(os.environ)
+    print("Inventory build against environment size")
+    try:
+        for size in sizes:
+            os.environ.clear()
+            os.environ.update(original)
+            os.environ.update({"INJECTED_SERVICE_{}_PORT".format(i): str(i) for i in range(size)})
+            os.environ.update({"SPLUNK_PASSWORD": "helloworld", "SPLUNK_INDEXER_URL": "idx1,idx2"})
+            report("legacy getVars ({} vars)".format(size), timeit.timeit(lambda: legacy_getVars(r"(.*)_URL"), number=runs), runs)
+            report("getVars ({} vars)".format(size), timeit.timeit(lambda: environ.getVars(r"(.*)_URL"), number=runs), runs)
+            def build():
+                # Force a fresh snapshot, as a new inventory process would
+                environ.envSnapshot["source"] = None
+                environ.getSplunkInventory(copy.deepcopy(environ.inventory))
+            report("getSplunkInventory ({} vars)".format(size), timeit.timeit(build, number=runs), runs)
+    finally:
+        os.environ.clear()
+        os.environ.update(original)
+
+def legacy_merge_dict(dict1, dict2, path=None):
+    if path is None: path = []
+    for key in dict2:
+        if key in dict1:
+            if isinstance(dict1[key], dict) and isinstance(dict2[key], dict):
+                legacy_merge_dict(dict1[key], dict2[key], path + [str(key)])
+            elif isinstance(dict1[key], list) and isinstance(dict2[key], list):
+                dict1[key] += dict2[key]
+            else:
+                dict1[key] = dict2[key]
+        else:
+            dict1[key] = dict2[key]
+    return dict1
+
+def build_tree(depth, width, layer):
+    '''
+    Build a defaults tree of the given depth where every level holds width subtrees, scalars and lists
+    '''
+    if not depth:
+        return {"value": layer, "items": [layer, "shared"]}
+    tree = {"key{}".format(i): build_tree(depth - 1, width, layer) for i in range(width)}
+    tree.update({"scalar{}".format(i): layer for i in range(width)})
+    return tree
+
+def bench_merge_dict(shapes=((4, 8), (12, 2), (2, 60)), layers=4, runs=10):
+    print("merge_dict of {} default.yml layers".format(layers))
+    strategies = environ.getMergeStrategies({})
+    for depth, width in shapes:
+        trees = [build_tree(depth, width, i) for i in range(layers)]
+        def merge(func, *args):
+            # Copying is part of the setup, only the merge itself is timed
+            copies = [copy.deepcopy(tree) for tree in trees]
+            gc.disable()
+            try:
+                start = timeit.default_timer()
+                base = copies[0]
+                for tree in copies[1:]:
+                    func(base, tree, *args)
+                return timeit.default_timer() - start
+            finally:
+                gc.enable()
+        label = "depth {}, width {}".format(depth, width)
+        report("legacy merge_dict ({}, best of {})".format(label, runs), min(merge(legacy_merge_dict) for _ in range(runs)), 1)
+        report("merge_dict ({}, best of {})".format(label, runs), min(merge(environ.merge_dict, strategies) for _ in range(runs)), 1)
+
+def bench_default_vars(runs=500):
+    defaults = environ.loadYAML(open(os.path.join(REPO_DIR, "inventory", "splunk_defaults_linux.yml")))
+    environ.loadDefaults = lambda: copy.deepcopy(defaults)
+    overrides = {var: "1" for section in environ.ENV_OVERRIDES.values() for var, _, _, _ in section}
+    overrides.update({"SPLUNK_PASSWORD": "helloworld", "SPLUNK_ROLE": "splunk_standalone"})
+    original = dict(os.environ)
+    print("getDefaultVars ({} declarative overrides)".format(len(overrides) - 2))
+    try:
+        for name, env in (("no overrides", {"SPLUNK_PASSWORD": "helloworld"}), ("all overrides", overrides)):
+            os.environ.clear()
+            os.environ.update(env)
+            environ.envSnapshot["source"] = None
+            report("getDefaultVars ({})".format(name), timeit.timeit(environ.getDefaultVars, number=runs), runs)
+    finally:
+        os.environ.clear()
+        os.environ.update(original)
+
+def bench_inventory_output(copies=(1, 20), runs=5):
+    print("Inventory serialization and end-to-end ansible-inventory --list (orjson: {})".format(environ.orjson is not None))
+    defaults_file = os.path.join(tempfile.gettempdir(), "bench_defaults_{}.yml".format(os.getpid()))
+    env = dict(os.environ, SPLUNK_PASSWORD="helloworld", SPLUNK_DEFAULTS_URL=defaults_file,
+               KUBERNETES_SERVICE_HOST="localhost", ANSIBLE_LOG_PATH=os.devnull)
+    try:
+        for count in copies:
+            with open(defaults_file, "w") as f:
+                f.write(build_large_defaults(count))
+            label = "{} defaults copies".format(count)
+            os.environ.update(env)
+            environ.envSnapshot["source"] = None
+            inventory = copy.deepcopy(environ.inventory)
+            environ.getSplunkInventory(inventory)
+            report("json.dumps ({})".format(label), timeit.timeit(lambda: json.dumps(inventory), number=runs), runs)
+            report("dumpInventory ({})".format(label), timeit.timeit(lambda: environ.dumpInventory(inventory), number=runs), runs)
+            report("dumpInventory compact ({})".format(label), timeit.timeit(lambda: environ.dumpInventory(inventory, True), number=runs), runs)
+            for compact in ("false", "true"):
+                command = ["ansible-inventory", "-i", os.path.join(REPO_DIR, "inventory", "environ.py"), "--list"]
+                run_env = dict(env, SPLUNK_INVENTORY_COMPACT=compact)
+                def run():
+                    subprocess.check_call(command, env=run_env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                report("ansible-inventory --list (compact {}, {})".format(compact, label), timeit.timeit(run, number=runs), runs)
+    finally:
+        if os.path.exists(defaults_file):
+            os.remove(defaults_file)
+
+if __name__ == "__main__":
+    bench_yaml_loader()
+    bench_environment_scan()
+    bench_default_vars()
+    bench_merge_dict()
+    bench_inventory_output()
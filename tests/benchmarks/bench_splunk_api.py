@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks for library/splunk_api.py against a local stub splunkd
+
+Usage: python tests/benchmarks/bench_splunk_api.py
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+MODULE = os.path.join(REPO_DIR, "library", "splunk_api.py")
+
+# Add splunk_api.py into path for benchmarking
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_api
+import urllib3
+urllib3.disable_warnings()
+
+def report(name, seconds, runs):
+    print("{:<64} {:>10.3f} ms".format(name, seconds * 1000.0 / runs))
+
+class StubSplunkdHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as splunkd does
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid stalling on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def reply(self, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/services/cluster/master/peers"):
+            # About 30KB, as for a cluster of 50 indexers
+            self.reply({"entry": [{"name": "peer{}".format(i), "content": {"label": "idx{}".format(i), "status": "Up", "site": "site1",
+                                                                           "bucket_count": 1000 + i, "host_port_pair": "10.0.0.{}:8089".format(i),
+                                                                           "is_searchable": True, "search_state_message": ""}}
+                                  for i in range(50)]})
+        elif self.path.startswith("/services/search/distributed/peers"):
+            # About 1.5MB, as for 1000 search peers
+            self.reply({"entry": [{"name": "10.0.{}.{}:8089".format(i // 250, i % 250), "content": dict(
+                {"peerName": "idx{}".format(i), "status": "Up", "server_roles": ["indexer", "search_peer"], "cluster_label": ["idxc"]},
+                **dict(("field{}".format(j), "value" * 4) for j in range(40)))} for i in range(1000)]})
+        else:
+            self.reply({"entry": [{"name": "server-info", "content": {"version": "8.1.0"}}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/services/auth/login":
+            self.reply({"sessionKey": "benchmark"})
+        else:
+            self.reply({"entry": []})
+
+    def log_message(self, *args):
+        pass
+
+class StubSplunkd(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubSplunkdUnixHandler(StubSplunkdHandler):
+    # TCP_NODELAY does not apply to unix sockets
+    disable_nagle_algorithm = False
+
+class StubSplunkdUnix(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def start_stub_splunkd(workdir):
+    '''
+    Serve the stub over HTTPS with a throwaway self-signed certificate
+    '''
+    cert = os.path.join(workdir, "splunkd.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                           "-keyout", cert, "-out", cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = StubSplunkd(("127.0.0.1", 0), StubSplunkdHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    return start_server(server)
+
+def run_task(args_file, workdir):
+    env = dict(os.environ, SPLUNK_API_SESSION_CACHE=os.path.join(workdir, "state", "sessions.json"))
+    process = subprocess.Popen([sys.executable, MODULE, args_file], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+    output = process.communicate()[0]
+    result = json.loads(output)
+    assert not result.get("failed"), output
+    return result
+
+def write_args(workdir, args):
+    args_file = os.path.join(workdir, "args.json")
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    return args_file
+
+def bench_broker(calls=100, tasks=20):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    port = server.server_address[1]
+    broker = {"socket": os.path.join(workdir, "broker", "broker.sock"), "idle_timeout": 30}
+    print("splunk_api calls against a local HTTPS stub splunkd")
+    try:
+        def call(broker=None):
+            response, excep_str = splunk_api.api_call_tcp("https", "GET", "/services/server/info", "admin", "helloworld", port, broker=broker)
+            assert response is not None and response.status_code == 200, excep_str
+        report("api_call_tcp, new session per call", timeit.timeit(call, number=calls), calls)
+        # Spawn the broker outside of the timings
+        call(broker)
+        report("api_call_tcp, through the broker", timeit.timeit(lambda: call(broker), number=calls), calls)
+        stats = splunk_api.broker_stats(broker["socket"])
+        for target, target_stats in stats.items():
+            print("  broker latency for {}: {} calls, mean {:.3f} ms, max {:.3f} ms".format(
+                target, target_stats["calls"], target_stats["total_ms"] / target_stats["calls"], target_stats["max_ms"]))
+        # Whole module processes, as Ansible runs one per task
+        for use_broker in (False, True):
+            args_file = write_args(workdir, {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld",
+                                             "cert_prefix": "https", "svc_port": port, "verify": False,
+                                             "broker": use_broker, "broker_socket": broker["socket"]})
+            report("splunk_api task ({})".format("broker" if use_broker else "direct"),
+                   timeit.timeit(lambda: run_task(args_file, workdir), number=tasks), tasks)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+def bench_batch(calls=10, runs=10):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld",
+            "cert_prefix": "https", "svc_port": server.server_address[1], "verify": False, "broker": False}
+    print("{} splunk_api calls against a local HTTPS stub splunkd".format(calls))
+    try:
+        args_file = write_args(workdir, args)
+        def tasks():
+            for _ in range(calls):
+                run_task(args_file, workdir)
+        report("one task per call", timeit.timeit(tasks, number=runs), runs)
+        for concurrency in (1, 4):
+            batch_file = write_args(workdir, dict(args, requests=[{}] * calls, concurrency=concurrency))
+            report("one task with a requests list, concurrency {}".format(concurrency),
+                   timeit.timeit(lambda: run_task(batch_file, workdir), number=runs), runs)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+def bench_transport(calls=100):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    socket_path = os.path.join(workdir, "cli.socket")
+    uds_server = start_server(StubSplunkdUnix(socket_path, StubSplunkdUnixHandler))
+    endpoints = [("GET", "/services/server/info", None),
+                 ("GET", "/services/cluster/master/peers?output_mode=json&count=0", None),
+                 ("POST", "/servicesNS/nobody/system/configs/conf-app/shclustering", {"deployer_push_mode": "merge_to_default"})]
+    print("UDS socket vs loopback TLS against a local stub splunkd")
+    try:
+        for method, endpoint, body in endpoints:
+            for pooled in (False, True):
+                # A new session per call as for one task, or keep-alive sessions as for requests and wait
+                pool = splunk_api.SessionPool() if pooled else None
+                def tls():
+                    response, excep_str = splunk_api.api_call_tcp("https", method, endpoint, "admin", "helloworld", server.server_address[1],
+                                                                  body, body_format="form-urlencoded", pool=pool)
+                    assert response is not None and response.status_code == 200, excep_str
+                def uds():
+                    response, excep_str = splunk_api.api_call_uds(method, endpoint, "admin", "helloworld", None,
+                                                                  body, body_format="form-urlencoded", pool=pool, socket_path=socket_path)
+                    assert response is not None and response.status_code == 200, excep_str
+                for name, call in (("tls", tls), ("uds", uds)):
+                    report("{} {} {} ({})".format(name, method, "/".join(endpoint.split("?")[0].split("/")[-2:]), "keep-alive" if pooled else "new session"),
+                           timeit.timeit(call, number=calls), calls)
+    finally:
+        server.shutdown()
+        uds_server.shutdown()
+        shutil.rmtree(workdir)
+
+def bench_projection(tasks=10):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    args = {"method": "GET", "url": "/services/search/distributed/peers?output_mode=json&count=0", "username": "admin", "password": "helloworld",
+            "cert_prefix": "https", "svc_port": server.server_address[1], "verify": False}
+    fields = ["entry.*.name", "entry.*.content.status", "entry.*.content.peerName", "entry.*.content.server_roles"]
+    print("splunk_api task fetching 1000 search peers from a local HTTPS stub splunkd")
+    try:
+        for name, extra in (("whole response", {}), ("fields", {"fields": fields}),
+                            ("dest", {"dest": os.path.join(workdir, "peers.json")}),
+                            ("dest and fields", {"dest": os.path.join(workdir, "peers.json"), "fields": fields})):
+            args_file = write_args(workdir, dict(args, **extra))
+            output = {}
+            def task():
+                output["result"] = run_task(args_file, workdir)
+            seconds = timeit.timeit(task, number=tasks)
+            report("{} ({} KB of module result)".format(name, len(json.dumps(output["result"])) // 1024), seconds, tasks)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+def bench_metrics(calls=200):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    pool = splunk_api.SessionPool()
+    call = {"method": "GET", "url": "/services/server/info", "status_code": [200]}
+    print("Metrics overhead of splunk_api calls against a local HTTPS stub splunkd")
+    try:
+        for name, metrics in (("without metrics", lambda: None), ("with metrics", splunk_api.new_metrics)):
+            def run():
+                response, excep_str = splunk_api.api_call(call, "admin", "helloworld", "https", server.server_address[1], False, pool=pool,
+                                                          metrics=metrics())
+                assert response is not None and response.status_code == 200, excep_str
+            run()
+            report("api_call, keep-alive, {}".format(name), timeit.timeit(run, number=calls), calls)
+        metrics = splunk_api.new_metrics()
+        splunk_api.api_call(call, "admin", "helloworld", "https", server.server_address[1], False, metrics=metrics)
+        print("  new session: {}".format(", ".join("{} {}".format(k, round(v, 3) if isinstance(v, float) else v) for k, v in sorted(metrics.items()))))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+def bench_pipeline(counts=(10, 100, 1000)):
+    workdir = tempfile.mkdtemp()
+    server = start_stub_splunkd(workdir)
+    port = server.server_address[1]
+    session_auth = {"cache": os.path.join(workdir, "state", "sessions.json"), "ttl": 3000}
+    print("Bulk POSTs of DMC groups against a local HTTPS stub splunkd")
+    try:
+        for count in counts:
+            calls = [{"method": "POST", "url": "/services/search/distributed/groups", "body": {"name": "dmc_group_{}".format(i), "default": "false"},
+                      "body_format": "form-urlencoded", "status_code": [200]} for i in range(count)]
+            # Each run opens its connections, as one task does
+            def batch(concurrency):
+                pool = splunk_api.SessionPool()
+                return splunk_api.run_batch(lambda call: splunk_api.batch_call(call, {}, "admin", "helloworld", "https", port, False, None, session_auth, pool),
+                                            calls, concurrency)
+            runs = {
+                "keep-alive, concurrency 1": lambda: batch(1),
+                "keep-alive, concurrency 4": lambda: batch(4),
+                "pipelined, depth 16": lambda: splunk_api.pipeline_calls(calls, {}, "admin", "helloworld", "https", port, False, session_auth, None, 16),
+                "pipelined, depth 64": lambda: splunk_api.pipeline_calls(calls, {}, "admin", "helloworld", "https", port, False, session_auth, None, 64),
+            }
+            for name in sorted(runs):
+                def run():
+                    assert not any(result["failed"] for result in runs[name]())
+                seconds = min(timeit.repeat(run, number=1, repeat=3))
+                print("{:<64} {:>10.3f} ms {:>8.0f} ops/s".format("{} operations, {}".format(count, name), seconds * 1000.0, count / seconds))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    bench_broker()
+    bench_batch()
+    bench_transport()
+    bench_projection()
+    bench_metrics()
+    bench_pipeline()
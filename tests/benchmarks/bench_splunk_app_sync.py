@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks for library/splunk_app_sync.py against the tar pipeline it replaces
+
+Usage: python tests/benchmarks/bench_splunk_app_sync.py
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add splunk_app_sync.py into path for benchmarking
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_app_sync
+
+def report(name, seconds, runs):
+    print("{:<64} {:>10.3f} ms".format(name, seconds * 1000.0 / runs))
+
+def make_apps(src, apps, files, size):
+    content = os.urandom(size)
+    for a in range(apps):
+        for f in range(files):
+            path = os.path.join(src, "app{}".format(a), "default" if f % 2 else "bin", "file{}.conf".format(f))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as out:
+                out.write(content)
+    return ["app{}".format(a) for a in range(apps)]
+
+def tar_copy(src, dest, apps):
+    for app in apps:
+        subprocess.check_call("set -o pipefail && tar -c --exclude=local/app.conf --exclude='*.pyc' --exclude='*__pycache__*' {} | tar -x -C {}".format(app, dest),
+                              shell=True, cwd=src, executable="/bin/bash")
+
+def bench_sync(apps=20, files=50, size=64 * 1024, runs=5):
+    """
+    A redeploy with unchanged apps, copied again by tar, against a sync finding nothing to do
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, "apps")
+        names = make_apps(src, apps, files, size)
+        label = "{} apps x {} files x {} KiB".format(apps, files, size // 1024)
+        tar_dest = os.path.join(tmp, "tar")
+        os.makedirs(tar_dest)
+        report("tar | tar, {}".format(label), timeit.timeit(lambda: tar_copy(src, tar_dest, names), number=runs), runs)
+        for hardlink in (False, True):
+            dest = os.path.join(tmp, "sync-{}".format(hardlink))
+            os.makedirs(dest)
+            result = {}
+            seconds = timeit.timeit(lambda: result.update(splunk_app_sync.sync_apps(src, dest, names, hardlink=hardlink)), number=1)
+            report("first sync, hardlink={}, {} bytes copied".format(hardlink, result["bytes_copied"]), seconds, 1)
+            report("unchanged sync, hardlink={}, {}".format(hardlink, label),
+                   timeit.timeit(lambda: splunk_app_sync.sync_apps(src, dest, names, hardlink=hardlink), number=runs), runs)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    bench_sync()
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import os
 import sys
+import json
 import pytest
 import requests
 from mock import MagicMock, patch, mock_open
@@ -34,6 +35,19 @@ def test_getVars(regex, result):
         r = environ.getVars(regex)
         assert r == result
 
+def test_getEnv():
+    os_env = {"SPLUNK_ROLE": "splunk_indexer", "SPLUNKD_SSL_ENABLE": "false", "JAVA_VERSION": "openjdk:11",
+              "DMC_ASSET_INTERVAL": "* * * * *", "HIDE_PASSWORD": "true", "SPLUNKBASE_USERNAME": "ocho",
+              "PATH": "/usr/bin", "KUBERNETES_PORT": "tcp://10.0.0.1:443", "SPLUNKX": "1"}
+    with patch("os.environ", new=os_env):
+        env = environ.getEnv()
+        assert environ.getEnv() is env
+    assert env == {"SPLUNK_ROLE": "splunk_indexer", "SPLUNKD_SSL_ENABLE": "false", "JAVA_VERSION": "openjdk:11",
+                   "DMC_ASSET_INTERVAL": "* * * * *", "HIDE_PASSWORD": "true", "SPLUNKBASE_USERNAME": "ocho"}
+    # Replacing the environment rebuilds the snapshot
+    with patch("os.environ", new={"SPLUNK_ROLE": "splunk_search_head"}):
+        assert environ.getEnv() == {"SPLUNK_ROLE": "splunk_search_head"}
+
 @pytest.mark.skip(reason="TODO")
 def test_getSplunkInventory():
     pass
@@ -49,6 +63,52 @@ def test_getDefaultVars(mock_overrideEnvironmentVars, mock_loadDefaultSplunkVari
     retval = environ.getDefaultVars()
     assert "splunk" in retval
 
+@pytest.mark.parametrize(("default_yml", "os_env", "result"),
+            [
+                # Check null parameters creates the missing sections
+                ({}, {}, {"splunk": {"dfs": {"enable": False, "dfw_num_slots": 10, "dfc_num_slots": 4, "dfw_num_slots_enabled": False,
+                                             "spark_master_host": "127.0.0.1", "spark_master_webui_port": 8080}}}),
+                # Check default.yml parameters are coerced
+                ({"splunk": {"dfs": {"dfw_num_slots": "20"}}}, {}, {"splunk": {"dfs": {"enable": False, "dfw_num_slots": 20, "dfc_num_slots": 4, "dfw_num_slots_enabled": False,
+                                                                                       "spark_master_host": "127.0.0.1", "spark_master_webui_port": 8080}}}),
+                # Check env var parameters take precedence
+                ({"splunk": {"dfs": {"dfw_num_slots": 20}}}, {"SPLUNK_DFW_NUM_SLOTS": "30", "SPARK_MASTER_HOST": "spark"},
+                 {"splunk": {"dfs": {"enable": False, "dfw_num_slots": 30, "dfc_num_slots": 4, "dfw_num_slots_enabled": False,
+                                     "spark_master_host": "spark", "spark_master_webui_port": 8080}}}),
+                # Check non-dict intermediate values are replaced
+                ({"splunk": {"dfs": None}}, {}, {"splunk": {"dfs": {"enable": False, "dfw_num_slots": 10, "dfc_num_slots": 4, "dfw_num_slots_enabled": False,
+                                                                    "spark_master_host": "127.0.0.1", "spark_master_webui_port": 8080}}}),
+            ]
+        )
+def test_applyEnvOverrides(default_yml, os_env, result):
+    with patch("os.environ", new=os_env):
+        environ.applyEnvOverrides(default_yml, "dfs")
+    assert default_yml == result
+
+def test_applyEnvOverrides_errors():
+    vars_scope = {"splunk": {"hec": {"port": 8088}}}
+    with patch("os.environ", new={"SPLUNK_HEC_PORT": "abc"}):
+        with pytest.raises(Exception) as exc:
+            environ.applyEnvOverrides(vars_scope, "hec")
+    assert "SPLUNK_HEC_PORT='abc' is not a valid int" in str(exc.value)
+
+def test_collectEnvOverrideErrors():
+    def override(vars_scope):
+        environ.applyEnvOverrides(vars_scope, "web_ssl")
+        environ.applyEnvOverrides(vars_scope, "hec")
+        # Later steps relying on the invalid values may fail on their own
+        raise KeyError("http_enableSSL")
+    vars_scope = {"splunk": {"hec": {}}}
+    with patch("os.environ", new={"SPLUNK_HTTP_PORT": "80a", "SPLUNK_HEC_PORT": "abc"}):
+        with pytest.raises(Exception) as exc:
+            environ.collectEnvOverrideErrors(override, vars_scope)
+    assert str(exc.value) == "Invalid configuration: SPLUNK_HTTP_PORT='80a' is not a valid int; SPLUNK_HEC_PORT='abc' is not a valid int"
+    assert not environ.envOverrideErrors["collect"]
+    # Unrelated failures are propagated untouched
+    with pytest.raises(KeyError):
+        environ.collectEnvOverrideErrors(lambda v: v["splunk"], {})
+    assert environ.collectEnvOverrideErrors(lambda v: v, 1) == 1
+
 @pytest.mark.parametrize(("default_yml", "os_env", "output"),
             [
                 # Check null parameters
@@ -699,18 +759,27 @@ def test_getSplunkBuild(default_yml, os_env, build, build_url_bearer_token):
     assert vars_scope["splunk"]["build_location"] == build
     assert vars_scope["splunk"]["build_url_bearer_token"] == build_url_bearer_token
 
+SPLUNKBASE_APP = {"splunk": {"apps_location": ["https://splunkbase.splunk.com/app/2890/release/4.1.0/download"]}}
+
 @pytest.mark.parametrize(("default_yml", "response_content", "trigger_splunkbase"),
                          [
                             ({}, "<id>123abc</id>", False),
                             ({"splunkbase_username": "ocho"}, "<id>123abc</id>", False),
                             ({"splunkbase_password": "cinco"}, "<id>123abc</id>", False),
-                            ({"splunkbase_username": "ocho", "splunkbase_password": "cinco"}, "<id>123abc</id>", True),
+                            ({"splunkbase_username": "ocho", "splunkbase_password": "cinco"}, "<id>123abc</id>", False),
+                            (dict(SPLUNKBASE_APP, splunkbase_username="ocho", splunkbase_password="cinco"), "<id>123abc</id>", True),
                             ({"splunkbase_username": "", "splunkbase_password": ""}, "<id>123abc</id>", False),
                             ({}, "<id>123abc</id>", False),
                             ({"splunkbase_username": "ocho"}, b"<id>123abc</id>", False),
                             ({"splunkbase_password": "cinco"}, b"<id>123abc</id>", False),
-                            ({"splunkbase_username": "ocho", "splunkbase_password": "cinco"}, b"<id>123abc</id>", True),
+                            (dict(SPLUNKBASE_APP, splunkbase_username="ocho", splunkbase_password="cinco"), b"<id>123abc</id>", True),
                             ({"splunkbase_username": "", "splunkbase_password": ""}, b"<id>123abc</id>", False),
+                            # Splunkbase apps without credentials
+                            (dict(SPLUNKBASE_APP), "<id>123abc</id>", False),
+                            # Credentials without Splunkbase apps
+                            ({"splunk": {"apps_location": ["/tmp/app.tgz"]}, "splunkbase_username": "ocho", "splunkbase_password": "cinco"}, "<id>123abc</id>", False),
+                            ({"splunk": {"apps_location_local": "https://splunkbase.splunk.com/app/1/release/1/download"}, "splunkbase_username": "ocho", "splunkbase_password": "cinco"}, "<id>123abc</id>", True),
+                            ({"splunk": {"app_paths_install": {"idxc": ["https://splunkbase.splunk.com/app/1/release/1/download"]}}, "splunkbase_username": "ocho", "splunkbase_password": "cinco"}, "<id>123abc</id>", True),
                          ]
                         )
 def test_getSplunkbaseToken(default_yml, response_content, trigger_splunkbase):
@@ -734,12 +803,77 @@ def test_getSplunkbaseToken_exception():
     with patch("environ.requests.post") as mock_post:
         mock_post.return_value = MagicMock(status_code=400, content="error")
         try:
-            environ.getSplunkbaseToken({"splunkbase_username": "ocho", "splunkbase_password": "cinco"})
+            environ.getSplunkbaseToken(dict(SPLUNKBASE_APP, splunkbase_username="ocho", splunkbase_password="cinco"))
             assert False
         except Exception as e:
             assert True
             assert "Invalid Splunkbase credentials" in str(e)
 
+@pytest.fixture
+def splunkbase_stub():
+    """
+    Local HTTP server standing in for the Splunkbase login API
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import threading
+    logins = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            logins.append(self.rfile.read(int(self.headers["Content-Length"])))
+            body = "<feed><id>stubtoken{}</id></feed>".format(len(logins)).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    with patch("environ.SPLUNKBASE_LOGIN_URL", "http://127.0.0.1:{}/api/account:login/".format(server.server_port)):
+        yield logins
+    server.shutdown()
+    server.server_close()
+
+def test_getSplunkbaseToken_cache(tmpdir, splunkbase_stub):
+    cache_file = str(tmpdir.join("splunkbase", "token.json"))
+    os_env = {"SPLUNKBASE_USERNAME": "ocho", "SPLUNKBASE_PASSWORD": "cinco", "SPLUNKBASE_TOKEN_CACHE": cache_file}
+    with patch("os.environ", new=os_env):
+        first = dict(SPLUNKBASE_APP)
+        environ.getSplunkbaseToken(first)
+        second = dict(SPLUNKBASE_APP)
+        environ.getSplunkbaseToken(second)
+    assert len(splunkbase_stub) == 1
+    assert first["splunkbase_token"] == second["splunkbase_token"] == "stubtoken1"
+    # Neither the password nor anything derived from it is kept
+    assert json.loads(tmpdir.join("splunkbase", "token.json").read()).keys() == {"username", "token", "expires"}
+    # Another account does not reuse the cached token
+    os_env = dict(os_env, SPLUNKBASE_USERNAME="nueve")
+    with patch("os.environ", new=os_env):
+        third = dict(SPLUNKBASE_APP)
+        environ.getSplunkbaseToken(third)
+    assert len(splunkbase_stub) == 2
+    assert third["splunkbase_token"] == "stubtoken2"
+
+def test_getSplunkbaseToken_cache_expired(tmpdir, splunkbase_stub):
+    cache_file = str(tmpdir.join("token.json"))
+    os_env = {"SPLUNKBASE_USERNAME": "ocho", "SPLUNKBASE_PASSWORD": "cinco", "SPLUNKBASE_TOKEN_CACHE": cache_file, "SPLUNKBASE_TOKEN_TTL": "60"}
+    with patch("os.environ", new=os_env):
+        with patch("environ.time", return_value=1000):
+            environ.getSplunkbaseToken(dict(SPLUNKBASE_APP))
+        with patch("environ.time", return_value=1059):
+            environ.getSplunkbaseToken(dict(SPLUNKBASE_APP))
+        assert len(splunkbase_stub) == 1
+        with patch("environ.time", return_value=1060):
+            vars_scope = dict(SPLUNKBASE_APP)
+            environ.getSplunkbaseToken(vars_scope)
+    assert len(splunkbase_stub) == 2
+    assert vars_scope["splunkbase_token"] == "stubtoken2"
+
 @pytest.mark.parametrize(("default_yml", "os_env", "apps_cnt_def", "apps_cnt_shc", "apps_cnt_idc"),
                          [
                             # Check null parameters
@@ -1071,6 +1205,113 @@ def test_merge_dict(dict1, dict2, result):
     output = environ.merge_dict(dict1, dict2)
     assert output == result
 
+@pytest.mark.parametrize(("dict1", "dict2", "strategies", "result"),
+    [
+        # Check replace
+        ({"a": {"b": [1, 2]}}, {"a": {"b": [3]}}, {"a.b": "replace"}, {"a": {"b": [3]}}),
+        # Check append is the default for other paths
+        ({"a": {"b": [1, 2], "c": [1]}}, {"a": {"b": [2], "c": [1]}}, {"a.b": "append-unique"}, {"a": {"b": [1, 2], "c": [1, 1]}}),
+        # Check append-unique, including dicts and duplicates within the same layer
+        ({"a": [1, {"x": 1}]}, {"a": [{"x": 1}, 2, 2, 1]}, {"a": "append-unique"}, {"a": [1, {"x": 1}, 2]}),
+        # Check keyed merge
+        ({"splunk": {"smartstore": {"index": [{"indexName": "a", "remoteName": "r1", "s3": {"access_key": "k"}}, {"indexName": "b"}]}}},
+         {"splunk": {"smartstore": {"index": [{"indexName": "a", "s3": {"secret_key": "s"}}, {"indexName": "c"}]}}},
+         {},
+         {"splunk": {"smartstore": {"index": [{"indexName": "a", "remoteName": "r1", "s3": {"access_key": "k", "secret_key": "s"}},
+                                              {"indexName": "b"}, {"indexName": "c"}]}}}),
+        # Check keyed merge keeps entries without the key field
+        ({"l": [{"name": "a", "v": 1}, "x"]}, {"l": [{"v": 2}, {"name": "a", "v": 3}, {"name": "b"}, {"name": "b", "v": 4}]}, {"l": "keyed:name"},
+         {"l": [{"name": "a", "v": 3}, "x", {"v": 2}, {"name": "b", "v": 4}]}),
+        # Check strategies do not apply to mismatched types
+        ({"a": {"b": "x"}}, {"a": {"b": [1]}}, {"a.b": "append-unique"}, {"a": {"b": [1]}}),
+    ]
+)
+def test_merge_dict_strategies(dict1, dict2, strategies, result):
+    output = environ.merge_dict(dict1, dict2, environ.getMergeStrategies({"config": {"merge_strategies": strategies}}))
+    assert output == result
+
+@pytest.mark.parametrize(("config", "result"),
+    [
+        ({}, {"splunk": {"apps_location": "append-unique", "apps_location_local": "append-unique", "smartstore": {"index": "keyed:indexName"}}}),
+        ({"merge_strategies": None}, {"splunk": {"apps_location": "append-unique", "apps_location_local": "append-unique", "smartstore": {"index": "keyed:indexName"}}}),
+        ({"merge_strategies": {"splunk.apps_location": "append", "ansible_pre_tasks": "replace"}},
+         {"ansible_pre_tasks": "replace", "splunk": {"apps_location": "append", "apps_location_local": "append-unique", "smartstore": {"index": "keyed:indexName"}}}),
+    ]
+)
+def test_getMergeStrategies(config, result):
+    assert environ.getMergeStrategies({"config": config}) == result
+
+def test_getMergeStrategies_invalid():
+    with pytest.raises(Exception) as exc:
+        environ.getMergeStrategies({"config": {"merge_strategies": {"a.b": "prepend"}}})
+    assert "Invalid merge strategy prepend for a.b" in str(exc.value)
+
+def legacy_merge_dict(dict1, dict2):
+    for key in dict2:
+        if key in dict1 and isinstance(dict1[key], dict) and isinstance(dict2[key], dict):
+            legacy_merge_dict(dict1[key], dict2[key])
+        elif key in dict1 and isinstance(dict1[key], list) and isinstance(dict2[key], list):
+            dict1[key] += dict2[key]
+        else:
+            dict1[key] = dict2[key]
+    return dict1
+
+def random_tree(rng, depth):
+    tree = {}
+    for _ in range(rng.randint(0, 4)):
+        key = rng.choice("abcde")
+        kind = rng.random()
+        if depth and kind < 0.4:
+            tree[key] = random_tree(rng, depth - 1)
+        elif kind < 0.7:
+            # Items are unique within a layer, duplicates only come from merging layers
+            pool = [1, 2, 3, "x", {"indexName": "a", "v": rng.randint(0, 9)}, {"indexName": "b", "v": rng.randint(0, 9)}]
+            tree[key] = rng.sample(pool, rng.randint(0, 4))
+        else:
+            tree[key] = rng.randint(0, 9)
+    return tree
+
+def iter_lists(tree, path=()):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            for found in iter_lists(value, path + (key,)):
+                yield found
+        elif isinstance(value, list):
+            yield path + (key,), value
+
+@pytest.mark.parametrize("seed", range(50))
+def test_merge_dict_properties(seed):
+    import copy
+    import random
+    rng = random.Random(seed)
+    layers = [random_tree(rng, 4) for _ in range(3)]
+    # Default strategy matches the recursive implementation
+    expected = {}
+    merged = {}
+    for layer in layers:
+        legacy_merge_dict(expected, copy.deepcopy(layer))
+        environ.merge_dict(merged, copy.deepcopy(layer))
+    assert merged == expected
+    # append-unique never introduces duplicates and keeps every item seen
+    paths = [".".join(path) for layer in layers for path, _ in iter_lists(layer)]
+    strategies = environ.getMergeStrategies({"config": {"merge_strategies": {path: "append-unique" for path in paths}}})
+    unique = {}
+    for layer in layers:
+        environ.merge_dict(unique, copy.deepcopy(layer), strategies)
+    for path, value in iter_lists(unique):
+        assert all(value.count(item) == 1 for item in value)
+    # Merging the same layer again is idempotent
+    again = environ.merge_dict(copy.deepcopy(unique), copy.deepcopy(layers[-1]), strategies)
+    assert again == unique
+    # keyed merges leave at most one entry per key
+    strategies = environ.getMergeStrategies({"config": {"merge_strategies": {path: "keyed:indexName" for path in paths}}})
+    keyed = {}
+    for layer in layers:
+        environ.merge_dict(keyed, copy.deepcopy(layer), strategies)
+    for path, value in iter_lists(keyed):
+        names = [item["indexName"] for item in value if isinstance(item, dict)]
+        assert len(names) == len(set(names))
+
 @pytest.mark.parametrize(("source", "merge_url_called", "merge_file_called"),
             [
                 (None, False, False),
@@ -1165,12 +1406,153 @@ def test_mergeDefaultsFromURL(vars_scope, content, os_env, headers, verify):
     expected_headers = {}
     if headers:
         expected_headers.update(headers)
-    if os_env and "SPLUNK_DEFAULTS_HTTP_AUTH_HEADER" is os_env:
+    if os_env and "SPLUNK_DEFAULTS_HTTP_AUTH_HEADER" in os_env:
         expected_headers["Authorization"] = os_env["SPLUNK_DEFAULTS_HTTP_AUTH_HEADER"]
     mock_get.assert_called_once()
     mock_get.assert_called_with("http://website", headers=expected_headers, timeout=vars_scope["config"]["max_timeout"], verify=verify)
     mock_merge.assert_called_once()
-    mock_merge.assert_called_with(vars_scope, "helloworld")
+    mock_merge.assert_called_with(vars_scope, "helloworld", environ.getMergeStrategies(vars_scope))
+
+def test_fetchDefaultsFromURL_mirror(tmpdir):
+    vars_scope = {"config": {"max_retries": 0, "max_delay": 0, "max_timeout": 5, "mirror_dir": str(tmpdir)}}
+    first = MagicMock(status_code=200, content="hello: world", headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    second = MagicMock(status_code=304, content="", headers={"ETag": '"v1"'})
+    with patch("os.environ", new={}):
+        with patch("environ.requests.get", side_effect=[first, second]) as mock_get:
+            assert environ.fetchDefaultsFromURL(vars_scope, "http://web/default.yml") == {"hello": "world"}
+            with patch("environ.loadYAML") as mock_load:
+                assert environ.fetchDefaultsFromURL(vars_scope, "http://web/default.yml") == {"hello": "world"}
+                mock_load.assert_not_called()
+    _, kwargs = mock_get.call_args_list[0]
+    assert "If-None-Match" not in kwargs["headers"]
+    _, kwargs = mock_get.call_args_list[1]
+    assert kwargs["headers"]["If-None-Match"] == '"v1"'
+    assert kwargs["headers"]["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert environ.urlValidators["http://web/default.yml"]["etag"] == '"v1"'
+
+@pytest.mark.parametrize(("serve_stale", "has_mirror", "raises"),
+            [
+                (False, False, True),
+                (False, True, True),
+                ("True", False, True),
+                ("True", True, False),
+            ]
+        )
+def test_fetchDefaultsFromURL_serve_stale(tmpdir, serve_stale, has_mirror, raises):
+    vars_scope = {"config": {"max_retries": 1, "max_delay": 0, "max_timeout": 5, "mirror_dir": str(tmpdir), "serve_stale": serve_stale}}
+    if has_mirror:
+        environ.saveDefaultsMirror(str(tmpdir), "http://web/default.yml", {"etag": '"v1"'}, {"hello": "stale"})
+    with patch("os.environ", new={}):
+        with patch("environ.sleep"):
+            with patch("environ.requests.get", side_effect=requests.exceptions.ConnectionError("down")) as mock_get:
+                if raises:
+                    with pytest.raises(requests.exceptions.ConnectionError):
+                        environ.fetchDefaultsFromURL(vars_scope, "http://web/default.yml")
+                else:
+                    assert environ.fetchDefaultsFromURL(vars_scope, "http://web/default.yml") == {"hello": "stale"}
+    assert mock_get.call_count == 2
+
+@pytest.mark.parametrize(("max_retries", "max_delay", "max_elapsed", "expected_retries"),
+            [
+                (0, 60, 1200, 0),
+                (3, 60, 1200, 3),
+                # Unlimited retries are still bounded by the deadline
+                (-1, 0, 0, 0),
+            ]
+        )
+def test_RetryPolicy_limits(max_retries, max_delay, max_elapsed, expected_retries):
+    policy = environ.RetryPolicy(max_retries, max_delay, max_elapsed)
+    with patch("environ.random.uniform", return_value=0):
+        delays = []
+        while len(delays) < 10:
+            delay = policy.nextDelay()
+            if delay is None:
+                break
+            delays.append(delay)
+    assert len(delays) == expected_retries
+    assert policy.retries == expected_retries
+
+def test_RetryPolicy_backoff():
+    policy = environ.RetryPolicy(10, 5, 1200, base_delay=1)
+    with patch("environ.random.uniform", side_effect=lambda low, high: high) as mock_uniform:
+        delays = [policy.nextDelay() for _ in range(5)]
+    # Full jitter draws from [0, min(cap, base * 2^n)]
+    assert delays == [1, 2, 4, 5, 5]
+    assert all(args[0] == 0 for args, _ in mock_uniform.call_args_list)
+
+def test_RetryPolicy_deadline():
+    with patch("environ.time", return_value=100):
+        policy = environ.RetryPolicy(-1, 60, 30)
+    with patch("environ.time", return_value=110):
+        assert policy.timeout() == 20
+        with patch("environ.random.uniform", return_value=25):
+            assert policy.nextDelay() is None
+        with patch("environ.random.uniform", return_value=5):
+            assert policy.nextDelay() == 5
+
+@pytest.mark.parametrize(("os_env", "max_retries", "max_delay", "max_elapsed"),
+            [
+                ({}, 3, 60, 1200),
+                ({"SPLUNK_DEFAULTS_HTTP_MAX_RETRIES": "-1", "SPLUNK_DEFAULTS_HTTP_MAX_DELAY": "5", "SPLUNK_DEFAULTS_HTTP_MAX_TIMEOUT": "30"}, -1, 5, 30),
+            ]
+        )
+def test_RetryPolicy_fromConfig(os_env, max_retries, max_delay, max_elapsed):
+    with patch("os.environ", new=os_env):
+        policy = environ.RetryPolicy.fromConfig({"max_retries": 3, "max_delay": 60, "max_timeout": 1200})
+    assert policy.max_retries == max_retries
+    assert policy.max_delay == max_delay
+    assert policy.max_elapsed == max_elapsed
+
+def test_fetchDefaultsFromURL_stats():
+    vars_scope = {"config": {"max_retries": 2, "max_delay": 0, "max_timeout": 5}}
+    ok = MagicMock(status_code=200, content="a: b", headers={})
+    with patch("os.environ", new={}):
+        with patch("environ.sleep"):
+            with patch("environ.requests.get", side_effect=[requests.exceptions.ConnectionError("down"), ok]):
+                environ.fetchDefaultsFromURL(vars_scope, "https://user:pw@web/default.yml?token=abc")
+    stats = environ.urlFetchStats["https://user:pw@web/default.yml?token=abc"]
+    assert stats["url"] == "https://web/default.yml"
+    assert stats["attempts"] == 2
+    assert stats["retries"] == 1
+    assert stats["result"] == "fetched"
+
+def test_fetchDefaultsConcurrently_preserves_order():
+    import time
+    delays = {"http://web/1.yml": 0.2, "http://web/2.yml": 0.1, "http://web/3.yml": 0}
+    def fake_fetch(vars_scope, url, headers, verify):
+        time.sleep(delays[url])
+        return {"value": url, url: True}
+    base = {"config": {"max_workers": 4, "host": {"headers": {"A": "B"}, "verify": True},
+                       "baked": None, "env": None}}
+    ymls = [{"key": "host", "src": url} for url in sorted(delays)]
+    with patch("os.environ", new={}):
+        with patch("environ.fetchDefaultsFromURL", side_effect=fake_fetch) as mock_fetch:
+            with patch("environ.loadBaseDefaults", return_value=base):
+                with patch("environ.loadHostDefaults", return_value=ymls):
+                    result = environ.loadDefaults()
+    assert mock_fetch.call_count == 3
+    mock_fetch.assert_any_call(base, "http://web/1.yml", {"A": "B"}, True)
+    # Last declared source wins regardless of completion order
+    assert result["value"] == "http://web/3.yml"
+    assert all(result[url] for url in delays)
+
+@pytest.mark.parametrize(("ymls", "os_env", "fetch_count"),
+            [
+                ([], {}, 0),
+                # A single remote source is fetched by mergeDefaults() as before
+                ([{"key": "env", "src": "http://web/1.yml"}], {}, 0),
+                ([{"key": "env", "src": "http://web/1.yml"}, {"key": "env", "src": "/tmp/default.yml"}], {}, 0),
+                ([{"key": "env", "src": "http://web/1.yml"}, {"key": "env", "src": "HTTP://WEB/1.yml"}], {}, 0),
+                ([{"key": "env", "src": "http://web/1.yml"}, {"key": "env", "src": "http://web/2.yml"}], {}, 2),
+                ([{"key": "env", "src": "http://web/1.yml"}, {"key": "env", "src": "http://web/2.yml"}], {"SPLUNK_DEFAULTS_HTTP_MAX_WORKERS": "1"}, 0),
+            ]
+        )
+def test_fetchDefaultsConcurrently(ymls, os_env, fetch_count):
+    with patch("os.environ", new=os_env):
+        with patch("environ.fetchDefaultsFromURL", return_value={"a": 1}) as mock_fetch:
+            result = environ.fetchDefaultsConcurrently({"config": {}}, ymls)
+    assert mock_fetch.call_count == fetch_count
+    assert len(result) == fetch_count
 
 @pytest.mark.parametrize(("file", "file_exists", "merge_called"),
             [
@@ -1231,6 +1613,135 @@ def test_loadDefaults(mock_base, mock_baked, mock_env, mock_host, merge_call_cou
                         output = environ.loadDefaults()
                         assert mock_merge.call_count == merge_call_count
 
+def test_loadDefaults_cache_hit_and_miss(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    baked = tmpdir.join("default.yml")
+    baked.write("splunk:\n    password: helloworld\n")
+    # Sources are lowercased by mergeDefaults(), so resolve them relative to the tmpdir
+    mbase = MagicMock(side_effect=lambda: {"config": {"baked": "default.yml", "defaults_dir": "."}, "splunk": {}})
+    with tmpdir.as_cwd(), patch("environ.loadBaseDefaults", mbase):
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir}):
+            first = environ.loadDefaults()
+            with patch("environ.mergeDefaults") as mock_merge:
+                second = environ.loadDefaults()
+                mock_merge.assert_not_called()
+            stats = environ.readDefaultsCacheStats(cache_dir)
+    assert mbase.call_count == 1
+    assert first == second
+    assert second["splunk"]["password"] == "helloworld"
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["last_result"] == "hit"
+
+def test_loadDefaults_cache_stale_file(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    baked = tmpdir.join("default.yml")
+    baked.write("splunk:\n    password: helloworld\n")
+    mbase = MagicMock(side_effect=lambda: {"config": {"baked": "default.yml", "defaults_dir": "."}, "splunk": {}})
+    with tmpdir.as_cwd(), patch("environ.loadBaseDefaults", mbase):
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir}):
+            environ.loadDefaults()
+            baked.write("splunk:\n    password: changedpassword\n")
+            result = environ.loadDefaults()
+            stats = environ.readDefaultsCacheStats(cache_dir)
+    assert mbase.call_count == 2
+    assert result["splunk"]["password"] == "changedpassword"
+    assert stats["misses"] == 2
+    assert stats["last_reason"] == "stale"
+
+@pytest.mark.parametrize(("os_env", "reason"),
+            [
+                ({"SPLUNK_DEFAULTS_CACHE_INVALIDATE": "true"}, "invalidated"),
+                ({"SPLUNK_ROLE": "splunk_indexer"}, "missing"),
+            ]
+        )
+def test_loadDefaults_cache_invalidation(tmpdir, os_env, reason):
+    cache_dir = str(tmpdir.join("cache"))
+    mbase = MagicMock(side_effect=lambda: {"config": {}, "splunk": {}})
+    with patch("environ.loadBaseDefaults", mbase):
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir}):
+            environ.loadDefaults()
+        os_env["SPLUNK_DEFAULTS_CACHE_DIR"] = cache_dir
+        with patch("os.environ", new=os_env):
+            environ.loadDefaults()
+    assert mbase.call_count == 2
+    assert environ.readDefaultsCacheStats(cache_dir)["last_reason"] == reason
+
+def test_loadDefaults_cache_after_invalidation(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    passwords = iter(["old", "new"])
+    mbase = MagicMock(side_effect=lambda: {"config": {}, "splunk": {"password": next(passwords)}})
+    with patch("environ.loadBaseDefaults", mbase):
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir}):
+            environ.loadDefaults()
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir, "SPLUNK_DEFAULTS_CACHE_INVALIDATE": "true",
+                                      "SPLUNK_DEFAULTS_HTTP_MAX_RETRIES": "3"}):
+            assert environ.loadDefaults()["splunk"]["password"] == "new"
+        # The next run is served what the invalidated one rebuilt
+        with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": cache_dir}):
+            assert environ.loadDefaults()["splunk"]["password"] == "new"
+    assert mbase.call_count == 2
+    assert len([f for f in os.listdir(cache_dir) if f.startswith("defaults-")]) == 1
+    assert environ.readDefaultsCacheStats(cache_dir)["last_result"] == "hit"
+
+@pytest.mark.parametrize(("os_env", "same_key"),
+            [
+                ({"SPLUNK_DEFAULTS_CACHE_INVALIDATE": "true"}, True),
+                ({"SPLUNK_DEFAULTS_HTTP_MAX_TIMEOUT": "30", "SPLUNK_DEFAULTS_HTTP_SERVE_STALE": "true"}, True),
+                ({"SPLUNK_DEFAULTS_URL": "http://config/default.yml"}, False),
+                ({"SPLUNK_ROLE": "splunk_indexer"}, False),
+            ]
+        )
+def test_getDefaultsCacheKey(os_env, same_key):
+    with patch("os.environ", new={"SPLUNK_DEFAULTS_CACHE_DIR": "/tmp/cache"}):
+        key = environ.getDefaultsCacheKey()
+    with patch("os.environ", new=dict(os_env, SPLUNK_DEFAULTS_CACHE_DIR="/tmp/other")):
+        assert (environ.getDefaultsCacheKey() == key) == same_key
+
+@pytest.mark.parametrize(("cached_etag", "current_etag", "head_fails", "valid"),
+            [
+                ('"abc"', '"abc"', False, True),
+                ('"abc"', '"def"', False, False),
+                ('"abc"', '"abc"', True, False),
+            ]
+        )
+def test_isDefaultsSourceValid_url(cached_etag, current_etag, head_fails, valid):
+    source = {"type": "url", "key": "host", "url": "http://web/default.yml", "etag": cached_etag, "last_modified": None}
+    defaults = {"config": {"max_timeout": 5, "host": {"headers": {"A": "B"}, "verify": True}}}
+    mock_response = MagicMock()
+    mock_response.headers = {"ETag": current_etag}
+    if head_fails:
+        mock_response.raise_for_status = MagicMock(side_effect=requests.exceptions.HTTPError("500"))
+    with patch("os.environ", new={}):
+        with patch("environ.requests.head", return_value=mock_response) as mock_head:
+            assert environ.isDefaultsSourceValid(source, defaults) == valid
+    mock_head.assert_called_with("http://web/default.yml", headers={"A": "B"}, timeout=5, verify=True)
+
+def test_describeDefaultsSource_url_without_validators():
+    with patch("environ.urlValidators", new={"http://web/default.yml": {"etag": None, "last_modified": None}}):
+        assert environ.describeDefaultsSource({"key": "host", "src": "http://web/default.yml"}) is None
+
+def test_invalidateDefaultsCache(tmpdir):
+    tmpdir.join("defaults-abc.json").write("{}")
+    tmpdir.join("stats.json").write("{}")
+    environ.invalidateDefaultsCache(str(tmpdir))
+    assert not tmpdir.join("defaults-abc.json").check()
+    assert tmpdir.join("stats.json").check()
+
+def test_loadYAML():
+    content = """
+opt: &opt /opt
+home: &home !!python/object/apply:os.path.join [*opt, "splunk"]
+exec: !!python/object/apply:os.path.join [*home, "bin", "splunk"]
+list: [1, "two", true]
+"""
+    result = environ.loadYAML(content)
+    assert result == {"opt": "/opt", "home": "/opt/splunk", "exec": "/opt/splunk/bin/splunk", "list": [1, "two", True]}
+
+def test_loadYAML_rejects_arbitrary_python_tags():
+    with pytest.raises(environ.yaml.constructor.ConstructorError):
+        environ.loadYAML("foo: !!python/object/apply:os.system ['echo hello']")
+
 @pytest.mark.parametrize(("os_env", "filename"),
             [
                 ({}, "splunk_defaults"),
@@ -1323,6 +1834,40 @@ def test_obfuscate_vars(inputInventory, outputInventory):
     result = environ.obfuscate_vars(inputInventory)
     assert result == outputInventory
 
+@pytest.mark.parametrize(("compact", "localhost"),
+            [
+                (False, {"splunk": {"role": "splunk_standalone"}, "ansible_connection": "local"}),
+                (True, {}),
+            ]
+        )
+def test_dumpInventory(compact, localhost):
+    import json
+    all_vars = {"splunk": {"role": "splunk_standalone"}, "ansible_connection": "local"}
+    inventory = {"_meta": {"hostvars": {"localhost": all_vars, "other": {"a": 1}}},
+                 "all": {"hosts": ["localhost"], "children": ["ungrouped"], "vars": all_vars}}
+    result = json.loads(environ.dumpInventory(inventory, compact))
+    assert result["all"]["vars"] == all_vars
+    assert result["_meta"]["hostvars"] == {"localhost": localhost, "other": {"a": 1}}
+    # The inventory itself is left untouched
+    assert inventory["_meta"]["hostvars"]["localhost"] is all_vars
+    # Without hostvars there is nothing to compact
+    assert json.loads(environ.dumpInventory({"all": {"vars": all_vars}}, compact)) == {"all": {"vars": all_vars}}
+
+@pytest.mark.parametrize("content",
+            [
+                {"a": [1, "b", None, True], "c": {"d": 1.5}},
+                {1: "int keys"},
+                # Beyond 64-bit integers are left to json
+                {"big": 2**70},
+            ]
+        )
+def test_dumpJSON(content):
+    import json
+    expected = json.loads(json.dumps(content))
+    assert json.loads(environ.dumpJSON(content)) == expected
+    with patch("environ.orjson", new=None):
+        assert environ.dumpJSON(content) == json.dumps(content)
+
 @pytest.mark.skip(reason="TODO")
 def test_create_parser():
     pass
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+Unit tests for ansible_commands/shc_ready.py
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import pytest
+import requests
+from mock import patch, MagicMock
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add shc_ready.py and splunk_api.py into path for testing
+sys.path.append(os.path.join(REPO_DIR, "ansible_commands"))
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import shc_ready
+import splunk_api
+
+def get_module(**params):
+    module = MagicMock()
+    module.params = dict({"captain_url": "sh1", "shc_peers": ["sh1", "sh2"], "spl_user": "admin", "spl_pass": "helloworld", "circuit": None}, **params)
+    return module
+
+def status(peers, status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = {"entry": [{"content": {"peers": peers}}]}
+    return response
+
+READY = {"sh1": {"last_conf_replication": "Success"}, "sh2": {"last_conf_replication": "Success"}}
+
+@pytest.fixture
+def state(tmpdir):
+    path = str(tmpdir.join("state", "circuits.json"))
+    with patch.dict(os.environ, {"SPLUNK_API_CIRCUIT_STATE": path}):
+        yield path
+
+def test_defaults_match_splunk_api():
+    assert shc_ready.CIRCUIT_DEFAULTS == splunk_api.CIRCUIT_DEFAULTS
+    assert shc_ready.CIRCUIT_STATE_PATH == splunk_api.CIRCUIT_STATE_PATH
+
+@pytest.fixture
+def mock_get():
+    with patch("shc_ready.requests.Session") as mock_session:
+        yield mock_session.return_value.get
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch("shc_ready.time.time", clock.time), patch("shc_ready.time.sleep", clock.sleep):
+        yield clock
+
+def test_run(mock_get, state):
+    mock_get.return_value = status(READY)
+    facts = shc_ready.ShcReady(get_module()).run()
+    assert facts[5] == ["sh1", "sh2"]
+    mock_get.return_value = status(dict(READY, sh2={"last_conf_replication": "Pending"}))
+    with pytest.raises(Exception, match="online_peers"):
+        shc_ready.ShcReady(get_module()).run()
+    # Without circuit, nothing is recorded
+    assert not os.path.exists(state)
+
+def test_run_circuit(mock_get, state):
+    mock_get.side_effect = requests.exceptions.ConnectionError("Connection refused")
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            shc_ready.ShcReady(get_module(circuit={"threshold": 2})).run()
+    with pytest.raises(Exception, match="Circuit open for https://sh1:8089: 2 consecutive failures"):
+        shc_ready.ShcReady(get_module(circuit={"threshold": 2})).run()
+    assert mock_get.call_count == 2
+    # The probe, once the cooldown is over, closes the circuit when the captain answers, even not ready yet
+    mock_get.side_effect = None
+    mock_get.return_value = status({"sh1": {}})
+    with patch("shc_ready.time.time", return_value=time.time() + 10):
+        with pytest.raises(Exception, match="Insufficient number of peers"):
+            shc_ready.ShcReady(get_module(circuit={"threshold": 2})).run()
+    mock_get.return_value = status(READY)
+    shc_ready.ShcReady(get_module(circuit={"threshold": 2})).run()
+
+def test_circuit_shared_with_splunk_api(mock_get, state):
+    # splunk_api found the captain down, shc_ready does not call it
+    circuit = splunk_api.get_circuit({"threshold": 1}, state)
+    splunk_api.report_circuit(circuit, "https://sh1:8089", False)
+    with pytest.raises(Exception, match="Circuit open"):
+        shc_ready.ShcReady(get_module(circuit={"threshold": 1})).run()
+    assert not mock_get.called
+    # and the other way around
+    mock_get.return_value = status({}, 503)
+    with patch("shc_ready.time.time", return_value=time.time() + 10):
+        with pytest.raises(Exception):
+            shc_ready.ShcReady(get_module(circuit={"threshold": 1})).run()
+    with patch("splunk_api.time.time", return_value=time.time() + 10):
+        assert splunk_api.acquire_circuit(circuit, "https://sh1:8089") == "2 consecutive failures, next probe in 20s"
+
+def test_session_reused(state):
+    with patch("shc_ready.requests.Session") as mock_session:
+        mock_session.return_value.get.return_value = status(READY)
+        shc = shc_ready.ShcReady(get_module())
+        shc.run()
+        shc.run()
+    assert mock_session.call_count == 1
+    assert mock_session.return_value.auth == ("admin", "helloworld")
+    assert mock_session.return_value.verify is False
+    assert mock_session.return_value.get.call_count == 2
+
+def test_wait(mock_get, state, clock):
+    pending = {"last_conf_replication": "Pending"}
+    mock_get.side_effect = [
+        status({"sh1": dict(pending, label="sh1")}),
+        status({"sh1": dict(pending, label="sh1"), "sh2": dict(pending, label="sh2")}),
+        status({"sh1": dict(pending, label="sh1"), "sh2": dict(pending, label="sh2")}),
+        status({"sh1": dict(pending, label="sh1"), "sh2": dict(pending, label="sh2")}),
+        status({"sh1": {"label": "sh1", "last_conf_replication": "Success"}, "sh2": dict(pending, label="sh2")}),
+        status({"sh1": {"label": "sh1", "last_conf_replication": "Success"}, "sh2": {"label": "sh2", "last_conf_replication": "Success"}}),
+    ]
+    facts, report = shc_ready.ShcReady(get_module(timeout=60, interval=1, backoff=2, max_interval=3)).wait()
+    assert facts[5] == ["sh1", "sh2"]
+    # Back to the minimum interval on every change, backing off while nothing moves
+    assert clock.sleeps == [1, 1, 2, 3, 1]
+    assert report["attempts"] == 6
+    assert report["time_to_ready"] == 8
+    assert report["ready_at"] == {"sh1": 7, "sh2": 8}
+    assert report["stragglers"] == ["sh2"]
+    assert report["missing"] == 0
+    assert [(t["peer"], t["from"], t["to"], t["at"]) for t in report["transitions"]] == [
+        ("sh1", None, "Pending", 0),
+        ("sh2", None, "Pending", 1),
+        ("sh1", "Pending", "Success", 7),
+        ("sh2", "Pending", "Success", 8),
+    ]
+
+def test_wait_ready_at_once(mock_get, state, clock):
+    mock_get.return_value = status(READY)
+    facts, report = shc_ready.ShcReady(get_module(timeout=60)).wait()
+    assert facts[5] == ["sh1", "sh2"]
+    assert report["attempts"] == 1
+    assert report["time_to_ready"] == 0
+    assert report["stragglers"] == []
+    assert clock.sleeps == []
+
+def test_wait_status_timeout(mock_get, state, clock):
+    # The requests of a wait end by its deadline
+    mock_get.return_value = status({"sh1": {"last_conf_replication": "Pending"}})
+    shc_ready.ShcReady(get_module(timeout=14, interval=6, backoff=1)).wait()
+    # At least a second for the last one
+    assert [c[1]["timeout"] for c in mock_get.call_args_list] == [10, 8, 2, 1]
+    mock_get.return_value = status(READY)
+    shc_ready.ShcReady(get_module()).run()
+    assert mock_get.call_args[1]["timeout"] == shc_ready.STATUS_TIMEOUT
+
+def test_wait_timeout(mock_get, state, clock):
+    mock_get.side_effect = [requests.exceptions.ConnectionError("Connection refused")] + \
+        [status({"sh1": {"last_conf_replication": "Pending"}})] * 10
+    facts, report = shc_ready.ShcReady(get_module(timeout=10, interval=2, backoff=2, max_interval=4)).wait()
+    assert facts is None
+    # Failures back off, the first answer brings the interval back down
+    assert clock.sleeps == [4, 2, 4]
+    assert report["attempts"] == 4
+    assert report["stragglers"] == ["sh1"]
+    assert report["missing"] == 1
+    assert "Insufficient number of peers" in report["error"]
+    assert "time_to_ready" not in report
+
+def test_wait_circuit(mock_get, state, clock):
+    # An open circuit is waited out rather than failing the wait, for no longer than max_interval
+    with patch("splunk_api.time.time", clock.time):
+        splunk_api.report_circuit(splunk_api.get_circuit({"threshold": 1, "cooldown": 300}, state), "https://sh1:8089", False)
+    mock_get.return_value = status(READY)
+    facts, report = shc_ready.ShcReady(get_module(timeout=60, interval=5, max_interval=5, circuit={"threshold": 1})).wait()
+    assert facts[5] == ["sh1", "sh2"]
+    assert mock_get.call_count == 1
+    assert report["attempts"] == 2
+    assert report["time_to_ready"] == 5
+
+@pytest.mark.parametrize("up_at", [0, 100, 175, 340])
+def test_wait_circuit_captain_back(mock_get, state, clock, up_at):
+    # The values of the deployer role, the captain failing until up_at
+    polls = []
+    def get(url, timeout=None):
+        polls.append(clock.now - 1000)
+        if clock.now - 1000 < up_at:
+            return status({}, 503)
+        return status(READY)
+    mock_get.side_effect = get
+    facts, report = shc_ready.ShcReady(get_module(timeout=360, max_interval=6, circuit={})).wait()
+    assert facts[5] == ["sh1", "sh2"]
+    # Seen within an interval of coming back, however long it failed
+    assert polls[-1] - up_at < 6
+    assert all(b - a <= 6 for a, b in zip(polls, polls[1:]))
+
+@pytest.mark.parametrize(("quorum", "peers", "expected"), [
+    (None, 5, 5),
+    ("", 5, 5),
+    ("3", 5, 3),
+    (" 5 ", 5, 5),
+    ("80%", 5, 4),
+    ("70%", 10, 7),
+    ("50%", 3, 2),
+    ("1%", 3, 1),
+    ("100%", 3, 3),
+])
+def test_get_quorum(quorum, peers, expected):
+    assert shc_ready.get_quorum(quorum, peers) == expected
+
+@pytest.mark.parametrize(("quorum", "error"), [
+    ("all", "expected a number of peers or a percentage"),
+    ("0", "expected between 1 and 3 peers"),
+    ("4", "expected between 1 and 3 peers"),
+    ("0%", "expected between 1 and 3 peers"),
+    ("150%", "expected between 1 and 3 peers"),
+])
+def test_get_quorum_invalid(quorum, error):
+    with pytest.raises(ValueError, match=error):
+        shc_ready.get_quorum(quorum, 3)
+
+def member(status="Up", last_conf_replication="Success", status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = {"entry": [{"content": {"status": status, "last_conf_replication": last_conf_replication}}]}
+    return response
+
+def route(captain, members):
+    def get(url, **kwargs):
+        if "/shcluster/status" in url:
+            return captain
+        member = members[url.split("/")[2]]
+        if isinstance(member, Exception):
+            raise member
+        return member
+    return get
+
+PEERS = dict(("sh{0}".format(i), {"label": "sh{0}".format(i), "mgmt_uri": "https://sh{0}:8089".format(i), "last_conf_replication": "Success"})
+             for i in range(1, 5))
+
+def test_quorum(mock_get, state):
+    peers = dict(PEERS, sh4=dict(PEERS["sh4"], last_conf_replication="Pending"))
+    mock_get.return_value = status(peers)
+    module = get_module(shc_peers=sorted(PEERS))
+    with pytest.raises(Exception, match="online_peers"):
+        shc_ready.ShcReady(module).run()
+    module.params["quorum"] = "75%"
+    assert sorted(shc_ready.ShcReady(module).run()[5]) == ["sh1", "sh2", "sh3"]
+
+def test_probe_members(mock_get, state):
+    mock_get.side_effect = route(status(PEERS), {
+        "sh1:8089": member(),
+        "sh2:8089": member(status="Down"),
+        "sh3:8089": requests.exceptions.ConnectionError("Connection refused"),
+        "sh4:8089": member(last_conf_replication="Pending"),
+    })
+    shc = shc_ready.ShcReady(get_module(shc_peers=sorted(PEERS), probe_threads=4, quorum="1"))
+    assert shc.run()[5] == ["sh1"]
+    assert shc.unconfirmed == {"sh2": "Status Down", "sh3": "Connection refused", "sh4": "Pending"}
+    member_calls = [c for c in mock_get.call_args_list if "member/info" in c[0][0]]
+    assert len(member_calls) == 4
+    assert all(c[1]["timeout"] == shc_ready.MEMBER_PROBE_TIMEOUT for c in member_calls)
+
+def test_probe_skips_pending(mock_get, state):
+    # Only the peers the captain sees ready are probed
+    peers = dict(PEERS, sh4=dict(PEERS["sh4"], last_conf_replication="Pending"), sh3=dict(PEERS["sh3"], mgmt_uri=None))
+    mock_get.side_effect = route(status(peers), {"sh1:8089": member(), "sh2:8089": member(status_code=503)})
+    shc = shc_ready.ShcReady(get_module(shc_peers=sorted(PEERS), probe_threads=2, quorum="50%"))
+    with pytest.raises(Exception, match="online_peers"):
+        shc.run()
+    assert shc.unconfirmed == {"sh2": "HTTP 503", "sh3": "No mgmt_uri"}
+    assert len([c for c in mock_get.call_args_list if "member/info" in c[0][0]]) == 2
+
+def test_wait_quorum(mock_get, state, clock):
+    members = dict(("sh{0}:8089".format(i), member()) for i in range(1, 5))
+    members["sh4:8089"] = member(status="Down")
+    mock_get.side_effect = route(status(PEERS), members)
+    facts, report = shc_ready.ShcReady(get_module(shc_peers=sorted(PEERS), timeout=60, probe_threads=4)).wait()
+    assert facts is None
+    assert report["stragglers"] == ["sh4"]
+    assert report["unconfirmed"] == {"sh4": "Status Down"}
+    assert report["required"] == 4
+    mock_get.side_effect = route(status(PEERS), members)
+    facts, report = shc_ready.ShcReady(get_module(shc_peers=sorted(PEERS), timeout=60, probe_threads=4, quorum="3")).wait()
+    assert sorted(facts[5]) == ["sh1", "sh2", "sh3"]
+    assert report["attempts"] == 1
+    assert report["stragglers"] == []
+    assert report["left_behind"] == ["sh4"]
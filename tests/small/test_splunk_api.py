@@ -0,0 +1,1252 @@
+#!/usr/bin/env python
+'''
+Unit tests for library/splunk_api.py
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import base64
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import threading
+import pytest
+from mock import patch, MagicMock
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import parse_qs
+    from urllib import unquote
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add splunk_api.py into path for testing
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_api
+
+class FakeSplunkdHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        self.handled = 0
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.handled += 1
+        if self.server.keepalive_requests and self.handled >= self.server.keepalive_requests:
+            self.send_header("Connection", "close")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        authorization = self.headers.get("Authorization") or ""
+        if authorization.startswith("Splunk "):
+            return authorization[len("Splunk "):] in self.server.session_keys
+        if authorization.startswith("Basic "):
+            return base64.b64decode(authorization[len("Basic "):]).decode("utf-8") == "admin:" + self.server.password
+        return False
+
+    def entity(self):
+        # Collection registered by the test and name of the entity the request is for, if any
+        path = self.path.split("?")[0]
+        for collection in self.server.collections:
+            if path == collection:
+                return collection, None
+            if path.startswith(collection + "/"):
+                return collection, unquote(path[len(collection) + 1:])
+        return None, None
+
+    def reply_entity(self, status, collection, name):
+        self.reply(status, {"entry": [{"name": name, "links": {"edit": "{}/{}".format(collection, name)},
+                                       "content": self.server.collections[collection][name]}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        collection, name = self.entity()
+        if collection is not None and self.authorized():
+            self.server.requests.append((self.command, self.path, body))
+            entities = self.server.collections[collection]
+            settings = dict((k, v[0] if len(v) == 1 else v) for k, v in parse_qs(body, keep_blank_values=True).items())
+            if name is None:
+                name = settings.pop("name")
+                if name in entities:
+                    return self.reply(409, {"messages": [{"type": "ERROR", "text": "An object with name={} already exists".format(name)}]})
+                entities[name] = settings
+                return self.reply_entity(201, collection, name)
+            if name not in entities:
+                return self.reply(404, {"messages": [{"type": "ERROR", "text": "Not Found"}]})
+            entities[name].update(settings)
+            return self.reply_entity(200, collection, name)
+        self.server.requests.append((self.command, self.path, self.headers.get("Authorization")))
+        if self.path == "/services/auth/login" and self.server.login_enabled:
+            form = parse_qs(body)
+            if form.get("username") != ["admin"] or form.get("password") != [self.server.password]:
+                return self.reply(401, {"messages": [{"type": "WARN", "text": "Login failed"}]})
+            key = "key{}".format(len(self.server.session_keys))
+            self.server.session_keys.append(key)
+            return self.reply(200, {"sessionKey": key})
+        if not self.authorized():
+            return self.reply(401, {"messages": [{"type": "WARN", "text": "call not properly authenticated"}]})
+        if self.path.startswith("/services/search/distributed/groups"):
+            return self.reply(201, {"form": parse_qs(body)})
+        self.reply(404, {"messages": [{"type": "ERROR", "text": "Not Found"}]})
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.headers.get("Authorization")))
+        collection, name = self.entity()
+        if not self.authorized():
+            self.reply(401, {"messages": [{"type": "WARN", "text": "call not properly authenticated"}]})
+        elif collection is not None:
+            if name in self.server.collections[collection]:
+                self.reply_entity(200, collection, name)
+            else:
+                self.reply(404, {"messages": [{"type": "ERROR", "text": "Not Found"}]})
+        elif self.path.startswith("/services/cluster/master/peers"):
+            # One more peer joins on each call
+            self.server.peer_calls += 1
+            self.reply(200, {"entry": [{"name": "peer{}".format(i), "content": {"status": "Up"}} for i in range(min(self.server.peer_calls, 3))]})
+        elif self.path.startswith("/services/apps/local"):
+            self.reply(200, {"entry": [{"name": "app{}".format(i), "content": {"version": "1.0", "disabled": False, "description": "x" * 100}}
+                                       for i in range(200)]})
+        elif self.path.startswith("/services/server/info"):
+            self.reply(200, {"entry": [{"content": {"version": "8.1.0"}}]})
+        else:
+            self.reply(404, {"messages": [{"type": "ERROR", "text": "Not Found"}]})
+
+    def log_message(self, *args):
+        pass
+
+class FakeSplunkd(ThreadingMixIn, HTTPServer):
+    # Keep-alive connections held by the broker must not block shutdown
+    daemon_threads = True
+
+class FakeSplunkdUnix(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def serve_splunkd(server):
+    server.requests = []
+    server.password = "helloworld"
+    server.session_keys = []
+    server.login_enabled = True
+    server.connections = 0
+    server.peer_calls = 0
+    server.collections = {}
+    server.keepalive_requests = 0
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return server
+
+@pytest.fixture
+def splunkd():
+    server = serve_splunkd(FakeSplunkd(("127.0.0.1", 0), FakeSplunkdHandler))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def splunk_home():
+    # Short enough a path for a unix socket
+    path = tempfile.mkdtemp(prefix="splunk")
+    os.makedirs(os.path.join(path, "var", "run", "splunk"))
+    yield path
+    shutil.rmtree(path)
+
+@pytest.fixture
+def splunkd_uds(splunk_home):
+    server = serve_splunkd(FakeSplunkdUnix(os.path.join(splunk_home, "var", "run", "splunk", "cli.socket"), FakeSplunkdHandler))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def broker(tmpdir):
+    socket_path = str(tmpdir.join("broker", "broker.sock"))
+    assert splunk_api.ensure_private_dir(os.path.dirname(socket_path))
+    # Run the broker in-process rather than as a detached process
+    thread = threading.Thread(target=splunk_api.run_broker, args=(socket_path, 0.2))
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + 5
+    while not os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.01)
+    yield {"socket": socket_path, "idle_timeout": 0.2}
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not os.path.exists(socket_path)
+
+def test_api_call_tcp(splunkd):
+    response, excep_str = splunk_api.api_call_tcp("http", "GET", "/services/server/info", "admin", "helloworld", splunkd.server_address[1], status_code=[200])
+    assert excep_str == "No Exception"
+    assert response.status_code == 200
+    assert response.json()["entry"][0]["content"]["version"] == "8.1.0"
+
+@pytest.mark.parametrize(("endpoint", "status_code", "expected_status", "failed"),
+            [
+                ("/services/server/info", None, 200, False),
+                ("/services/server/info", [200], 200, False),
+                ("/services/missing", [200], 404, True),
+                ("/services/missing", [404], 404, False),
+            ]
+        )
+def test_api_call_tcp_broker(splunkd, broker, endpoint, status_code, expected_status, failed):
+    port = splunkd.server_address[1]
+    with patch("splunk_api.spawn_broker") as mock_spawn:
+        for _ in range(3):
+            response, excep_str = splunk_api.api_call_tcp("http", "GET", endpoint, "admin", "helloworld", port, status_code=status_code, broker=broker)
+            assert isinstance(response, splunk_api.BrokerResponse)
+            assert response.status_code == expected_status
+            assert (excep_str != "No Exception") == failed
+    mock_spawn.assert_not_called()
+    assert [r[1] for r in splunkd.requests] == [endpoint] * 3
+    # Credentials are still sent with each request
+    assert all(r[2] and r[2].startswith("Basic ") for r in splunkd.requests)
+    stats = splunk_api.broker_stats(broker["socket"])
+    target = "http://127.0.0.1:{}".format(port)
+    assert stats[target]["calls"] == 3
+    assert stats[target]["errors"] == 0
+    assert stats[target]["max_ms"] * 3 >= stats[target]["total_ms"]
+
+def test_api_call_tcp_broker_upstream_error(broker):
+    # Connection failures upstream are reported, not retried directly
+    with patch("splunk_api.requests.Session") as mock_session:
+        response, excep_str = splunk_api.api_call_tcp("http", "GET", "/services/server/info", "admin", "helloworld", 1, broker=broker)
+    mock_session.assert_not_called()
+    assert response is None
+    assert "Connection refused" in excep_str or "Max retries" in excep_str
+    assert splunk_api.broker_stats(broker["socket"])["http://127.0.0.1:1"]["errors"] == 1
+
+@pytest.mark.parametrize("spawn_error", [False, True])
+def test_api_call_tcp_broker_unavailable(splunkd, tmpdir, spawn_error):
+    broker = {"socket": str(tmpdir.join("broker", "broker.sock")), "idle_timeout": 1}
+    with patch("splunk_api.BROKER_START_TIMEOUT", new=0.1):
+        with patch("splunk_api.spawn_broker", side_effect=OSError if spawn_error else None) as mock_spawn:
+            response, excep_str = splunk_api.api_call_tcp("http", "GET", "/services/server/info", "admin", "helloworld", splunkd.server_address[1], broker=broker)
+    mock_spawn.assert_called_once_with(broker["socket"], 1)
+    # Falls back to a direct call
+    assert excep_str == "No Exception"
+    assert not isinstance(response, splunk_api.BrokerResponse)
+    assert response.status_code == 200
+
+@pytest.mark.parametrize("mode", [0o700, 0o755])
+def test_ensure_private_dir(tmpdir, mode):
+    path = str(tmpdir.join("broker"))
+    os.mkdir(path)
+    os.chmod(path, mode)
+    assert splunk_api.ensure_private_dir(path) == (mode == 0o700)
+    # No broker is used unless its socket is private
+    if mode != 0o700:
+        with patch("splunk_api.connect_broker") as mock_connect:
+            assert splunk_api.broker_request(os.path.join(path, "broker.sock"), {}) is None
+        mock_connect.assert_not_called()
+
+@pytest.fixture
+def session_auth(tmpdir):
+    return {"cache": str(tmpdir.join("state", "sessions.json")), "ttl": 60}
+
+def get_server_info(splunkd, session_auth, password="helloworld", broker=None):
+    response, excep_str = splunk_api.api_call_tcp("http", "GET", "/services/server/info", "admin", password, splunkd.server_address[1],
+                                                  broker=broker, session_auth=session_auth)
+    return response.status_code
+
+def test_session_auth(splunkd, session_auth):
+    for _ in range(3):
+        assert get_server_info(splunkd, session_auth) == 200
+    # A single login, then the session key is reused from the cache
+    assert splunkd.requests == [("POST", "/services/auth/login", None)] + [("GET", "/services/server/info", "Splunk key0")] * 3
+    assert oct(os.stat(session_auth["cache"]).st_mode & 0o777) == oct(0o600)
+    with open(session_auth["cache"]) as f:
+        content = f.read()
+    assert "helloworld" not in content
+    assert "key0" in content
+
+def test_session_auth_refresh(splunkd, session_auth):
+    assert get_server_info(splunkd, session_auth) == 200
+    # splunkd expired or revoked the session
+    splunkd.session_keys[0] = "revoked"
+    assert get_server_info(splunkd, session_auth) == 200
+    assert [r[2] for r in splunkd.requests] == [None, "Splunk key0", "Splunk key0", None, "Splunk key1"]
+    # The refreshed key is cached
+    assert get_server_info(splunkd, session_auth) == 200
+    assert splunkd.requests[-1] == ("GET", "/services/server/info", "Splunk key1")
+
+def test_session_auth_expired(splunkd, session_auth):
+    assert get_server_info(splunkd, session_auth) == 200
+    now = time.time()
+    with patch("splunk_api.time.time", return_value=now + 61):
+        assert get_server_info(splunkd, session_auth) == 200
+        assert get_server_info(splunkd, session_auth) == 200
+    # The expired key is not sent again, the new one is reused
+    assert [r[2] for r in splunkd.requests] == [None, "Splunk key0", None, "Splunk key1", "Splunk key1"]
+
+def test_session_auth_credentials(splunkd, session_auth):
+    assert get_server_info(splunkd, session_auth) == 200
+    splunkd.password = "newpassword"
+    assert get_server_info(splunkd, session_auth, "newpassword") == 200
+    assert [r[2] for r in splunkd.requests] == [None, "Splunk key0", None, "Splunk key1"]
+    # Wrong credentials are still rejected, through basic auth since login fails
+    assert get_server_info(splunkd, session_auth, "wrongpassword") == 401
+    assert splunkd.requests[-2:] == [("POST", "/services/auth/login", None), ("GET", "/services/server/info", "Basic YWRtaW46d3JvbmdwYXNzd29yZA==")]
+
+def test_session_auth_login_unavailable(splunkd, session_auth):
+    splunkd.login_enabled = False
+    assert get_server_info(splunkd, session_auth) == 200
+    assert splunkd.requests[-1][2].startswith("Basic ")
+    assert not os.path.exists(session_auth["cache"]) or json.load(open(session_auth["cache"])) == {}
+
+def test_session_auth_broker(splunkd, session_auth, broker):
+    for _ in range(2):
+        assert get_server_info(splunkd, session_auth, broker=broker) == 200
+    assert [r[2] for r in splunkd.requests] == [None, "Splunk key0", "Splunk key0"]
+    assert splunk_api.broker_stats(broker["socket"])["http://127.0.0.1:{}".format(splunkd.server_address[1])]["calls"] == 3
+
+def test_session_auth_disabled(splunkd):
+    assert get_server_info(splunkd, None) == 200
+    assert len(splunkd.requests) == 1 and splunkd.requests[0][2].startswith("Basic ")
+
+@pytest.mark.parametrize(("concurrency", "on_error", "expected"),
+            [
+                (1, "stop", [False, False, True, None, None, None]),
+                (1, "collect", [False, False, True, False, True, False]),
+                (3, "collect", [False, False, True, False, True, False]),
+            ]
+        )
+def test_run_batch(concurrency, on_error, expected):
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+    def run(call):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.02)
+        with lock:
+            in_flight["now"] -= 1
+        return {"url": call["url"], "failed": call["url"].startswith("/missing")}
+    calls = [{"method": "GET", "url": url} for url in ("/a", "/b", "/missing1", "/c", "/missing2", "/d")]
+    results = splunk_api.run_batch(run, calls, concurrency, on_error)
+    assert [r["url"] for r in results] == [c["url"] for c in calls]
+    assert [None if r.get("skipped") else r["failed"] for r in results] == expected
+    assert in_flight["max"] == concurrency
+
+def test_run_batch_stop_concurrent():
+    # Calls already in flight complete, the ones not started are skipped
+    calls = [{"method": "GET", "url": "/missing"}] + [{"method": "GET", "url": "/{}".format(i)} for i in range(20)]
+    results = splunk_api.run_batch(lambda call: {"failed": call["url"] == "/missing"}, calls, 4, "stop")
+    assert results[0]["failed"]
+    assert all(r["skipped"] for r in results[1:])
+
+@pytest.mark.parametrize(("calls", "error"),
+            [
+                (["/services/server/info"], "requests[0] must be a dict"),
+                ([{"url": "/a"}, {"uri": "/b"}], "requests[1] has unsupported keys uri"),
+                ([{"method": None}], "requests[0] needs a method and a url"),
+            ]
+        )
+def test_get_batch_calls_invalid(calls, error):
+    with pytest.raises(ValueError) as e:
+        splunk_api.get_batch_calls(calls, {"method": "GET", "url": None, "status_code": None})
+    assert error in str(e.value)
+
+def test_get_batch_calls():
+    defaults = {"method": "POST", "url": "/services/search/distributed/groups", "body": None, "body_format": "form-urlencoded",
+                "headers": None, "status_code": [201, 409], "timeout": 10}
+    calls = splunk_api.get_batch_calls([{"name": "indexer", "body": {"name": "dmc_group_indexer"}},
+                                        {"method": "GET", "url": "/services/server/info", "status_code": "200,204", "timeout": None}], defaults)
+    assert calls == [
+        {"name": "indexer", "method": "POST", "url": "/services/search/distributed/groups", "body": {"name": "dmc_group_indexer"},
+         "body_format": "form-urlencoded", "status_code": [201, 409], "timeout": 10},
+        {"method": "GET", "url": "/services/server/info", "body_format": "form-urlencoded", "status_code": [200, 204], "timeout": 10},
+    ]
+
+def test_batch_call_pool(splunkd, session_auth):
+    pool = splunk_api.SessionPool()
+    call = {"method": "POST", "url": "/services/search/distributed/groups", "body": {"name": "dmc_group_indexer"},
+            "body_format": "form-urlencoded", "status_code": [201]}
+    for _ in range(3):
+        result = splunk_api.batch_call(call, {}, "admin", "helloworld", "http", splunkd.server_address[1], False, None, session_auth, pool)
+        assert not result["failed"] and not result["brokered"]
+        assert result["status"] == 201
+        assert result["json"] == {"form": {"name": ["dmc_group_indexer"]}}
+    # The login and the calls share a single keep-alive connection
+    assert splunkd.connections == 1
+    assert [r[2] for r in splunkd.requests] == [None] + ["Splunk key0"] * 3
+    result = splunk_api.batch_call(dict(call, url="/services/missing"), {}, "admin", "helloworld", "http", splunkd.server_address[1], False, None, session_auth, pool)
+    assert result["failed"] and result["status"] == 404
+    assert result["msg"].startswith("POST /services/missing failed with status code 404")
+
+def run_module(args, tmpdir):
+    args_file = str(tmpdir.join("args.json"))
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    env = dict(os.environ, SPLUNK_API_SESSION_CACHE=str(tmpdir.join("state", "sessions.json")),
+               SPLUNK_API_CIRCUIT_STATE=str(tmpdir.join("state", "circuits.json")))
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "library", "splunk_api.py"), args_file],
+                               stdout=subprocess.PIPE, env=env)
+    return json.loads(process.communicate()[0])
+
+@pytest.mark.parametrize(("on_error", "concurrency", "statuses"),
+            [
+                ("stop", 1, [201, 404, None, None]),
+                ("collect", 2, [201, 404, 201, 200]),
+            ]
+        )
+def test_main_requests(splunkd, tmpdir, on_error, concurrency, statuses):
+    args = {"method": "POST", "url": "/services/search/distributed/groups", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1], "body_format": "form-urlencoded", "status_code": "201,409",
+            "on_error": on_error, "concurrency": concurrency,
+            "requests": [
+                {"body": {"name": "dmc_group_indexer"}},
+                {"url": "/services/missing", "body": {"name": "missing"}},
+                {"body": {"name": "dmc_group_search_head"}},
+                {"name": "info", "method": "GET", "url": "/services/server/info", "status_code": [200]},
+            ]}
+    result = run_module(args, tmpdir)
+    assert result["failed"]
+    assert result["msg"].startswith("1 of 4 requests failed")
+    assert [r.get("status") for r in result["results"]] == statuses
+    assert [r["skipped"] for r in result["results"]] == [s is None for s in statuses]
+    assert result["results"][3]["name"] == "info"
+    assert "helloworld" not in json.dumps(result)
+
+def test_main_requests_ok(splunkd, tmpdir):
+    args = {"method": "POST", "url": "/services/search/distributed/groups", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1], "body_format": "form-urlencoded", "status_code": [201],
+            "concurrency": 4, "requests": [{"body": {"name": "group{}".format(i)}} for i in range(8)]}
+    result = run_module(args, tmpdir)
+    assert not result.get("failed") and result["changed"]
+    assert [r["json"]["form"]["name"] for r in result["results"]] == [["group{}".format(i)] for i in range(8)]
+    # One login, one keep-alive connection per concurrent worker at most
+    assert [r[1] for r in splunkd.requests].count("/services/auth/login") == 1
+    assert splunkd.connections <= 4
+
+@pytest.mark.parametrize(("args", "error"),
+            [
+                ({}, "method and url are required unless requests is given"),
+                ({"requests": [{"method": "GET"}]}, "requests[0] needs a method and a url"),
+                ({"requests": [], "concurrency": 0}, "concurrency must be at least 1"),
+            ]
+        )
+def test_main_invalid(tmpdir, args, error):
+    result = run_module(dict(args, username="admin", password="helloworld"), tmpdir)
+    assert result["failed"]
+    assert error in result["msg"]
+
+PEERS = {"entry": [{"name": "idx1", "content": {"status": "Up", "port": 8089}},
+                   {"name": "idx2", "content": {"status": "Down", "port": 8089}},
+                   {"name": "idx3", "content": {}}]}
+
+@pytest.mark.parametrize(("path", "expected"),
+            [
+                (None, PEERS),
+                ("entry.0.name", "idx1"),
+                ("entry.-1.content", {}),
+                ("entry.*.name", ["idx1", "idx2", "idx3"]),
+                # Items missing the rest of the path are left out of an expansion
+                ("entry.*.content.status", ["Up", "Down"]),
+                ("entry.*.content.*", ["Up", 8089, "Down", 8089]),
+                ("entry.*.missing", []),
+            ]
+        )
+def test_resolve_path(path, expected):
+    assert splunk_api.resolve_path(PEERS, path) == expected
+
+@pytest.mark.parametrize("path", ["missing", "entry.3", "entry.name", "entry.0.name.first", "entry.*.content.status.x.y"])
+def test_resolve_path_missing(path):
+    if path.startswith("entry.*"):
+        assert splunk_api.resolve_path(PEERS, path) == []
+    else:
+        with pytest.raises((KeyError, IndexError, ValueError, TypeError)):
+            splunk_api.resolve_path(PEERS, path)
+
+@pytest.mark.parametrize(("wait", "expected"),
+            [
+                ({}, True),
+                ({"path": "missing"}, False),
+                ({"path": "entry", "length": 3}, True),
+                ({"path": "entry", "length": "3"}, True),
+                ({"path": "entry", "length": 2}, False),
+                ({"path": "entry.0.content.status", "equals": "Up"}, True),
+                ({"path": "entry.0.content.port", "equals": "8089"}, True),
+                ({"path": "entry.1.content.status", "equals": "Up"}, False),
+                ({"path": "entry.1.content.status", "not_equals": "Up"}, True),
+                ({"path": "entry.3.content.status", "not_equals": "Up"}, False),
+                ({"path": "entry.*.content.status", "contains": "Down"}, True),
+                ({"path": "entry.*.content.status", "not_contains": "Down"}, False),
+                ({"path": "entry.*.content.status", "not_contains": "Pending"}, True),
+                ({"path": "entry.0.name", "contains": "idx"}, True),
+                ({"path": "entry.0.name", "not_contains": "idx"}, False),
+            ]
+        )
+def test_check_condition(wait, expected):
+    assert splunk_api.check_condition(PEERS, wait) == expected
+
+def test_get_wait():
+    assert splunk_api.get_wait({"path": "entry", "length": "3", "interval": "0.5", "timeout": 60, "equals": None}) == \
+        {"path": "entry", "length": 3, "interval": 0.5, "backoff": 1.0, "max_interval": 30.0, "timeout": 60.0}
+
+@pytest.mark.parametrize(("wait", "error"),
+            [
+                ({"delay": 1}, "wait has unsupported keys delay"),
+                ({"equals": 1, "length": 1}, "wait accepts a single condition, got equals, length"),
+                ({"length": "three"}, "Invalid wait"),
+                ({"interval": 0}, "wait needs interval > 0"),
+                ({"backoff": 0.5}, "wait needs interval > 0"),
+                ({"interval": 5, "max_interval": 1}, "wait needs interval > 0"),
+            ]
+        )
+def test_get_wait_invalid(wait, error):
+    with pytest.raises(ValueError) as e:
+        splunk_api.get_wait(wait)
+    assert error in str(e.value)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.mark.parametrize(("ready_after", "timeout", "expected_attempts", "met", "sleeps"),
+            [
+                # The first attempt gets no response
+                (1, 60, 2, True, [1]),
+                (4, 60, 4, True, [1, 2, 4]),
+                (10, 60, 10, True, [1, 2, 4, 8, 10, 10, 10, 10, 5]),
+                # The last interval is cut short by the deadline
+                (10, 12, 5, False, [1, 2, 4, 5]),
+                (10, 0, 1, False, []),
+            ]
+        )
+def test_poll(ready_after, timeout, expected_attempts, met, sleeps):
+    clock = FakeClock()
+    attempts = []
+    def call():
+        attempts.append(clock.now)
+        return (None, "connection refused") if len(attempts) == 1 else (len(attempts), "No Exception")
+    wait = {"interval": 1, "backoff": 2, "max_interval": 10, "timeout": timeout}
+    with patch("splunk_api.time", new=clock):
+        response, excep_str, count, done = splunk_api.poll(call, lambda response: response >= ready_after, wait)
+    assert (count, done) == (expected_attempts, met)
+    assert clock.sleeps == sleeps
+    assert count == len(attempts)
+
+def test_main_wait(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/cluster/master/peers?output_mode=json", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1], "status_code": [200],
+            "wait": {"path": "entry", "length": "3", "interval": 0.01, "timeout": 10}}
+    result = run_module(args, tmpdir)
+    assert not result.get("failed") and result["status"] == 200
+    assert result["transport"] == "tcp"
+    assert result["attempts"] == 3
+    assert len(result["json"]["entry"]) == 3
+    # A single login and connection for every attempt
+    assert [r[1] for r in splunkd.requests].count("/services/auth/login") == 1
+    assert splunkd.connections == 1
+
+def test_main_wait_timeout(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/cluster/master/peers?output_mode=json", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1],
+            "wait": {"path": "entry.*.content.status", "contains": "Down", "interval": 0.01, "max_interval": 0.05, "backoff": 2, "timeout": 0.3}}
+    result = run_module(args, tmpdir)
+    assert result["failed"]
+    assert result["msg"].startswith("GET /services/cluster/master/peers?output_mode=json did not meet the wait condition within 0.3s")
+    assert result["attempts"] > 3 and result["status"] == 200
+    assert "helloworld" not in result["msg"]
+
+@pytest.mark.parametrize(("args", "error"),
+            [
+                ({"method": "GET", "url": "/services/server/info", "wait": {"length": 1, "equals": 1}}, "wait accepts a single condition"),
+                ({"requests": [{"method": "GET", "url": "/services/server/info"}], "wait": {}}, "wait is not supported along with requests"),
+            ]
+        )
+def test_main_wait_invalid(tmpdir, args, error):
+    result = run_module(dict(args, username="admin", password="helloworld"), tmpdir)
+    assert result["failed"]
+    assert error in result["msg"]
+
+@pytest.mark.parametrize(("uds", "socket_path", "home", "env_home", "expected"),
+            [
+                (None, None, None, None, None),
+                (None, None, "home", None, "socket"),
+                (None, None, None, "home", "socket"),
+                (None, None, "missing", "home", None),
+                (None, "socket", None, None, "socket"),
+                (None, "missing/cli.socket", "home", None, None),
+                (False, None, "home", None, None),
+                # Forcing UDS does not require the socket to exist yet
+                (True, None, "missing", None, "missing/var/run/splunk/cli.socket"),
+                (True, None, None, None, splunk_api.UDS_SOCKET_PATH),
+            ]
+        )
+def test_get_uds_socket(splunkd_uds, splunk_home, uds, socket_path, home, env_home, expected):
+    paths = {"home": splunk_home, "missing": os.path.join(splunk_home, "missing"), "socket": splunkd_uds.server_address}
+    def resolve(value):
+        if value is None or os.path.isabs(value):
+            return value
+        head, _, tail = value.partition("/")
+        return os.path.join(paths[head], tail) if tail else paths[head]
+    env = {"SPLUNK_HOME": resolve(env_home)} if env_home else {}
+    with patch.dict(os.environ, env, clear=True):
+        assert splunk_api.get_uds_socket(uds, resolve(socket_path), resolve(home)) == resolve(expected)
+
+def test_supports_uds(splunkd_uds, splunk_home):
+    assert splunk_api.supports_uds(splunkd_uds.server_address)
+    # Only an actual socket counts
+    regular_file = os.path.join(splunk_home, "cli.socket")
+    open(regular_file, "w").close()
+    assert not splunk_api.supports_uds(regular_file)
+    assert not splunk_api.supports_uds(os.path.join(splunk_home, "missing"))
+
+@pytest.mark.parametrize("auth_method", ["session", "basic"])
+def test_main_uds(splunkd_uds, splunk_home, tmpdir, auth_method):
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld",
+            "svc_port": 1, "status_code": [200], "splunk_home": splunk_home, "auth_method": auth_method}
+    result = run_module(args, tmpdir)
+    assert not result.get("failed") and result["status"] == 200
+    assert result["transport"] == "uds"
+    assert result["ansible_facts"] == {"splunk_api_transport": "uds"}
+    assert splunkd_uds.requests[-1][1] == "/services/server/info"
+    assert [r[0] for r in splunkd_uds.requests] == (["POST", "GET"] if auth_method == "session" else ["GET"])
+
+def test_main_uds_disabled(splunkd, splunkd_uds, splunk_home, tmpdir):
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "splunk_home": splunk_home, "uds": False}
+    result = run_module(args, tmpdir)
+    assert result["transport"] == "tcp" and result["status"] == 200
+    assert splunkd_uds.requests == []
+
+@pytest.mark.parametrize(("fields", "expected"),
+            [
+                ([""], PEERS),
+                (["entry.*.name"], {"entry": [{"name": "idx1"}, {"name": "idx2"}, {"name": "idx3"}]}),
+                (["entry.*.name", "entry.*.content.status"], {"entry": [{"name": "idx1", "content": {"status": "Up"}},
+                                                                        {"name": "idx2", "content": {"status": "Down"}},
+                                                                        {"name": "idx3"}]}),
+                (["entry.*.content.status"], {"entry": [{"content": {"status": "Up"}}, {"content": {"status": "Down"}}]}),
+                (["entry.0.name", "entry.-1"], {"entry": [{"name": "idx1"}, {"name": "idx3", "content": {}}]}),
+                (["entry.*.content"], {"entry": [{"content": {"status": "Up", "port": 8089}}, {"content": {"status": "Down", "port": 8089}},
+                                                 {"content": {}}]}),
+                (["entry.-4.name", "entry.3.name", "entry.x"], None),
+                (["missing", "entry.*.content.port.x"], None),
+            ]
+        )
+def test_project(fields, expected):
+    assert splunk_api.project(PEERS, fields) == expected
+
+@pytest.mark.parametrize(("url", "rest_filter", "expected"),
+            [
+                ("/services/apps/local", None, "/services/apps/local"),
+                ("/services/apps/local", ["version", "disabled"], "/services/apps/local?output_mode=json&f=version&f=disabled"),
+                ("/services/apps/local?output_mode=json&count=0", ["version"], "/services/apps/local?output_mode=json&count=0&f=version"),
+                ("/services/apps/local?count=0", ["label*"], "/services/apps/local?count=0&output_mode=json&f=label%2A"),
+            ]
+        )
+def test_add_rest_filter(url, rest_filter, expected):
+    assert splunk_api.add_rest_filter(url, rest_filter) == expected
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("max_bytes", [None, 100000, 1000])
+def test_read_body(splunkd, tmpdir, stream, max_bytes):
+    def get():
+        response, excep_str = splunk_api.api_call_tcp("http", "GET", "/services/apps/local", "admin", "helloworld", splunkd.server_address[1], stream=stream)
+        return response
+    full = get().text
+    dest = str(tmpdir.join("apps.json"))
+    if max_bytes is not None and len(full) > max_bytes:
+        for path in (None, dest):
+            with pytest.raises(ValueError) as e:
+                splunk_api.read_body(get(), max_bytes, path)
+            assert "exceeds max_bytes of 1000" in str(e.value)
+        # No partial file is left behind
+        assert os.listdir(str(tmpdir)) == []
+        return
+    assert splunk_api.read_body(get(), max_bytes) == (full, len(full))
+    assert splunk_api.read_body(get(), max_bytes, dest) == (None, len(full))
+    with open(dest) as f:
+        assert f.read() == full
+    broker_response = splunk_api.BrokerResponse({"status_code": 200, "headers": {}, "text": full, "elapsed_ms": 1})
+    assert splunk_api.read_body(broker_response, max_bytes) == (full, len(full))
+
+def test_main_projection(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/apps/local?count=0", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "rest_filter": ["version"], "fields": ["entry.*.name", "entry.*.content.version"],
+            "max_bytes": 100000}
+    result = run_module(args, tmpdir)
+    assert not result.get("failed")
+    assert splunkd.requests[-1][1] == "/services/apps/local?count=0&output_mode=json&f=version"
+    assert result["json"] == {"entry": [{"name": "app{}".format(i), "content": {"version": "1.0"}} for i in range(200)]}
+    assert result["size"] > len(json.dumps(result["json"]))
+
+@pytest.mark.parametrize("fields", [None, ["entry.0.name"]])
+def test_main_dest(splunkd, tmpdir, fields):
+    dest = str(tmpdir.join("apps.json"))
+    args = {"method": "GET", "url": "/services/apps/local", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "dest": dest, "fields": fields}
+    result = run_module(args, tmpdir)
+    assert not result.get("failed")
+    assert result["dest"] == dest
+    with open(dest) as f:
+        assert len(json.load(f)["entry"]) == 200
+    assert result["size"] == os.path.getsize(dest)
+    if fields:
+        assert result["json"] == {"entry": [{"name": "app0"}]}
+    else:
+        assert "json" not in result
+
+def test_main_max_bytes(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/apps/local", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "max_bytes": 1000, "dest": str(tmpdir.join("apps.json"))}
+    result = run_module(args, tmpdir)
+    assert result["failed"] and result["status"] == 200
+    assert result["msg"] == "GET /services/apps/local: Response body exceeds max_bytes of 1000"
+    assert not os.path.exists(args["dest"])
+
+def test_main_requests_projection(splunkd, tmpdir):
+    args = {"method": "GET", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "fields": ["entry.0.name"], "max_bytes": 1000, "on_error": "collect",
+            "requests": [{"url": "/services/server/info"}, {"url": "/services/apps/local"}]}
+    result = run_module(args, tmpdir)
+    assert result["failed"]
+    info, apps = result["results"]
+    # No name in the server info entries
+    assert not info["failed"] and info["json"] is None
+    assert apps["failed"] and apps["status"] == 200 and "json" not in apps
+    assert apps["msg"] == "GET /services/apps/local: Response body exceeds max_bytes of 1000"
+
+@pytest.fixture
+def splunkd_https(tmpdir):
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is required to generate a certificate")
+    import ssl
+    cert = str(tmpdir.join("splunkd.pem"))
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                           "-keyout", cert, "-out", cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = FakeSplunkd(("127.0.0.1", 0), FakeSplunkdHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    serve_splunkd(server)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_timed_request(splunkd):
+    session = splunk_api.requests.Session()
+    url = "http://127.0.0.1:{}/services/server/info".format(splunkd.server_address[1])
+    response, timings = splunk_api.timed_request(session, "GET", url, auth=("admin", "helloworld"))
+    assert response.status_code == 200
+    assert timings["connections"] == 1 and timings["connect_ms"] > 0 and timings["tls_ms"] == 0
+    assert timings["bytes_in"] == len(response.content) and timings["bytes_out"] == 0
+    assert timings["ttfb_ms"] > 0
+    # The connection is kept alive
+    response, timings = splunk_api.timed_request(session, "POST", url.replace("server/info", "search/distributed/groups"),
+                                                 auth=("admin", "helloworld"), data={"name": "dmc_group_indexer"})
+    assert timings["connections"] == 0 and timings["connect_ms"] == 0
+    assert timings["bytes_out"] == len("name=dmc_group_indexer")
+    # Connections opened outside of timed_request are not accounted anywhere
+    assert getattr(splunk_api.connection_timings, "current", None) is None
+
+def test_timed_request_tls(splunkd_https):
+    url = "https://127.0.0.1:{}/services/server/info".format(splunkd_https.server_address[1])
+    response, timings = splunk_api.timed_request(splunk_api.requests.Session(), "GET", url, auth=("admin", "helloworld"), verify=False)
+    assert response.status_code == 200
+    assert timings["connections"] == 1 and timings["tls_ms"] > 0 and timings["connect_ms"] > 0
+
+def test_timed_request_uds(splunkd_uds):
+    url = "http+unix://{}/services/server/info".format(splunk_api.quote(splunkd_uds.server_address, safe=""))
+    response, timings = splunk_api.timed_request(splunk_api.requests_unixsocket.Session(), "GET", url, auth=("admin", "helloworld"))
+    assert response.status_code == 200
+    assert timings["connections"] == 1 and timings["connect_ms"] > 0 and timings["tls_ms"] == 0
+
+def call_metrics(splunkd, session_auth=None, broker=None, pool=None):
+    call = {"method": "GET", "url": "/services/server/info", "status_code": [200]}
+    metrics = splunk_api.new_metrics()
+    response, excep_str = splunk_api.api_call(call, "admin", "helloworld", "http", splunkd.server_address[1], False, broker, session_auth, pool,
+                                              metrics=metrics)
+    assert response.status_code == 200
+    return metrics
+
+def test_api_call_metrics(splunkd, session_auth):
+    metrics = call_metrics(splunkd, session_auth)
+    assert metrics["transport"] == "tcp" and not metrics["brokered"]
+    # Login then call, on a new session each
+    assert (metrics["requests"], metrics["logins"], metrics["retries"], metrics["connections"]) == (2, 1, 0, 2)
+    assert metrics["total_ms"] >= metrics["connect_ms"] + metrics["ttfb_ms"]
+    assert metrics["bytes_in"] == sum(len(json.dumps(body)) for body in ({"sessionKey": "key0"}, {"entry": [{"content": {"version": "8.1.0"}}]}))
+    splunkd.session_keys[0] = "revoked"
+    metrics = call_metrics(splunkd, session_auth)
+    assert (metrics["requests"], metrics["logins"], metrics["retries"]) == (3, 1, 1)
+    assert splunk_api.call_metrics.current is None
+
+def test_api_call_metrics_pool(splunkd, session_auth):
+    pool = splunk_api.SessionPool()
+    assert call_metrics(splunkd, session_auth, pool=pool)["connections"] == 1
+    assert call_metrics(splunkd, session_auth, pool=pool)["connections"] == 0
+
+def test_api_call_metrics_broker(splunkd, broker):
+    metrics = call_metrics(splunkd, broker=broker)
+    assert metrics["brokered"]
+    # Timings are measured by the broker
+    assert (metrics["requests"], metrics["connections"]) == (1, 1)
+    assert call_metrics(splunkd, broker=broker)["connections"] == 0
+
+def test_write_metrics(tmpdir):
+    path = str(tmpdir.join("artifacts", "metrics.json"))
+    splunk_api.write_metrics(path, [{"url": "/a"}, {"url": "/b"}])
+    splunk_api.write_metrics(path, [{"url": "/c"}])
+    with open(path) as f:
+        assert [json.loads(line)["url"] for line in f] == ["/a", "/b", "/c"]
+    # Metrics never fail a call
+    os.chmod(str(tmpdir.join("artifacts")), 0o500)
+    try:
+        splunk_api.write_metrics(os.path.join(str(tmpdir.join("artifacts")), "other", "metrics.json"), [{"url": "/a"}])
+    finally:
+        os.chmod(str(tmpdir.join("artifacts")), 0o700)
+
+def test_main_metrics(splunkd, tmpdir):
+    metrics_file = str(tmpdir.join("artifacts", "splunk_api_metrics.json"))
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "metrics": True, "metrics_file": metrics_file}
+    result = run_module(args, tmpdir)
+    assert result["metrics"]["transport"] == "tcp" and result["metrics"]["requests"] == 2
+    result = run_module(dict(args, requests=[{"name": "info"}, {"url": "/services/missing"}], on_error="collect"), tmpdir)
+    assert result["failed"]
+    assert [r["metrics"]["requests"] for r in result["results"]] == [1, 1]
+    result = run_module(dict(args, url="/services/missing"), tmpdir)
+    assert result["failed"] and result["metrics"]["requests"] == 1
+    # Disabled unless asked for
+    run_module(dict(args, metrics=False), tmpdir)
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["url"], r["status"], r["failed"], r.get("name")) for r in records] == [
+        ("/services/server/info", 200, False, None),
+        ("/services/server/info", 200, False, "info"),
+        ("/services/missing", 404, True, None),
+        ("/services/missing", 404, True, None),
+    ]
+    assert all(set(splunk_api.new_metrics()) <= set(r) for r in records)
+    assert "helloworld" not in json.dumps(records)
+
+@pytest.mark.parametrize(("body", "desired"),
+            [
+                ({"deployer_push_mode": "merge_to_default", "skipped": None}, {"deployer_push_mode": "merge_to_default"}),
+                ("member=a&member=b&default=true&name=dmc_group_indexer", {"member": ["a", "b"], "default": "true", "name": "dmc_group_indexer"}),
+                ("default=false&member=", {"default": "false", "member": ""}),
+                (None, {}),
+            ]
+        )
+def test_get_desired(body, desired):
+    assert splunk_api.get_desired(body) == desired
+
+def test_get_desired_invalid():
+    with pytest.raises(ValueError):
+        splunk_api.get_desired(["name=dmc_group_indexer"])
+
+@pytest.mark.parametrize(("url", "desired", "expected"),
+            [
+                ("/services/search/distributed/groups", {"name": "dmc_indexerclustergroup_idx c"},
+                 "/services/search/distributed/groups/dmc_indexerclustergroup_idx%20c?output_mode=json"),
+                ("/services/search/distributed/groups/", {"name": "dmc_group_indexer"}, "/services/search/distributed/groups/dmc_group_indexer?output_mode=json"),
+                ("/servicesNS/nobody/system/configs/conf-server/shclustering", {"preferred_captain": "true"},
+                 "/servicesNS/nobody/system/configs/conf-server/shclustering?output_mode=json"),
+                ("/servicesNS/nobody/system/configs/conf-app/shclustering?output_mode=xml&count=0", {},
+                 "/servicesNS/nobody/system/configs/conf-app/shclustering?count=0&output_mode=json"),
+            ]
+        )
+def test_get_entity_url(url, desired, expected):
+    assert splunk_api.get_entity_url(url, desired) == expected
+
+@pytest.mark.parametrize(("current", "desired", "same"),
+            [
+                ("merge_to_default", "merge_to_default", True),
+                ("merge_to_default", "full", False),
+                (True, "true", True),
+                ("1", "True", True),
+                (False, "true", False),
+                ("0", False, True),
+                (3, "3", True),
+                ("10", "1", False),
+                (["b", "a"], ["a", "b"], True),
+                (["a"], "a", True),
+                (["a", "b"], "a", False),
+                ([], "", False),
+                (None, "", False),
+            ]
+        )
+def test_same_setting(current, desired, same):
+    assert splunk_api.same_setting(current, desired) == same
+
+def test_diff_settings():
+    current = {"member": ["a", "b"], "default": False, "disabled": False}
+    assert splunk_api.diff_settings(current, {"member": ["b", "a"], "default": "false", "name": "dmc_group_indexer"}) == {"before": {}, "after": {}}
+    assert splunk_api.diff_settings(current, {"member": "a", "default": "true", "search_heads": "sh1"}) == {
+        "before": {"member": ["a", "b"], "default": False, "search_heads": None},
+        "after": {"member": "a", "default": "true", "search_heads": "sh1"},
+    }
+
+def ensure(splunkd, body, url="/services/search/distributed/groups", check_mode=False):
+    call = {"method": "POST", "url": url, "body": body, "body_format": "form-urlencoded", "status_code": [200, 201, 409]}
+    del splunkd.requests[:]
+    response, excep_str, changed, diff = splunk_api.ensure_call(call, "admin", "helloworld", "http", splunkd.server_address[1], False,
+                                                                check_mode=check_mode)
+    writes = [(path, parse_qs(body)) for method, path, body in splunkd.requests if method == "POST"]
+    return response, changed, diff, writes
+
+def test_ensure_call_collection(splunkd):
+    splunkd.collections["/services/search/distributed/groups"] = {}
+    groups = splunkd.collections["/services/search/distributed/groups"]
+    body = "member=idx1:8089&member=idx2:8089&default=true&name=dmc_group_indexer"
+    # Nothing is written in check mode
+    response, changed, diff, writes = ensure(splunkd, body, check_mode=True)
+    assert response.status_code == 404 and changed and writes == [] and groups == {}
+    assert diff == {"before": {}, "after": {"member": ["idx1:8089", "idx2:8089"], "default": "true"}}
+    # Created when missing
+    response, changed, diff, writes = ensure(splunkd, body)
+    assert response.status_code == 201 and changed
+    assert writes == [("/services/search/distributed/groups", {"member": ["idx1:8089", "idx2:8089"], "default": ["true"], "name": ["dmc_group_indexer"]})]
+    # Left alone when up to date, whatever the order of the members
+    response, changed, diff, writes = ensure(splunkd, "member=idx2:8089&member=idx1:8089&default=true&name=dmc_group_indexer")
+    assert response.status_code == 200 and not changed and writes == [] and diff == {"before": {}, "after": {}}
+    # Edited in place, without its name, when it differs
+    response, changed, diff, writes = ensure(splunkd, "member=idx1:8089&default=true&name=dmc_group_indexer")
+    assert response.status_code == 200 and changed
+    assert writes == [("/services/search/distributed/groups/dmc_group_indexer", {"member": ["idx1:8089"], "default": ["true"]})]
+    assert diff == {"before": {"member": ["idx1:8089", "idx2:8089"]}, "after": {"member": "idx1:8089"}}
+    assert groups["dmc_group_indexer"]["member"] == "idx1:8089"
+
+def test_ensure_call_stanza(splunkd):
+    splunkd.collections["/servicesNS/nobody/system/configs/conf-app"] = {"shclustering": {"deployer_push_mode": "merge_to_default", "disabled": False}}
+    url = "/servicesNS/nobody/system/configs/conf-app/shclustering"
+    response, changed, diff, writes = ensure(splunkd, {"deployer_push_mode": "merge_to_default"}, url)
+    assert not changed and writes == []
+    response, changed, diff, writes = ensure(splunkd, {"deployer_push_mode": "full"}, url)
+    assert response.status_code == 200 and changed and writes == [(url, {"deployer_push_mode": ["full"]})]
+    assert diff == {"before": {"deployer_push_mode": "merge_to_default"}, "after": {"deployer_push_mode": "full"}}
+
+def test_ensure_call_lookup_failure(splunkd):
+    splunkd.collections["/services/search/distributed/groups"] = {}
+    splunkd.password = "changed"
+    response, changed, diff, writes = ensure(splunkd, "name=dmc_group_indexer")
+    assert response is None and not changed and diff is None and writes == []
+
+def test_main_ensure(splunkd, tmpdir):
+    splunkd.collections["/servicesNS/nobody/system/configs/conf-server"] = {"shclustering": {"preferred_captain": True}}
+    splunkd.collections["/services/search/distributed/groups"] = {}
+    args = {"method": "POST", "url": "/servicesNS/nobody/system/configs/conf-server/shclustering", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1], "body": {"preferred_captain": "false"}, "body_format": "form-urlencoded",
+            "status_code": "200,409", "ensure": "present"}
+    result = run_module(dict(args, _ansible_check_mode=True), tmpdir)
+    assert result["changed"] and result["diff"]["after"] == {"preferred_captain": "false"}
+    assert splunkd.collections["/servicesNS/nobody/system/configs/conf-server"]["shclustering"]["preferred_captain"] is True
+    result = run_module(args, tmpdir)
+    assert result["changed"] and result["status"] == 200
+    result = run_module(args, tmpdir)
+    assert not result["changed"] and result["status"] == 200
+    # Without ensure, check mode does not send anything
+    plain = dict((k, v) for k, v in args.items() if k != "ensure")
+    result = run_module(dict(plain, _ansible_check_mode=True), tmpdir)
+    assert not result["changed"] and "status" not in result
+    # Per item of a requests list
+    # Edits of an existing entity answer 200
+    batch = dict(args, url="/services/search/distributed/groups", body=None, status_code="200,201,409",
+                 requests=[{"body": {"name": "dmc_group_indexer", "default": "true"}}, {"body": {"name": "dmc_group_search_head", "default": "false"}}])
+    result = run_module(batch, tmpdir)
+    assert result["changed"] and [r["changed"] for r in result["results"]] == [True, True]
+    batch["requests"][1]["body"]["default"] = "true"
+    result = run_module(batch, tmpdir)
+    assert result["changed"] and [r["changed"] for r in result["results"]] == [False, True]
+    assert [r["status"] for r in result["results"]] == [200, 200]
+    result = run_module(batch, tmpdir)
+    assert not result["changed"]
+    # Sent regardless without it
+    result = run_module(dict(plain, url=batch["url"], body=None, status_code=batch["status_code"], requests=[{"body": {"name": "dmc_group_indexer"}}]), tmpdir)
+    assert result["changed"] and not result.get("failed") and result["results"][0]["status"] == 409
+    result = run_module(dict(args, requests=[{"ensure": "absent"}]), tmpdir)
+    assert result["failed"] and "unsupported ensure" in result["msg"]
+
+def test_main_ensure_check_mode_mixed(splunkd, tmpdir):
+    splunkd.collections["/services/search/distributed/groups"] = {}
+    args = {"method": "POST", "url": "/services/search/distributed/groups", "username": "admin", "password": "helloworld",
+            "cert_prefix": "http", "svc_port": splunkd.server_address[1], "body_format": "form-urlencoded", "status_code": "200,201,409",
+            "requests": [{"body": {"name": "dmc_group_indexer"}, "ensure": "present"}, {"name": "plain", "body": {"name": "dmc_group_search_head"}}]}
+    result = run_module(dict(args, _ansible_check_mode=True), tmpdir)
+    # The item with ensure is looked up, the plain one is not sent
+    assert result["changed"] and not result.get("failed")
+    assert [r["changed"] for r in result["results"]] == [True, False]
+    assert result["results"][1] == {"name": "plain", "method": "POST", "url": "/services/search/distributed/groups",
+                                    "skipped": True, "failed": False, "changed": False}
+    assert splunkd.collections["/services/search/distributed/groups"] == {}
+
+def test_batch_call_check_mode():
+    with patch("splunk_api.api_call") as mock_api_call:
+        result = splunk_api.batch_call({"method": "POST", "url": "/services/search/distributed/groups"}, None,
+                                       "admin", "helloworld", "http", 8089, False, check_mode=True)
+    assert not mock_api_call.called
+    assert result["skipped"] and not result["changed"]
+
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+@pytest.mark.parametrize(("circuit", "expected"),
+            [
+                ({}, dict(splunk_api.CIRCUIT_DEFAULTS, state="circuits.json")),
+                ({"threshold": "5", "cooldown": 2, "max_cooldown": None}, dict(splunk_api.CIRCUIT_DEFAULTS, threshold=5, cooldown=2.0, state="circuits.json")),
+            ]
+        )
+def test_get_circuit(circuit, expected):
+    assert splunk_api.get_circuit(circuit, "circuits.json") == expected
+
+@pytest.mark.parametrize("circuit",
+            [
+                {"retries": 3},
+                {"threshold": 0},
+                {"cooldown": "soon"},
+                {"cooldown": 60, "max_cooldown": 30},
+                {"probe_timeout": 0},
+            ]
+        )
+def test_get_circuit_invalid(circuit):
+    with pytest.raises(ValueError):
+        splunk_api.get_circuit(circuit)
+
+def test_circuit(tmpdir):
+    circuit = splunk_api.get_circuit({"threshold": 2, "cooldown": 10, "max_cooldown": 15, "probe_timeout": 5}, str(tmpdir.join("state", "circuits.json")))
+    target = "https://cm:8089"
+    now = time.time()
+    with patch("splunk_api.time.time") as mock_time:
+        mock_time.return_value = now
+        assert splunk_api.acquire_circuit(circuit, target) is None
+        splunk_api.report_circuit(circuit, target, False)
+        assert splunk_api.acquire_circuit(circuit, target) is None
+        splunk_api.report_circuit(circuit, target, False)
+        assert splunk_api.acquire_circuit(circuit, target) == "2 consecutive failures, next probe in 10s"
+        # Other targets are not affected
+        assert splunk_api.acquire_circuit(circuit, "https://deployer:8089") is None
+        # A single probe once the cooldown is over
+        mock_time.return_value = now + 10
+        assert splunk_api.acquire_circuit(circuit, target) is None
+        assert splunk_api.acquire_circuit(circuit, target) == "2 consecutive failures, waiting on the probe in flight"
+        # Unless it does not report in time
+        mock_time.return_value = now + 15
+        assert splunk_api.acquire_circuit(circuit, target) is None
+        # A failed probe doubles the cooldown, up to max_cooldown
+        splunk_api.report_circuit(circuit, target, False)
+        assert splunk_api.acquire_circuit(circuit, target) == "3 consecutive failures, next probe in 15s"
+        mock_time.return_value = now + 30
+        assert splunk_api.acquire_circuit(circuit, target) is None
+        splunk_api.report_circuit(circuit, target, True)
+        assert splunk_api.acquire_circuit(circuit, target) is None
+    with open(circuit["state"]) as f:
+        assert json.load(f) == {}
+
+def test_circuit_shorter_max_cooldown(tmpdir):
+    circuit = splunk_api.get_circuit({"threshold": 1, "cooldown": 100, "max_cooldown": 300}, str(tmpdir.join("state", "circuits.json")))
+    now = time.time()
+    with patch("splunk_api.time.time") as mock_time:
+        mock_time.return_value = now
+        splunk_api.report_circuit(circuit, "https://cm:8089", False)
+        assert splunk_api.acquire_circuit(dict(circuit, max_cooldown=5), "https://cm:8089") == "1 consecutive failures, next probe in 5s"
+        mock_time.return_value = now + 5
+        assert splunk_api.acquire_circuit(circuit, "https://cm:8089") == "1 consecutive failures, next probe in 95s"
+        assert splunk_api.acquire_circuit(dict(circuit, max_cooldown=5), "https://cm:8089") is None
+
+@pytest.mark.parametrize("up_at", [0, 100, 175, 340])
+def test_poll_circuit(tmpdir, up_at):
+    clock = FakeClock()
+    circuit = splunk_api.get_circuit({}, str(tmpdir.join("state", "circuits.json")))
+    # The wait of wait_for_splunk_instance.yml
+    wait = splunk_api.get_wait({"interval": 6, "max_interval": 6, "timeout": 360})
+    sent = []
+    def send_call(*args):
+        sent.append(clock.now - 1000)
+        return (MagicMock(status_code=200), "No Exception") if clock.now - 1000 >= up_at else (None, "connection refused")
+    call = {"method": "GET", "url": "/", "host": "sh1"}
+    with patch("splunk_api.time", new=clock), patch("splunk_api.send_call", side_effect=send_call):
+        # Another task already opened the circuit for long
+        splunk_api.report_circuit(dict(circuit, threshold=1, cooldown=300), "https://sh1:8089", False)
+        response, excep_str, attempts, done = splunk_api.poll(
+            lambda: splunk_api.circuit_call(call, None, None, "https", 8089, False, None, None, None, None, False, splunk_api.get_wait_circuit(circuit, wait)),
+            lambda response: response.status_code == 200, wait)
+    assert done
+    # Seen within an interval of coming back, however long it was down
+    assert sent[-1] - up_at < 6
+    assert all(b - a <= 6 for a, b in zip(sent, sent[1:]))
+
+def test_circuit_without_private_dir(tmpdir):
+    os.chmod(str(tmpdir), 0o755)
+    circuit = splunk_api.get_circuit({"threshold": 1}, str(tmpdir.join("circuits.json")))
+    splunk_api.report_circuit(circuit, "https://cm:8089", False)
+    assert splunk_api.acquire_circuit(circuit, "https://cm:8089") is None
+    assert not tmpdir.join("circuits.json").exists()
+
+def test_api_call_circuit(splunkd, tmpdir):
+    circuit = splunk_api.get_circuit({"threshold": 2}, str(tmpdir.join("state", "circuits.json")))
+    down = {"method": "GET", "url": "/services/server/info", "host": "127.0.0.1"}
+    port = closed_port()
+    for _ in range(2):
+        response, excep_str = splunk_api.api_call(down, "admin", "helloworld", "http", port, False, circuit=circuit)
+        assert response is None and "Circuit open" not in excep_str
+    metrics = splunk_api.new_metrics()
+    response, excep_str = splunk_api.api_call(down, "admin", "helloworld", "http", port, False, metrics=metrics, circuit=circuit)
+    assert response is None and excep_str.startswith("Circuit open for http://127.0.0.1:{}: 2 consecutive failures".format(port))
+    assert (metrics["refused"], metrics["requests"], metrics["connections"]) == (1, 0, 0)
+    # Any answer but a 5xx means splunkd is up
+    up = {"method": "GET", "url": "/services/missing"}
+    for _ in range(3):
+        response, excep_str = splunk_api.api_call(up, "admin", "helloworld", "http", splunkd.server_address[1], False, circuit=circuit)
+        assert response.status_code == 404
+    with open(circuit["state"]) as f:
+        assert list(json.load(f)) == ["http://127.0.0.1:{}".format(port)]
+
+def test_main_circuit(splunkd, splunkd_uds, splunk_home, tmpdir):
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": closed_port(), "host": "127.0.0.1", "splunk_home": splunk_home, "circuit": {"threshold": 2}}
+    # The failures of each task add up
+    for _ in range(2):
+        result = run_module(args, tmpdir)
+        assert result["failed"] and "Circuit open" not in result["msg"]
+    result = run_module(args, tmpdir)
+    assert result["failed"] and "Circuit open" in result["msg"] and result["metrics"]["refused"] == 1
+    # Waits go on with the other tasks probing the target
+    result = run_module(dict(args, wait={"interval": 0.1, "timeout": 0.3}), tmpdir)
+    assert result["failed"] and result["metrics"]["refused"] == result["attempts"]
+    # A host goes over TCP even when a UDS socket is available
+    result = run_module(dict(args, svc_port=splunkd.server_address[1]), tmpdir)
+    assert result["status"] == 200 and result["transport"] == "tcp"
+    assert splunkd.requests[-1][:2] == ("GET", "/services/server/info") and splunkd_uds.requests == []
+    result = run_module(dict(args, svc_port=splunkd.server_address[1], host=None, circuit={"threshold": "none"}), tmpdir)
+    assert result["failed"] and "Invalid circuit" in result["msg"]
+
+def test_main_without_credentials(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/server/info", "cert_prefix": "http", "svc_port": splunkd.server_address[1],
+            "host": "127.0.0.1", "status_code": "200,401", "circuit": {}}
+    # A remote host is reached without logging in nor sending any credentials
+    result = run_module(args, tmpdir)
+    assert not result.get("failed") and result["status"] == 401
+    assert splunkd.requests == [("GET", "/services/server/info", None)]
+    result = run_module(dict(args, host=None), tmpdir)
+    assert result["failed"] and result["msg"] == "username and password are required unless host is set"
+    result = run_module(dict(args, username="admin"), tmpdir)
+    assert result["failed"] and result["msg"] == "username and password must be set together"
+
+def test_main_wait_unanswered(tmpdir):
+    # Accepts connections, never answers
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(8)
+    try:
+        args = {"method": "GET", "url": "/", "cert_prefix": "http", "svc_port": sock.getsockname()[1], "host": "127.0.0.1",
+                "timeout": 1, "circuit": {}, "wait": {"interval": 0.1, "timeout": 0.5}}
+        start = time.time()
+        result = run_module(args, tmpdir)
+        assert time.time() - start < 10
+    finally:
+        sock.close()
+    assert result["failed"] and "did not meet the wait condition" in result["msg"]
+    assert "timed out" in result["msg"]
+
+def pipeline(server, calls, depth, on_error="collect", session_auth=None, uds_socket=None, circuit=None):
+    port = None if uds_socket else server.server_address[1]
+    return splunk_api.pipeline_calls(calls, {}, "admin", "helloworld", "http", port, False, session_auth, uds_socket, depth, on_error, circuit)
+
+@pytest.mark.parametrize("depth", [1, 4, 100])
+def test_pipeline_calls(splunkd, depth):
+    calls = [{"method": "GET", "url": "/services/server/info", "name": "info{}".format(i)} for i in range(10)]
+    calls[3] = {"method": "POST", "url": "/services/search/distributed/groups", "body": {"name": "dmc_group_indexer", "member": ["a", "b"]},
+                "body_format": "form-urlencoded", "status_code": [201]}
+    calls[6] = {"method": "GET", "url": "/services/missing"}
+    results = pipeline(splunkd, calls, depth)
+    assert [r["status"] for r in results] == [200] * 3 + [201] + [200] * 2 + [404] + [200] * 3
+    assert [r["failed"] for r in results] == [False] * 6 + [True] + [False] * 3
+    assert results[0]["name"] == "info0" and results[0]["json"] == {"entry": [{"content": {"version": "8.1.0"}}]}
+    assert results[3]["json"] == {"form": {"name": ["dmc_group_indexer"], "member": ["a", "b"]}}
+    # A single connection for all of them
+    assert splunkd.connections == 1
+    assert [r["metrics"]["connections"] for r in results] == [1] + [0] * 9
+    assert all(r["metrics"]["requests"] == 1 and r["metrics"]["transport"] == "tcp" for r in results)
+    assert results[3]["metrics"]["bytes_out"] == len("name=dmc_group_indexer&member=a&member=b")
+
+def test_pipeline_calls_stop(splunkd):
+    calls = [{"method": "GET", "url": "/services/server/info"}, {"method": "GET", "url": "/services/missing"}] + [{"method": "GET", "url": "/services/server/info"}] * 6
+    results = pipeline(splunkd, calls, 4, "stop")
+    # The calls in flight when the failure comes back, refilled after the first answer, are still answered
+    assert [r.get("status") for r in results] == [200, 404, 200, 200, 200, None, None, None]
+    assert [r["skipped"] for r in results] == [False] * 5 + [True] * 3
+
+def test_pipeline_calls_connection_close(splunkd):
+    splunkd.keepalive_requests = 3
+    results = pipeline(splunkd, [{"method": "GET", "url": "/services/server/info"}] * 10, 8)
+    assert [r["status"] for r in results] == [200] * 10
+    # One more at times, when the requests written after the last answer reset the connection before it is read
+    assert splunkd.connections >= 4
+    assert sum(r["metrics"]["connections"] for r in results) == splunkd.connections
+
+def test_pipeline_calls_session(splunkd, session_auth):
+    calls = [{"method": "GET", "url": "/services/server/info"}] * 5
+    results = pipeline(splunkd, calls, 4, session_auth=session_auth)
+    assert [r["status"] for r in results] == [200] * 5 and results[0]["metrics"]["logins"] == 1
+    assert set(auth for _, path, auth in splunkd.requests if path != "/services/auth/login") == set(["Splunk key0"])
+    # Calls answered 401 are resent once with a new key
+    splunkd.session_keys[0] = "revoked"
+    results = pipeline(splunkd, calls, 4, session_auth=session_auth)
+    assert [r["status"] for r in results] == [200] * 5
+    assert sum(r["metrics"]["retries"] for r in results) == 4 and sum(r["metrics"]["logins"] for r in results) == 1
+    # and with basic auth when no key can be obtained
+    splunkd.login_enabled = False
+    splunkd.session_keys[:] = []
+    del splunkd.requests[:]
+    results = pipeline(splunkd, calls[:2], 4, session_auth=session_auth)
+    assert [r["status"] for r in results] == [200] * 2
+    assert [auth.split()[0] for _, path, auth in splunkd.requests if path != "/services/auth/login"] == ["Splunk", "Splunk", "Basic", "Basic"]
+
+def test_pipeline_calls_uds(splunkd_uds):
+    results = pipeline(splunkd_uds, [{"method": "GET", "url": "/services/server/info"}] * 3, 4, uds_socket=splunkd_uds.server_address)
+    assert [r["status"] for r in results] == [200] * 3 and results[0]["metrics"]["transport"] == "uds"
+    assert splunkd_uds.connections == 1
+
+def test_pipeline_calls_unreachable(tmpdir):
+    calls = [{"method": "GET", "url": "/services/server/info"}] * 3
+    circuit = splunk_api.get_circuit({"threshold": 1}, str(tmpdir.join("state", "circuits.json")))
+    results = splunk_api.pipeline_calls(calls, {}, "admin", "helloworld", "http", closed_port(), False, None, None, 4, "collect", circuit)
+    assert all(r["failed"] and r["msg"].startswith("URL: http://127.0.0.1:") for r in results)
+    results = splunk_api.pipeline_calls(calls, {}, "admin", "helloworld", "http", closed_port(), False, None, None, 4, "collect")
+    assert all(r["failed"] for r in results)
+
+def test_main_pipeline(splunkd, tmpdir):
+    args = {"method": "GET", "url": "/services/server/info", "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": splunkd.server_address[1], "requests": [{"name": "info{}".format(i)} for i in range(20)], "pipeline": 8}
+    result = run_module(args, tmpdir)
+    assert [r["status"] for r in result["results"]] == [200] * 20 and [r["name"] for r in result["results"]][:2] == ["info0", "info1"]
+    # The login and the pipelined connection
+    assert splunkd.connections == 2
+    result = run_module(dict(args, pipeline=0), tmpdir)
+    assert result["failed"] and "pipeline must be at least 1" in result["msg"]
+    result = run_module(dict(args, requests=[{"ensure": "present", "method": "POST"}]), tmpdir)
+    assert result["failed"] and "ensure is not supported along with pipeline" in result["msg"]
+    result = run_module(dict((k, v) for k, v in args.items() if k != "requests"), tmpdir)
+    assert result["failed"] and "pipeline is only supported along with requests" in result["msg"]
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+Unit tests for library/splunk_app_sync.py
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add splunk_app_sync.py into path for testing
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_app_sync
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def tree(root):
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            found[os.path.relpath(path, root)] = read(path)
+    return found
+
+@pytest.fixture
+def apps(tmpdir):
+    src = str(tmpdir.mkdir("apps"))
+    dest = str(tmpdir.mkdir("shcluster").mkdir("apps"))
+    write(os.path.join(src, "app1", "default", "app.conf"), "[install]\nstate = enabled\n")
+    write(os.path.join(src, "app1", "local", "app.conf"), "[install]\nstate = disabled\n")
+    write(os.path.join(src, "app1", "local", "inputs.conf"), "[monitor:///var/log]\n")
+    write(os.path.join(src, "app1", "bin", "script.py"), "print('hello')\n")
+    write(os.path.join(src, "app1", "bin", "script.pyc"), "bytecode")
+    write(os.path.join(src, "app1", "bin", "__pycache__", "script.cpython-37.pyc"), "bytecode")
+    write(os.path.join(src, "app2", "default", "props.conf"), "[source::...]\n")
+    write(os.path.join(src, "app3", "default", "props.conf"), "[not synced]\n")
+    return src, dest
+
+EXPECTED = {
+    "app1/default/app.conf": "[install]\nstate = enabled\n",
+    "app1/local/inputs.conf": "[monitor:///var/log]\n",
+    "app1/bin/script.py": "print('hello')\n",
+    "app2/default/props.conf": "[source::...]\n",
+}
+
+@pytest.mark.parametrize(("rel_path", "excluded"),
+            [
+                ("app1/local/app.conf", True),
+                ("app1/default/app.conf", False),
+                ("app1/bin/script.pyc", True),
+                ("app1/bin/__pycache__", True),
+                ("app1/bin/lib/__pycache__/x.py", True),
+                ("app1/bin/script.py", False),
+                ("local/app.conf", True),
+                ("app1/mylocal/app.conf", False),
+            ]
+        )
+def test_is_excluded(rel_path, excluded):
+    assert splunk_app_sync.is_excluded(rel_path, splunk_app_sync.DEFAULT_EXCLUDES) == excluded
+
+def test_get_manifest_path():
+    assert splunk_app_sync.get_manifest_path("/opt/splunk/etc/shcluster/apps/") == "/opt/splunk/etc/shcluster/.apps.app_sync.json"
+
+def test_sync(apps):
+    src, dest = apps
+    result = splunk_app_sync.sync_apps(src, dest, ["app1", "app2"])
+    assert tree(dest) == EXPECTED
+    assert result["changed_apps"] == ["app1", "app2"]
+    assert result["copied"] + result["linked"] == 4
+    assert result["copied"] == 1
+    assert result["bytes_copied"] == len(EXPECTED["app1/local/inputs.conf"])
+    assert result["bytes_linked"] == sum(len(v) for k, v in EXPECTED.items() if "/local/" not in k)
+    assert os.path.exists(splunk_app_sync.get_manifest_path(dest))
+    # Files under local/ are copied as splunkd edits them in place, the others are linked
+    assert os.stat(os.path.join(dest, "app1", "local", "inputs.conf")).st_ino != os.stat(os.path.join(src, "app1", "local", "inputs.conf")).st_ino
+    assert os.stat(os.path.join(dest, "app1", "bin", "script.py")).st_ino == os.stat(os.path.join(src, "app1", "bin", "script.py")).st_ino
+    # Nothing to do, nor to hash, the second time
+    result = splunk_app_sync.sync_apps(src, dest, ["app1", "app2"])
+    assert result["changed_apps"] == []
+    assert result["unchanged"] == 4
+    assert result["hashed"] == 0
+
+def test_sync_changes(apps):
+    src, dest = apps
+    splunk_app_sync.sync_apps(src, dest, ["app1", "app2"], hardlink=False)
+    write(os.path.join(dest, "app1", "local", "app.conf"), "left alone")
+    write(os.path.join(src, "app1", "default", "app.conf"), "[install]\nstate = enabled\nbuild = 2\n")
+    write(os.path.join(src, "app1", "default", "new.conf"), "[new]\n")
+    os.unlink(os.path.join(src, "app1", "bin", "script.py"))
+    os.utime(os.path.join(src, "app2", "default", "props.conf"), (0, 0))
+    result = splunk_app_sync.sync_apps(src, dest, ["app1", "app2"], hardlink=False)
+    assert result["changed_apps"] == ["app1"]
+    assert (result["copied"], result["deleted"], result["unchanged"]) == (2, 1, 2)
+    # Only the touched file was hashed, along with the ones to copy
+    assert result["hashed"] == 3
+    assert result["bytes_copied"] == len("[install]\nstate = enabled\nbuild = 2\n") + len("[new]\n")
+    assert tree(dest) == {
+        "app1/default/app.conf": "[install]\nstate = enabled\nbuild = 2\n",
+        "app1/default/new.conf": "[new]\n",
+        "app1/local/app.conf": "left alone",
+        "app1/local/inputs.conf": "[monitor:///var/log]\n",
+        "app2/default/props.conf": "[source::...]\n",
+    }
+    # The directory emptied by the deletion is removed
+    assert not os.path.exists(os.path.join(dest, "app1", "bin"))
+
+def test_sync_existing_dest(apps):
+    src, dest = apps
+    # A dest already populated by the tar copy is adopted without copying what is the same
+    write(os.path.join(dest, "app1", "default", "app.conf"), EXPECTED["app1/default/app.conf"])
+    write(os.path.join(dest, "app2", "default", "props.conf"), "[modified]\n")
+    write(os.path.join(dest, "app2", "default", "extra.conf"), "[extra]\n")
+    result = splunk_app_sync.sync_apps(src, dest, ["app1", "app2"], hardlink=False)
+    assert (result["copied"], result["unchanged"], result["deleted"]) == (3, 1, 0)
+    assert result["changed_apps"] == ["app1", "app2"]
+    # Files no sync installed are left in place
+    assert tree(dest) == dict(EXPECTED, **{"app2/default/extra.conf": "[extra]\n"})
+
+def test_sync_dest_modified(apps):
+    src, dest = apps
+    splunk_app_sync.sync_apps(src, dest, ["app2"], hardlink=False)
+    write(os.path.join(dest, "app2", "default", "props.conf"), "[modified]\n")
+    result = splunk_app_sync.sync_apps(src, dest, ["app2"], hardlink=False)
+    assert result["copied"] == 1
+    assert read(os.path.join(dest, "app2", "default", "props.conf")) == "[source::...]\n"
+
+def test_sync_mode(apps):
+    src, dest = apps
+    script = os.path.join(src, "app1", "bin", "script.py")
+    splunk_app_sync.sync_apps(src, dest, ["app1"], hardlink=False)
+    os.chmod(script, 0o755)
+    result = splunk_app_sync.sync_apps(src, dest, ["app1"], hardlink=False)
+    assert result["changed_apps"] == ["app1"]
+    assert result["copied"] == 0
+    assert os.stat(os.path.join(dest, "app1", "bin", "script.py")).st_mode & 0o777 == 0o755
+
+def test_sync_symlinks(apps):
+    src, dest = apps
+    os.symlink("default", os.path.join(src, "app2", "linked"))
+    os.symlink("props.conf", os.path.join(src, "app2", "default", "props_link.conf"))
+    splunk_app_sync.sync_apps(src, dest, ["app2"])
+    assert os.readlink(os.path.join(dest, "app2", "linked")) == "default"
+    assert os.readlink(os.path.join(dest, "app2", "default", "props_link.conf")) == "props.conf"
+    assert splunk_app_sync.sync_apps(src, dest, ["app2"])["changed_apps"] == []
+
+def test_sync_check_mode(apps):
+    src, dest = apps
+    result = splunk_app_sync.sync_apps(src, dest, ["app1", "app2"], check_mode=True)
+    assert result["changed_apps"] == ["app1", "app2"]
+    assert result["copied"] + result["linked"] == 4
+    assert tree(dest) == {}
+    assert not os.path.exists(splunk_app_sync.get_manifest_path(dest))
+
+def test_sync_other_apps_kept(apps):
+    src, dest = apps
+    splunk_app_sync.sync_apps(src, dest, ["app1", "app2"])
+    # Syncing a subset of the apps keeps the manifest of the others, and never deletes them
+    os.unlink(os.path.join(src, "app1", "default", "app.conf"))
+    result = splunk_app_sync.sync_apps(src, dest, ["app2"])
+    assert result["deleted"] == 0
+    assert os.path.exists(os.path.join(dest, "app1", "default", "app.conf"))
+    result = splunk_app_sync.sync_apps(src, dest, ["app1"])
+    assert result["deleted"] == 1
+    assert result["hashed"] == 0
+
+def test_sync_missing_app(apps):
+    src, dest = apps
+    with pytest.raises(ValueError, match="App app4 not found"):
+        splunk_app_sync.sync_apps(src, dest, ["app4"])
+
+def test_sync_corrupt_manifest(apps):
+    src, dest = apps
+    splunk_app_sync.sync_apps(src, dest, ["app2"], hardlink=False)
+    with open(splunk_app_sync.get_manifest_path(dest), "w") as f:
+        f.write("{")
+    result = splunk_app_sync.sync_apps(src, dest, ["app2"], hardlink=False)
+    assert (result["copied"], result["unchanged"]) == (0, 1)
+
+def run_module(args, tmpdir, check_mode=False):
+    args_file = str(tmpdir.join("args.json"))
+    if check_mode:
+        args = dict(args, _ansible_check_mode=True)
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "library", "splunk_app_sync.py"), args_file],
+                               stdout=subprocess.PIPE)
+    return json.loads(process.communicate()[0])
+
+def test_main(apps, tmpdir):
+    src, dest = apps
+    args = {"src": src, "dest": dest, "apps": ["app1", "app2"]}
+    result = run_module(args, tmpdir, check_mode=True)
+    assert result["changed"]
+    assert tree(dest) == {}
+    result = run_module(args, tmpdir)
+    assert result["changed"]
+    assert result["changed_apps"] == ["app1", "app2"]
+    assert tree(dest) == EXPECTED
+    result = run_module(args, tmpdir)
+    assert not result["changed"]
+    result = run_module(dict(args, apps=["app4"]), tmpdir)
+    assert result["failed"]
+    assert "App app4 not found" in result["msg"]
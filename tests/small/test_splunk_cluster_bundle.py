@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+Unit tests for library/splunk_cluster_bundle.py
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import subprocess
+import threading
+import pytest
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add splunk_cluster_bundle.py into path for testing
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_cluster_bundle
+
+class FakeClusterMasterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.calls.append(("GET", self.path))
+        if self.path.startswith("/services/cluster/master/info"):
+            self.reply(200, {"entry": [{"content": dict(self.server.info)}]})
+        else:
+            self.reply(404, {"messages": [{"type": "ERROR", "text": "Not Found"}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        self.server.calls.append(("POST", self.path, dict((k, v[0]) for k, v in parse_qs(body).items())))
+        info = self.server.info
+        if self.server.apply_status != 200:
+            self.reply(self.server.apply_status, {"messages": [{"type": "ERROR", "text": self.server.apply_message}]})
+            return
+        if self.server.bundle != info["latest_bundle"]["checksum"]:
+            info["previous_active_bundle"] = info["active_bundle"]
+            info["latest_bundle"] = {"checksum": self.server.bundle}
+            info["rolling_restart_flag"] = self.server.restart
+        self.reply(200, {"messages": []})
+
+@pytest.fixture
+def cluster_master():
+    server = HTTPServer(("127.0.0.1", 0), FakeClusterMasterHandler)
+    server.calls = []
+    server.info = {"active_bundle": {"checksum": "A"}, "latest_bundle": {"checksum": "A"}, "rolling_restart_flag": False}
+    server.bundle = "A"
+    server.restart = False
+    server.apply_status = 200
+    server.apply_message = ""
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def bundle(tmpdir):
+    path = tmpdir.mkdir("master-apps")
+    path.mkdir("app1").mkdir("default").join("indexes.conf").write("[main]\n")
+    path.join("app1", "default").join("props.conf").write("[source::...]\n")
+    return str(path)
+
+def target(server):
+    return "http://127.0.0.1:{}".format(server.server_address[1])
+
+def sync(server, bundle, **kwargs):
+    return splunk_cluster_bundle.sync_bundle(requests.Session(), target(server), bundle, **kwargs)
+
+def applies(server):
+    return [call for call in server.calls if call[0] == "POST"]
+
+def test_get_state_path():
+    assert splunk_cluster_bundle.get_state_path("/opt/splunk/etc/master-apps/") == "/opt/splunk/etc/.master-apps.bundle.json"
+
+def test_get_bundle_checksum(bundle):
+    checksum, files, hashed = splunk_cluster_bundle.get_bundle_checksum(bundle)
+    assert hashed == 2
+    assert sorted(files) == ["app1/default/indexes.conf", "app1/default/props.conf"]
+    # Unchanged files are not hashed again
+    assert splunk_cluster_bundle.get_bundle_checksum(bundle, files) == (checksum, files, 0)
+    with open(os.path.join(bundle, "app1", "default", "indexes.conf"), "w") as f:
+        f.write("[main]\nfrozenTimePeriodInSecs = 1\n")
+    changed, files, hashed = splunk_cluster_bundle.get_bundle_checksum(bundle, files)
+    assert (changed != checksum, hashed) == (True, 1)
+    # Mode and paths are part of the checksum
+    os.chmod(os.path.join(bundle, "app1", "default", "props.conf"), 0o600)
+    assert splunk_cluster_bundle.get_bundle_checksum(bundle, files)[0] != changed
+    os.rename(os.path.join(bundle, "app1"), os.path.join(bundle, "app2"))
+    assert splunk_cluster_bundle.get_bundle_checksum(bundle)[0] not in (checksum, changed)
+
+def test_get_bundle_checksum_missing(tmpdir):
+    with pytest.raises(ValueError, match="is not a directory"):
+        splunk_cluster_bundle.get_bundle_checksum(str(tmpdir.join("missing")))
+
+def test_sync_bundle(cluster_master, bundle):
+    cluster_master.bundle = "B"
+    cluster_master.restart = True
+    result = sync(cluster_master, bundle)
+    assert result["changed"] and result["applied"]
+    assert (result["active_checksum"], result["latest_checksum"], result["restart_required"]) == ("A", "B", True)
+    assert applies(cluster_master)[0][2] == {"ignore_identical_bundle": "true", "skip-validation": "true"}
+    # Unchanged content, and the bundle applied is still the latest one: nothing is sent
+    result = sync(cluster_master, bundle)
+    assert not result["changed"] and not result["applied"]
+    assert result["hashed"] == 0
+    assert len(applies(cluster_master)) == 1
+    # Once pushed, it is the active one
+    cluster_master.info.update(active_bundle={"checksum": "B"}, latest_bundle={"checksum": "B"}, rolling_restart_flag=False)
+    result = sync(cluster_master, bundle)
+    assert not result["changed"] and not result["restart_required"]
+    assert len(applies(cluster_master)) == 1
+
+def test_sync_bundle_content_changed(cluster_master, bundle):
+    sync(cluster_master, bundle)
+    assert len(applies(cluster_master)) == 1
+    with open(os.path.join(bundle, "app1", "default", "indexes.conf"), "a") as f:
+        f.write("frozenTimePeriodInSecs = 1\n")
+    cluster_master.bundle = "C"
+    result = sync(cluster_master, bundle)
+    assert result["changed"]
+    assert result["latest_checksum"] == "C"
+    assert len(applies(cluster_master)) == 2
+
+def test_sync_bundle_replaced(cluster_master, bundle):
+    sync(cluster_master, bundle)
+    # Someone else applied another bundle since, the local one is applied again
+    cluster_master.info.update(active_bundle={"checksum": "D"}, latest_bundle={"checksum": "D"})
+    cluster_master.bundle = "A"
+    result = sync(cluster_master, bundle)
+    assert result["changed"]
+    assert len(applies(cluster_master)) == 2
+
+def test_sync_bundle_identical(cluster_master, bundle):
+    # The cluster master already has the content, as after a rerun without state
+    result = sync(cluster_master, bundle)
+    assert not result["changed"] and not result["applied"]
+    cluster_master.apply_status = 400
+    cluster_master.apply_message = "Bundle already exists"
+    os.unlink(splunk_cluster_bundle.get_state_path(bundle))
+    result = sync(cluster_master, bundle)
+    assert not result["changed"]
+    # The state is recorded either way
+    sync(cluster_master, bundle)
+    assert len(applies(cluster_master)) == 2
+
+def test_sync_bundle_error(cluster_master, bundle):
+    cluster_master.apply_status = 500
+    cluster_master.apply_message = "Not enough peers"
+    with pytest.raises(Exception, match="returned 500: Not enough peers"):
+        sync(cluster_master, bundle)
+    assert not os.path.exists(splunk_cluster_bundle.get_state_path(bundle))
+
+def test_sync_bundle_check_mode(cluster_master, bundle):
+    cluster_master.bundle = "B"
+    result = sync(cluster_master, bundle, check_mode=True, skip_validation=False)
+    assert result["changed"] and not result["applied"]
+    assert applies(cluster_master) == []
+    assert not os.path.exists(splunk_cluster_bundle.get_state_path(bundle))
+    sync(cluster_master, bundle, skip_validation=False)
+    assert applies(cluster_master)[0][2] == {"ignore_identical_bundle": "true"}
+
+def run_module(args, tmpdir):
+    args_file = str(tmpdir.join("args.json"))
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "library", "splunk_cluster_bundle.py"), args_file],
+                               stdout=subprocess.PIPE)
+    return json.loads(process.communicate()[0])
+
+def test_main(cluster_master, bundle, tmpdir):
+    cluster_master.bundle = "B"
+    args = {"bundle_path": bundle, "username": "admin", "password": "helloworld", "cert_prefix": "http",
+            "svc_port": cluster_master.server_address[1]}
+    result = run_module(args, tmpdir)
+    assert result["changed"]
+    assert result["latest_checksum"] == "B"
+    assert not run_module(args, tmpdir)["changed"]
+    result = run_module(dict(args, svc_port=1), tmpdir)
+    assert result["failed"]
+    assert "Could not reach the cluster master" in result["msg"]
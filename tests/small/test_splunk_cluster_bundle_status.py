@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+Unit tests for library/splunk_cluster_bundle_status.py
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import socket
+import subprocess
+import pytest
+import requests
+from mock import patch, MagicMock
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(FILE_DIR, "..", "..")
+
+# Add splunk_cluster_bundle_status.py into path for testing
+sys.path.append(os.path.join(REPO_DIR, "library"))
+
+import splunk_cluster_bundle_status
+
+WAIT = {"interval": 1.0, "backoff": 2.0, "max_interval": 4.0, "timeout": 30.0}
+
+def info(latest="B", status="None", rolling_restart=False, errors=None):
+    content = {"active_bundle": {"checksum": "A"}, "latest_bundle": {"checksum": latest},
+               "apply_bundle_status": {"status": status}, "rolling_restart_flag": rolling_restart}
+    if errors:
+        content["apply_bundle_status"]["invalid_bundle"] = {"bundle_validation_errors_on_master": errors}
+    return {"entry": [{"content": content}]}
+
+def peer(name, active="b", status="Up", errors=None):
+    content = {"label": name, "active_bundle_id": active, "status": status}
+    if errors:
+        content["apply_bundle_status"] = {"invalid_bundle": {"bundle_validation_errors": errors}}
+    return {"name": name.upper(), "content": content}
+
+def response(body, status_code=200):
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.json.return_value = body
+    return resp
+
+class FakeSession(object):
+    """
+    Answer each poll with the next (info, peers) of polls, the last one once they are exhausted
+    """
+    def __init__(self, polls):
+        self.polls = list(polls)
+        self.urls = []
+        self.timeouts = []
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        self.timeouts.append(timeout)
+        poll = self.polls[0] if len(self.polls) == 1 else (self.polls.pop(0) if "/peers" in url else self.polls[0])
+        if isinstance(poll, Exception):
+            if len(self.polls) > 1 and "/info" in url:
+                self.polls.pop(0)
+            raise poll
+        if "/info" in url:
+            return response(poll[0])
+        return response({"entry": poll[1]})
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch("splunk_cluster_bundle_status.time.time", clock.time), patch("splunk_cluster_bundle_status.time.sleep", clock.sleep):
+        yield clock
+
+def test_get_progress():
+    peers = [peer("idx1"), peer("idx2", active="A"), peer("idx3", status="Restarting"), peer("idx4", status="BatchAdding")]
+    progress = splunk_cluster_bundle_status.get_progress(info()["entry"][0]["content"], peers)
+    assert (progress["applied"], progress["pending"], progress["restarting"]) == (["idx1"], ["idx2", "idx4"], ["idx3"])
+    assert (progress["latest_checksum"], progress["active_checksum"], progress["status"]) == ("B", "A", "None")
+    assert progress["errors"] == []
+    assert not splunk_cluster_bundle_status.is_done(progress)
+
+@pytest.mark.parametrize(("content", "done"),
+            [
+                (info(), True),
+                (info(status=None), True),
+                (info(status="Apply bundle in progress"), False),
+                (info(rolling_restart=True), False),
+            ]
+        )
+def test_is_done(content, done):
+    progress = splunk_cluster_bundle_status.get_progress(content["entry"][0]["content"], [peer("idx1")])
+    assert splunk_cluster_bundle_status.is_done(progress) == done
+
+def test_get_progress_errors():
+    progress = splunk_cluster_bundle_status.get_progress(info(errors=["bad indexes.conf"])["entry"][0]["content"],
+                                                         [peer("idx1", errors=["missing app"])])
+    assert progress["errors"] == ["bad indexes.conf", "idx1: missing app"]
+
+def test_wait_bundle(clock, tmpdir):
+    progress_file = str(tmpdir.join("progress.json"))
+    session = FakeSession([
+        (info(rolling_restart=True), [peer("idx1", active="A"), peer("idx2", active="A")]),
+        (info(rolling_restart=True), [peer("idx1", active="A"), peer("idx2", active="A")]),
+        (info(rolling_restart=True), [peer("idx1", status="Restarting"), peer("idx2", active="A")]),
+        requests.exceptions.ConnectionError("Connection refused"),
+        (info(rolling_restart=True), [peer("idx1"), peer("idx2", status="Restarting")]),
+        (info(), [peer("idx1"), peer("idx2")]),
+    ])
+    done, progress, history, attempts = splunk_cluster_bundle_status.wait_bundle(session, "https://127.0.0.1:8089", WAIT, progress_file=progress_file)
+    assert done
+    assert attempts == 6
+    assert progress["applied"] == ["idx1", "idx2"]
+    assert "error" not in progress
+    # Back to the minimum interval whenever the push moves, errors back off
+    assert clock.sleeps == [1, 2, 1, 2, 1]
+    assert [(h["at"], h["applied"], h["pending"], h["restarting"], h.get("error")) for h in history] == [
+        (0, 0, 2, 0, None), (3, 0, 1, 1, None), (4, 0, 1, 1, "Connection refused"), (6, 1, 0, 1, None), (7, 2, 0, 0, None)]
+    with open(progress_file) as f:
+        assert [json.loads(line)["at"] for line in f] == [0, 3, 4, 6, 7]
+    assert all(url.startswith("https://127.0.0.1:8089/services/cluster/master/") for url in session.urls)
+
+def test_wait_bundle_timeout(clock):
+    session = FakeSession([(info(rolling_restart=True), [peer("idx1", status="Restarting")])])
+    done, progress, history, attempts = splunk_cluster_bundle_status.wait_bundle(session, "https://127.0.0.1:8089", WAIT)
+    assert not done
+    assert progress["restarting"] == ["idx1"]
+    assert len(history) == 1
+    # The last sleep is cut short by the deadline
+    assert sum(clock.sleeps) == 30
+    assert clock.sleeps[-1] <= 4
+
+def test_wait_bundle_request_timeout(clock):
+    session = FakeSession([(info(rolling_restart=True), [peer("idx1", status="Restarting")])])
+    splunk_cluster_bundle_status.wait_bundle(session, "https://127.0.0.1:8089", dict(WAIT, timeout=12), timeout=10)
+    # Cut short by the deadline, at least a second for the last requests
+    assert session.timeouts == [10, 10, 10, 10, 9, 9, 5, 5, 1, 1, 1, 1]
+
+def test_wait_bundle_invalid(clock):
+    session = FakeSession([(info(errors=["bad indexes.conf"]), [peer("idx1", active="A")])])
+    done, progress, history, attempts = splunk_cluster_bundle_status.wait_bundle(session, "https://127.0.0.1:8089", WAIT)
+    assert not done
+    assert attempts == 1
+    assert progress["errors"] == ["bad indexes.conf"]
+
+def test_wait_bundle_http_error(clock):
+    session = MagicMock()
+    session.get.return_value = response({"messages": [{"type": "ERROR", "text": "Unauthorized"}]}, 401)
+    done, progress, history, attempts = splunk_cluster_bundle_status.wait_bundle(session, "https://127.0.0.1:8089", dict(WAIT, timeout=3))
+    assert not done
+    assert progress["error"] == "GET /services/cluster/master/info returned 401: Unauthorized"
+
+def run_module(args, tmpdir):
+    args_file = str(tmpdir.join("args.json"))
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "library", "splunk_cluster_bundle_status.py"), args_file],
+                               stdout=subprocess.PIPE)
+    return json.loads(process.communicate()[0])
+
+def test_main(tmpdir):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    args = {"username": "admin", "password": "helloworld", "cert_prefix": "http", "svc_port": port, "timeout": 0.5, "interval": 0.1}
+    result = run_module(args, tmpdir)
+    assert result["failed"]
+    assert result["msg"].startswith("Bundle push not complete within 0.5s after")
+    assert "last error" in result["msg"]
+    assert result["attempts"] > 1
+    result = run_module(dict(args, backoff=0.5), tmpdir)
+    assert result["msg"] == "interval must be positive and backoff at least 1"
+    result = run_module(dict(args, request_timeout=0), tmpdir)
+    assert result["msg"] == "request_timeout must be positive"